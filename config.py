@@ -1,11 +1,149 @@
 import os
 from dotenv import load_dotenv
 from pathlib import Path
+from urllib.parse import urlparse
 
 load_dotenv()
 
+# Logging (utils/logger.py). LOG_FORMAT: 'text' or 'json' (one object per line). Only a
+# LOG_DEBUG_SAMPLE share of DEBUG records is kept (1 = all), and the same warning or error is
+# written at most LOG_REPEAT_LIMIT times per LOG_REPEAT_WINDOW seconds (0 = no limit)
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').strip().lower()
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+LOG_DEBUG_SAMPLE = float(os.getenv('LOG_DEBUG_SAMPLE', 1.0))
+LOG_REPEAT_LIMIT = int(os.getenv('LOG_REPEAT_LIMIT', 5))
+LOG_REPEAT_WINDOW = float(os.getenv('LOG_REPEAT_WINDOW', 60))
+
 BASE_DIR = Path(__file__).parent
 DATABASE_URL = os.getenv('DATABASE_URL', f"sqlite+aiosqlite:///{BASE_DIR / 'velobike.db'}")
+# Engine tuning (database/db.py ENGINE_PROFILES): 'auto' picks the profile matching DATABASE_URL,
+# 'default' keeps SQLAlchemy's defaults
+DB_PROFILE = os.getenv('DB_PROFILE', 'auto')
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+# negative = KiB, as in PRAGMA cache_size
+SQLITE_CACHE_SIZE = int(os.getenv('SQLITE_CACHE_SIZE', -64 * 1024))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000))
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 10))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 20))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))
+# asyncpg prepared statements per connection; set both to 0 behind pgbouncer in transaction mode
+PG_STATEMENT_CACHE_SIZE = int(os.getenv('PG_STATEMENT_CACHE_SIZE', 500))
+PG_PREPARED_STATEMENT_CACHE_SIZE = int(os.getenv('PG_PREPARED_STATEMENT_CACHE_SIZE', 500))
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 ADMIN_IDS = [int(x) for x in os.getenv('ADMIN_IDS','').split(',') if x.strip()]
 
+# How updates reach the bot: 'polling' (default) or 'webhook'
+BOT_MODE = os.getenv('BOT_MODE', 'polling').strip().lower()
+
+# Webhook mode: public URL registered with Telegram and the local server it is served from
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH') or urlparse(WEBHOOK_URL).path or '/webhook'
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBAPP_HOST = os.getenv('WEBAPP_HOST', '0.0.0.0')
+WEBAPP_PORT = int(os.getenv('WEBAPP_PORT') or os.getenv('PORT') or 8080)
+# bounded in-process queue between the HTTP server and the handler workers
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', 1000))
+HANDLER_CONCURRENCY = int(os.getenv('HANDLER_CONCURRENCY', 16))
+
+# Readiness (utils/startup.py): GET READY_PATH on the webhook and metrics servers, and
+# READY_FILE (empty = none) written once updates are accepted, e.g. for a container health check
+READY_PATH = os.getenv('READY_PATH', '/ready')
+READY_FILE = os.getenv('READY_FILE', '')
+
+# Conversation state: idle flows expire after STATE_TTL_SECONDS; at most STATE_MAX_ENTRIES kept in memory.
+# STATE_STORAGE_URL: sqlite:///path (local), redis://host:6379/0 (production) or memory:// (no durability)
+STATE_STORAGE_URL = os.getenv('STATE_STORAGE_URL', f"sqlite:///{BASE_DIR / 'state.db'}")
+STATE_TTL_SECONDS = int(os.getenv('STATE_TTL_SECONDS', 6 * 3600))
+STATE_MAX_ENTRIES = int(os.getenv('STATE_MAX_ENTRIES', 100000))
+
+# In-process telegram_id -> user cache. Each instance keeps its own copy, so the TTL bounds
+# how long another instance's write can stay invisible here.
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 50000))
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 600))
+
+# Partner ledger: how often (seconds, 0 = never) it is checked against rentals/payouts,
+# and whether mismatches are corrected from the raw tables
+LEDGER_RECONCILE_INTERVAL = int(os.getenv('LEDGER_RECONCILE_INTERVAL', 3600))
+LEDGER_RECONCILE_FIX = os.getenv('LEDGER_RECONCILE_FIX', '1').lower() in ('1', 'true', 'yes')
+
+# /stats is served from counters snapshotted at most STATS_MAX_AGE seconds ago. The counters are
+# checked against full-table counts every STATS_RECONCILE_INTERVAL seconds (0 = never)
+STATS_MAX_AGE = float(os.getenv('STATS_MAX_AGE', 30))
+STATS_RECONCILE_INTERVAL = int(os.getenv('STATS_RECONCILE_INTERVAL', 3600))
+STATS_RECONCILE_FIX = os.getenv('STATS_RECONCILE_FIX', '1').lower() in ('1', 'true', 'yes')
+
+# Nearest-bike search (services/location.py): grid cell size in degrees (0.005 ~ 500 m),
+# how many bikes to offer and how far to look
+GEO_CELL_DEG = float(os.getenv('GEO_CELL_DEG', 0.005))
+NEAREST_BIKES = int(os.getenv('NEAREST_BIKES', 5))
+NEAREST_MAX_KM = float(os.getenv('NEAREST_MAX_KM', 10))
+
+# In-process bike availability index (services/bike_service.py): full reload interval in
+# seconds, which bounds how long another instance's changes go unseen (0 = never)
+BIKE_INDEX_REFRESH = int(os.getenv('BIKE_INDEX_REFRESH', 300))
+
+# Outbound notifications (services/notifier.py). Telegram allows about 30 messages/s overall
+# and 1/s per chat
+NOTIFY_QUEUE_SIZE = int(os.getenv('NOTIFY_QUEUE_SIZE', 10000))
+NOTIFY_WORKERS = int(os.getenv('NOTIFY_WORKERS', 8))
+NOTIFY_GLOBAL_RATE = float(os.getenv('NOTIFY_GLOBAL_RATE', 30))
+NOTIFY_CHAT_RATE = float(os.getenv('NOTIFY_CHAT_RATE', 1))
+NOTIFY_MAX_RETRIES = int(os.getenv('NOTIFY_MAX_RETRIES', 5))
+
+# Rentals and billing. A rental is billed from start_at to end_at: the duration is rounded up to
+# BILLING_ROUND_MINUTES (at least BILLING_MIN_MINUTES), charged at the bike's price_per_hour
+# (RENT_PRICE_PER_HOUR when the bike has none; a price of 0 is free), each started day capped at
+# RENT_DAILY_CAP (0 = no cap).
+# Rentals still open after MAX_RENT_TIME_HOURS are closed automatically; the renter is reminded
+# RENT_REMIND_BEFORE_MINUTES before that.
+MAX_RENT_TIME_HOURS = float(os.getenv('MAX_RENT_TIME_HOURS', 24))
+RENT_PRICE_PER_HOUR = float(os.getenv('RENT_PRICE_PER_HOUR', 5.0))
+BILLING_ROUND_MINUTES = int(os.getenv('BILLING_ROUND_MINUTES', 15))
+BILLING_MIN_MINUTES = int(os.getenv('BILLING_MIN_MINUTES', 15))
+RENT_DAILY_CAP = float(os.getenv('RENT_DAILY_CAP', 0))
+FEE_DECIMALS = int(os.getenv('FEE_DECIMALS', 2))
+RENT_REMIND_BEFORE_MINUTES = int(os.getenv('RENT_REMIND_BEFORE_MINUTES', 30))
+
+# Payments. PAYMENT_PROVIDER picks the provider class in services/payment_service.py ('fake' is a
+# local stand-in). Providers confirm through a signed POST to PAYMENT_CALLBACK_PATH (webhook mode);
+# payments still pending after PAYMENT_PENDING_TIMEOUT seconds are re-checked with the provider
+# every PAYMENT_RECONCILE_INTERVAL seconds.
+PAYMENT_PROVIDER = os.getenv('PAYMENT_PROVIDER', 'fake')
+PAYMENT_CURRENCY = os.getenv('PAYMENT_CURRENCY', 'UZS')
+PAYMENT_CALLBACK_PATH = os.getenv('PAYMENT_CALLBACK_PATH', '/payments/callback')
+PAYMENT_CALLBACK_SECRET = os.getenv('PAYMENT_CALLBACK_SECRET', '')
+PAYMENT_PENDING_TIMEOUT = float(os.getenv('PAYMENT_PENDING_TIMEOUT', 60))
+PAYMENT_RECONCILE_INTERVAL = float(os.getenv('PAYMENT_RECONCILE_INTERVAL', 60))
+FAKE_PAYMENT_LATENCY = float(os.getenv('FAKE_PAYMENT_LATENCY', 0.05))
+FAKE_PAYMENT_FAIL_RATE = float(os.getenv('FAKE_PAYMENT_FAIL_RATE', 0))
+
+# /payout_run pays every partner whose outstanding balance is at least PAYOUT_MIN_AMOUNT
+PAYOUT_MIN_AMOUNT = float(os.getenv('PAYOUT_MIN_AMOUNT', 1.0))
+
+# Referrals: /top lists the REFERRAL_TOP_N best referrers from a list re-read at most every
+# REFERRAL_TOP_MAX_AGE seconds; /my_referrals counts referrals down to REFERRAL_TREE_DEPTH levels
+REFERRAL_TOP_N = int(os.getenv('REFERRAL_TOP_N', 10))
+REFERRAL_TOP_MAX_AGE = float(os.getenv('REFERRAL_TOP_MAX_AGE', 60))
+REFERRAL_TREE_DEPTH = int(os.getenv('REFERRAL_TREE_DEPTH', 3))
+
+# Metrics (services/metrics.py): Prometheus text on METRICS_HOST:METRICS_PORT + METRICS_PATH
+# (0 = no endpoint). Statements slower than SLOW_QUERY_MS are logged (0 = never)
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+METRICS_PATH = os.getenv('METRICS_PATH', '/metrics')
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', 0))
+
+# Partner bike photos (services/photos.py): PHOTO_WORKERS processes resize and hash them, off the
+# event loop. Each photo is re-encoded as a PHOTO_CATALOG_SIZE and a PHOTO_THUMB_SIZE px JPEG (longest
+# side, PHOTO_JPEG_QUALITY) and flagged as a duplicate when its hash is within PHOTO_DUPLICATE_DISTANCE
+# bits of an earlier photo's. Variants are uploaded to PHOTO_STORE_CHAT_ID (a private channel the bot
+# posts in; 0 = to the first admin, as the new-partner notification)
+PHOTO_WORKERS = int(os.getenv('PHOTO_WORKERS', 1))
+PHOTO_CATALOG_SIZE = int(os.getenv('PHOTO_CATALOG_SIZE', 1280))
+PHOTO_THUMB_SIZE = int(os.getenv('PHOTO_THUMB_SIZE', 320))
+PHOTO_JPEG_QUALITY = int(os.getenv('PHOTO_JPEG_QUALITY', 80))
+PHOTO_DUPLICATE_DISTANCE = int(os.getenv('PHOTO_DUPLICATE_DISTANCE', 6))
+PHOTO_STORE_CHAT_ID = int(os.getenv('PHOTO_STORE_CHAT_ID', 0))
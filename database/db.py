@@ -1,15 +1,135 @@
+from sqlalchemy import event, make_url
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker, declarative_base
-from config import DATABASE_URL
+from sqlalchemy.orm import sessionmaker, declarative_base, Session
+from config import DATABASE_URL, DB_PROFILE, SQLITE_SYNCHRONOUS, SQLITE_MMAP_SIZE, SQLITE_CACHE_SIZE, SQLITE_BUSY_TIMEOUT_MS
+from config import DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, PG_STATEMENT_CACHE_SIZE, PG_PREPARED_STATEMENT_CACHE_SIZE
 from contextlib import asynccontextmanager
 
-engine = create_async_engine(DATABASE_URL, echo=False, future=True)
+
+def _default_engine(url):
+    return create_async_engine(url, echo=False, future=True)
+
+
+def _sqlite_connections(eng, immediate: bool):
+    """Per-connection pragmas; with immediate=True every transaction starts with BEGIN IMMEDIATE."""
+    pragmas = {
+        'journal_mode': 'WAL',
+        'synchronous': SQLITE_SYNCHRONOUS,
+        'mmap_size': SQLITE_MMAP_SIZE,
+        'cache_size': SQLITE_CACHE_SIZE,
+        'busy_timeout': SQLITE_BUSY_TIMEOUT_MS,
+    }
+
+    @event.listens_for(eng.sync_engine, 'connect')
+    def _set_pragmas(dbapi_conn, _record):
+        cursor = dbapi_conn.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+        if immediate:
+            # stop the driver from emitting its own deferred BEGIN; _begin_immediate does it
+            dbapi_conn.isolation_level = None
+
+    if immediate:
+        @event.listens_for(eng.sync_engine, 'begin')
+        def _begin_immediate(conn):
+            conn.exec_driver_sql('BEGIN IMMEDIATE')
+
+    return eng
+
+
+def _sqlite_engine(url):
+    """WAL so readers never wait for the writer, plus per-connection pragmas.
+
+    Transactions start with BEGIN IMMEDIATE. A deferred transaction that reads
+    first takes a snapshot, and once another writer commits its later upgrade to
+    a write fails at once with "database is locked" (busy_timeout does not apply).
+    Taking the write lock up front makes concurrent updates wait instead.
+    Since only one transaction can run at a time anyway, the pool holds a single
+    connection: waiters queue on it in order instead of polling in SQLite's busy
+    handler, where some of them starve past busy_timeout under load.
+    """
+    eng = create_async_engine(url, echo=False, future=True, pool_size=1, max_overflow=0)
+    return _sqlite_connections(eng, immediate=True)
+
+
+def _sqlite_read_engine(url):
+    """Own pool for long read-only streams, which would otherwise hold the write lock.
+
+    The driver's deferred transactions never take it for plain SELECTs, so these
+    read alongside the writer as WAL allows.
+    """
+    return _sqlite_connections(create_async_engine(url, echo=False, future=True), immediate=False)
+
+
+def _postgres_engine(url):
+    url = make_url(url)
+    if url.drivername == 'postgresql+asyncpg':
+        url = url.update_query_dict({'prepared_statement_cache_size': str(PG_PREPARED_STATEMENT_CACHE_SIZE)})
+        connect_args = {'statement_cache_size': PG_STATEMENT_CACHE_SIZE}
+    else:
+        connect_args = {}
+    return create_async_engine(
+        url, echo=False, future=True,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=True,
+        connect_args=connect_args,
+    )
+
+
+ENGINE_PROFILES = {
+    'default': _default_engine,
+    'sqlite': _sqlite_engine,
+    'postgresql': _postgres_engine,
+}
+
+
+# profiles whose read-only streams need an engine of their own; the rest share the main one
+READ_ENGINE_PROFILES = {
+    'sqlite': _sqlite_read_engine,
+}
+
+
+def _resolve_profile(url: str, profile: str):
+    if profile == 'auto':
+        profile = make_url(url).get_backend_name()
+        if profile not in ENGINE_PROFILES:
+            profile = 'default'
+    if profile not in ENGINE_PROFILES:
+        raise ValueError(f"unknown DB_PROFILE {profile!r}, expected auto or one of {sorted(ENGINE_PROFILES)}")
+    return profile
+
+
+def make_engine(url: str = DATABASE_URL, profile: str = DB_PROFILE):
+    return ENGINE_PROFILES[_resolve_profile(url, profile)](url)
+
+
+def make_read_engine(url: str = DATABASE_URL, profile: str = DB_PROFILE):
+    """Engine for get_read_session(), or None when the profile reads through the main engine."""
+    factory = READ_ENGINE_PROFILES.get(_resolve_profile(url, profile))
+    return factory(url) if factory else None
+
+
+engine = make_engine()
+read_engine = make_read_engine() or engine
 AsyncSessionLocal = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+ReadSessionLocal = sessionmaker(read_engine, expire_on_commit=False, class_=AsyncSession)
 Base = declarative_base()
 
 async def init_db():
+    """Create missing tables, then apply pending migrations; returns the versions applied."""
+    # models must be registered on Base before create_all
+    from . import models  # noqa: F401
+    from .migrations import migrate, schema_current
+    async with engine.connect() as conn:
+        if await schema_current(conn):
+            return []
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+    return await migrate(engine)
 
 
 @asynccontextmanager
@@ -20,3 +140,40 @@ async def get_session():
             yield session
         finally:
             await session.close()
+
+
+@asynccontextmanager
+async def get_read_session():
+    """Session for long read-only streams (startup loads, broadcasts, exports); never commits."""
+    async with ReadSessionLocal() as session:
+        try:
+            yield session
+        finally:
+            await session.close()
+
+
+@asynccontextmanager
+async def session_scope(session: AsyncSession = None):
+    """Yield the caller's session (the caller commits), or a private one committed on exit."""
+    if session is not None:
+        yield session
+        return
+    async with get_session() as own:
+        yield own
+        await own.commit()
+
+
+def on_commit(session: AsyncSession, callback):
+    """Run callback after the session's current transaction commits; dropped on rollback."""
+    session.info.setdefault('on_commit', []).append(callback)
+
+
+@event.listens_for(Session, 'after_commit')
+def _run_on_commit(session):
+    for callback in session.info.pop('on_commit', []):
+        callback()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _drop_on_commit(session):
+    session.info.pop('on_commit', None)
@@ -0,0 +1,24 @@
+from aiogram import BaseMiddleware
+from .db import get_session
+
+
+class DbSessionMiddleware(BaseMiddleware):
+    """One AsyncSession per update, passed to handlers as ``session`` and committed at the end.
+
+    The session only checks out a connection on first use, so updates that never
+    touch the database cost nothing. Handlers may commit earlier themselves, e.g.
+    to release write locks before talking to Telegram. On SQLite every transaction
+    starts with BEGIN IMMEDIATE (database/db.py), so this goes for read-only
+    handlers too: an open read transaction holds the write lock.
+    """
+
+    async def __call__(self, handler, event, data):
+        async with get_session() as session:
+            data['session'] = session
+            try:
+                result = await handler(event, data)
+            except Exception:
+                await session.rollback()
+                raise
+            await session.commit()
+            return result
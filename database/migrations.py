@@ -0,0 +1,131 @@
+# Versioned schema migrations for databases created before a model change.
+#
+# create_all only creates missing tables, so anything added to an existing table
+# (columns, indexes) needs a step here as well. Steps run in version order inside
+# one transaction and must be idempotent: on a fresh database create_all has
+# already built the current schema and the steps only get recorded.
+import argparse
+import asyncio
+import datetime
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, insert, inspect, select, text
+from utils.logger import logger
+
+schema_migrations = Table(
+    'schema_migrations', MetaData(),
+    Column('version', Integer, primary_key=True),
+    Column('name', String, nullable=False),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+# version -> (name, fn(sync_connection))
+MIGRATIONS = {}
+
+
+def migration(version: int, name: str):
+    def register(fn):
+        if version in MIGRATIONS:
+            raise ValueError(f"duplicate migration version {version}")
+        MIGRATIONS[version] = (name, fn)
+        return fn
+    return register
+
+
+def _create_indexes(conn, *names):
+    from .db import Base
+    indexes = {ix.name: ix for table in Base.metadata.tables.values() for ix in table.indexes}
+    for name in names:
+        indexes[name].create(conn, checkfirst=True)
+
+
+def _add_columns(conn, table_name: str, *names):
+    """ALTER TABLE ... ADD COLUMN for model columns the table does not have yet."""
+    from .db import Base
+    table = Base.metadata.tables[table_name]
+    existing = {c['name'] for c in inspect(conn).get_columns(table_name)}
+    for name in names:
+        if name not in existing:
+            column = table.c[name]
+            ddl = f'ALTER TABLE {table_name} ADD COLUMN {name} {column.type.compile(dialect=conn.dialect)}'
+            if column.server_default is not None:
+                ddl += f" DEFAULT {column.server_default.arg}"
+                if not column.nullable:
+                    ddl += ' NOT NULL'
+            conn.exec_driver_sql(ddl)
+
+
+@migration(1, 'hot path indexes')
+def _hot_path_indexes(conn):
+    _create_indexes(
+        conn,
+        'ix_bikes_available', 'ix_bikes_is_main',
+        'ix_rentals_user_id', 'ix_rentals_bike_id', 'ix_rentals_start_at', 'ix_rentals_active',
+        'ix_payouts_partner_id', 'ix_users_referrer_id',
+    )
+
+
+@migration(2, 'bike coordinates')
+def _bike_coordinates(conn):
+    _add_columns(conn, 'bikes', 'lat', 'lon')
+
+
+@migration(3, 'referral counts')
+def _referral_counts(conn):
+    _add_columns(conn, 'users', 'referral_count')
+    conn.exec_driver_sql(
+        'UPDATE users SET referral_count = (SELECT count(*) FROM users r WHERE r.referrer_id = users.id) '
+        'WHERE id IN (SELECT referrer_id FROM users WHERE referrer_id IS NOT NULL)'
+    )
+    _create_indexes(conn, 'ix_users_referral_count')
+
+
+async def applied_versions(conn) -> set:
+    await conn.run_sync(schema_migrations.create, checkfirst=True)
+    return set((await conn.execute(select(schema_migrations.c.version))).scalars())
+
+
+async def schema_current(conn) -> bool:
+    """True when every model table exists and every migration is recorded: two catalog queries
+    instead of create_all's per-table reflection, so an unchanged database starts without DDL."""
+    from .db import Base
+    tables = set(await conn.run_sync(lambda sync_conn: inspect(sync_conn).get_table_names()))
+    if schema_migrations.name not in tables or not tables.issuperset(Base.metadata.tables):
+        return False
+    done = set((await conn.execute(select(schema_migrations.c.version))).scalars())
+    return done.issuperset(MIGRATIONS)
+
+
+async def migrate(engine) -> list:
+    """Apply pending migrations; returns the versions applied."""
+    from . import models  # noqa: F401  (indexes are looked up on the model metadata)
+    async with engine.begin() as conn:
+        if conn.dialect.name == 'postgresql':
+            # instances starting together: the second waits, then finds nothing pending
+            await conn.execute(text("SELECT pg_advisory_xact_lock(hashtext('schema_migrations'))"))
+        done = await applied_versions(conn)
+        pending = sorted(v for v in MIGRATIONS if v not in done)
+        for version in pending:
+            name, fn = MIGRATIONS[version]
+            logger.info("Applying migration %s: %s", version, name)
+            await conn.run_sync(fn)
+            await conn.execute(insert(schema_migrations).values(version=version, name=name, applied_at=datetime.datetime.utcnow()))
+    return pending
+
+
+async def _main():
+    parser = argparse.ArgumentParser(description='Database schema migrations')
+    parser.add_argument('command', choices=['upgrade', 'status'], nargs='?', default='upgrade')
+    args = parser.parse_args()
+    from .db import engine, init_db
+    if args.command == 'status':
+        async with engine.begin() as conn:
+            done = await applied_versions(conn)
+        for version, (name, _) in sorted(MIGRATIONS.items()):
+            print(f"{version:4d}  {'applied' if version in done else 'pending':8s} {name}")
+        return
+    # init_db creates missing tables and then applies pending migrations
+    applied = await init_db()
+    print(f"applied {', '.join(map(str, applied))}" if applied else 'schema is up to date')
+
+
+if __name__ == '__main__':
+    asyncio.run(_main())
@@ -1,7 +1,8 @@
-from sqlalchemy import Column, Integer, String, Boolean, Float, ForeignKey, DateTime
+from sqlalchemy import Column, Integer, String, Boolean, Float, ForeignKey, DateTime, Index
 from sqlalchemy.orm import relationship
 from .db import Base
 import datetime
+from collections import namedtuple
 
 class User(Base):
     __tablename__ = 'users'
@@ -11,6 +12,8 @@ class User(Base):
     # referral: who referred this user (users.referral_code)
     referrer_id = Column(Integer, ForeignKey('users.id'), nullable=True)
     referral_code = Column(String, unique=True, nullable=True)
+    # how many users name this one as referrer; kept by set_referrer / get_or_create_user
+    referral_count = Column(Integer, nullable=False, default=0, server_default='0')
     first_name = Column(String, nullable=True)
     last_name = Column(String, nullable=True)
     phone = Column(String, nullable=True)
@@ -19,6 +22,18 @@ class User(Base):
     passport_id = Column(String, nullable=True)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
 
+    # indexes added after the first release also need a migration (database/migrations.py)
+    __table_args__ = (
+        Index('ix_users_referrer_id', referrer_id),
+        # leaderboard: top referrers, read backwards
+        Index('ix_users_referral_count', referral_count, id, sqlite_where=referral_count > 0, postgresql_where=referral_count > 0),
+    )
+
+
+# Detached, read-only copy of a users row; safe to cache and share between handlers
+UserSnapshot = namedtuple('UserSnapshot', [c.name for c in User.__table__.columns])
+
+
 class Bike(Base):
     __tablename__ = 'bikes'
     id = Column(Integer, primary_key=True, index=True)
@@ -29,6 +44,49 @@ class Bike(Base):
     image_file_id = Column(String, nullable=True)
     code = Column(String, nullable=True, unique=True)
     is_main = Column(Boolean, default=False)
+    # where the bike is parked; nearest-bike search is served from services.location
+    lat = Column(Float, nullable=True)
+    lon = Column(Float, nullable=True)
+
+    # partial: only the few rows the pickers look for are indexed
+    __table_args__ = (
+        Index('ix_bikes_available', id, sqlite_where=available == True, postgresql_where=available == True),
+        Index('ix_bikes_is_main', id, sqlite_where=is_main == True, postgresql_where=is_main == True),
+    )
+
+# Detached copy of a bikes row, handed to bike change listeners
+BikeSnapshot = namedtuple('BikeSnapshot', [c.name for c in Bike.__table__.columns])
+
+
+class BikePhoto(Base):
+    """A partner's bike photo after services/photos.py processed it."""
+    __tablename__ = 'bike_photos'
+    id = Column(Integer, primary_key=True)
+    bike_id = Column(Integer, ForeignKey('bikes.id'), nullable=False)
+    # bikes.partner_id at upload time; duplicates from another partner are the suspicious ones
+    partner_id = Column(Integer, nullable=True)
+    # Telegram's file_unique_id of the original: the same file sent again has the same one
+    source_unique_id = Column(String, nullable=False)
+    # 64-bit difference hash of the image, 16 hex digits
+    phash = Column(String(16), nullable=False)
+    # size of the catalog variant
+    width = Column(Integer, nullable=True)
+    height = Column(Integer, nullable=True)
+    # file_ids of the uploaded variants, reused for every later send
+    thumb_file_id = Column(String, nullable=True)
+    catalog_file_id = Column(String, nullable=True)
+    # the earlier photo this one looks like, if any
+    duplicate_of = Column(Integer, ForeignKey('bike_photos.id'), nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+    __table_args__ = (
+        Index('ix_bike_photos_bike_id', bike_id),
+        Index('ix_bike_photos_source_unique_id', source_unique_id),
+    )
+
+
+BikePhotoSnapshot = namedtuple('BikePhotoSnapshot', [c.name for c in BikePhoto.__table__.columns])
+
 
 class Rental(Base):
     __tablename__ = 'rentals'
@@ -39,6 +97,21 @@ class Rental(Base):
     end_at = Column(DateTime, nullable=True)
     fee = Column(Float, default=0.0)
 
+    __table_args__ = (
+        Index('ix_rentals_user_id', user_id),
+        Index('ix_rentals_bike_id', bike_id),
+        Index('ix_rentals_start_at', start_at),
+        # active rentals, newest first
+        Index('ix_rentals_active', id, sqlite_where=end_at.is_(None), postgresql_where=end_at.is_(None)),
+    )
+
+    user = relationship('User')
+    bike = relationship('Bike')
+
+
+# Detached copy of a rentals row, handed to rental change listeners
+RentalSnapshot = namedtuple('RentalSnapshot', [c.name for c in Rental.__table__.columns])
+
 
 class Payout(Base):
     __tablename__ = 'payouts'
@@ -47,5 +120,61 @@ class Payout(Base):
     amount = Column(Float, nullable=False)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
 
-    user = relationship('User')
-    bike = relationship('Bike')
+    __table_args__ = (
+        Index('ix_payouts_partner_id', partner_id),
+    )
+
+
+
+class PartnerLedger(Base):
+    """Running totals per partner, updated in the same transaction as rentals and payouts."""
+    __tablename__ = 'partner_ledger'
+    # same id space as bikes.partner_id / payouts.partner_id
+    partner_id = Column(Integer, primary_key=True)
+    earned = Column(Float, nullable=False, default=0.0)
+    paid = Column(Float, nullable=False, default=0.0)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+
+class StatCounter(Base):
+    """Named totals for /stats ('users', 'partners', 'renters'), bumped in the transactions that change them."""
+    __tablename__ = 'stat_counters'
+    name = Column(String, primary_key=True)
+    value = Column(Integer, nullable=False, default=0)
+
+
+class Payment(Base):
+    """One charge attempt; idempotency_key makes a repeated submit return the same row."""
+    __tablename__ = 'payments'
+    id = Column(Integer, primary_key=True)
+    idempotency_key = Column(String, nullable=False, unique=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    rental_id = Column(Integer, ForeignKey('rentals.id'), nullable=True)
+    amount = Column(Float, nullable=False)
+    currency = Column(String, nullable=False)
+    # see PAYMENT_TRANSITIONS
+    status = Column(String, nullable=False, default='pending')
+    provider = Column(String, nullable=False)
+    provider_ref = Column(String, nullable=True)
+    error = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+    __table_args__ = (
+        Index('ix_payments_provider_ref', provider, provider_ref, unique=True),
+        Index('ix_payments_user_id', user_id),
+        Index('ix_payments_rental_id', rental_id),
+        # the reconciler only looks at payments still waiting for the provider
+        Index('ix_payments_pending', created_at, sqlite_where=status == 'pending', postgresql_where=status == 'pending'),
+    )
+
+
+PaymentSnapshot = namedtuple('PaymentSnapshot', [c.name for c in Payment.__table__.columns])
+
+# status -> statuses a payment may move to; captured/failed come from the provider, refunded from us
+PAYMENT_TRANSITIONS = {
+    'pending': ('captured', 'failed'),
+    'captured': ('refunded',),
+    'failed': (),
+    'refunded': (),
+}
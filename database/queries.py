@@ -1,228 +1,767 @@
-from sqlalchemy import select, update
-from .db import get_session
-from .models import User, Bike, Rental, Payout
-from sqlalchemy import func
+from sqlalchemy import bindparam, insert, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from .db import engine, get_read_session, on_commit, session_scope
+from .models import User, Bike, Rental, Payout, PartnerLedger, StatCounter, UserSnapshot, BikeSnapshot, RentalSnapshot
+from .models import Payment, PaymentSnapshot, PAYMENT_TRANSITIONS
+from .models import BikePhoto, BikePhotoSnapshot
+from sqlalchemy import func, literal
+from sqlalchemy.orm import aliased
+from config import USER_CACHE_SIZE, USER_CACHE_TTL
+from utils.cache import TTLCache
+import datetime
 import secrets
 
+# both sides of users.referrer_id in self-joins and UPDATE subqueries
+Referrer = aliased(User, name='referrer')
+Referred = aliased(User, name='referred')
+
+# telegram_id -> UserSnapshot; every write to a users row below refreshes its entry
+user_cache = TTLCache(max_entries=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+
+def _remember_user(user, session=None) -> UserSnapshot:
+    """Snapshot a users row and cache it (once session commits, when one is given)."""
+    snap = UserSnapshot(*(getattr(user, name) for name in UserSnapshot._fields))
+    if session is None:
+        user_cache.set(snap.telegram_id, snap)
+    else:
+        on_commit(session, lambda: user_cache.set(snap.telegram_id, snap))
+    return snap
 
-async def get_or_create_user(telegram_id: int):
-    async with get_session() as session:
-        q = await session.execute(select(User).where(User.telegram_id == telegram_id))
-        user = q.scalars().first()
-        if user:
-            return user
-        # create a user with a referral code
-        code = secrets.token_urlsafe(6)
-        user = User(telegram_id=telegram_id, referral_code=code)
-        session.add(user)
-        await session.commit()
-        await session.refresh(user)
-        return user
-
-
-async def set_referrer(telegram_id: int, ref_code: str):
-    """Set referrer for a user if ref_code matches another user's referral_code."""
-    async with get_session() as session:
-        q = await session.execute(select(User).where(User.referral_code == ref_code))
-        ref = q.scalars().first()
-        if not ref:
-            return None
-        q2 = await session.execute(select(User).where(User.telegram_id == telegram_id))
-        user = q2.scalars().first()
-        if not user:
+
+# callables(BikeSnapshot) run after a transaction that changed a bikes row commits;
+# in-memory bike indexes subscribe here
+bike_listeners = []
+
+
+def _bike_changed(bike, session):
+    snap = BikeSnapshot(*(getattr(bike, name) for name in BikeSnapshot._fields))
+    on_commit(session, lambda: [listener(snap) for listener in bike_listeners])
+    return snap
+
+
+# callables(RentalSnapshot) run after a transaction that opened or closed a rental commits
+rental_listeners = []
+
+
+def _rental_changed(rental, session):
+    snap = RentalSnapshot(*(getattr(rental, name) for name in RentalSnapshot._fields))
+    on_commit(session, lambda: [listener(snap) for listener in rental_listeners])
+    return snap
+
+
+def _insert(model):
+    """INSERT with ON CONFLICT support for the configured dialect."""
+    if engine.dialect.name == 'postgresql':
+        return postgresql.insert(model)
+    if engine.dialect.name == 'sqlite':
+        return sqlite.insert(model)
+    raise NotImplementedError(f"upserts are not implemented for {engine.dialect.name}")
+
+
+async def _ledger_add(session, partner_id: int, earned: float = 0.0, paid: float = 0.0):
+    """Add to a partner's running totals, creating the ledger row on first use."""
+    stmt = _insert(PartnerLedger).values(partner_id=partner_id, earned=earned, paid=paid, updated_at=datetime.datetime.utcnow())
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[PartnerLedger.partner_id],
+        set_={
+            'earned': PartnerLedger.earned + stmt.excluded.earned,
+            'paid': PartnerLedger.paid + stmt.excluded.paid,
+            'updated_at': stmt.excluded.updated_at,
+        },
+    )
+    await session.execute(stmt)
+
+
+STAT_NAMES = ('users', 'partners', 'renters')
+
+
+async def _counter_add(session, name: str, delta: int = 1):
+    """Bump a stat counter inside the caller's transaction."""
+    stmt = _insert(StatCounter).values(name=name, value=delta)
+    stmt = stmt.on_conflict_do_update(index_elements=[StatCounter.name], set_={'value': StatCounter.value + stmt.excluded.value})
+    await session.execute(stmt)
+
+
+async def get_or_create_user(telegram_id: int, ref_code: str = None, session=None):
+    """The user's row, inserted if new; a new user arriving with ref_code gets that referrer."""
+    cached = user_cache.get(telegram_id)
+    if cached is not None:
+        return cached
+    # existing users are the common case: read them without writing. Only a miss inserts, and
+    # ON CONFLICT DO NOTHING leaves a row created meanwhile by another update untouched.
+    values = {'telegram_id': telegram_id, 'referral_code': secrets.token_urlsafe(6)}
+    if ref_code:
+        values['referrer_id'] = select(Referrer.id).where(Referrer.referral_code == ref_code).scalar_subquery()
+    lookup = select(*User.__table__.c).where(User.telegram_id == telegram_id)
+    insert = _insert(User).values(**values).on_conflict_do_nothing(index_elements=[User.telegram_id]).returning(*User.__table__.c)
+    async with session_scope(session) as s:
+        row = (await s.execute(lookup)).first()
+        if row is None:
+            row = (await s.execute(insert)).first()
+            if row is None:
+                # lost the race to a concurrent insert
+                row = (await s.execute(lookup)).one()
+            else:
+                await _counter_add(s, 'users')
+                if row.referrer_id is not None:
+                    await _referral_add(s, row.referrer_id)
+        return _remember_user(row, s)
+
+
+async def _referral_add(session, referrer_id: int, delta: int = 1):
+    """Bump users.referral_count inside the caller's transaction; drops the referrer's cached row."""
+    stmt = update(User).where(User.id == referrer_id).values(referral_count=User.referral_count + delta).returning(User.telegram_id)
+    telegram_id = (await session.execute(stmt)).scalar()
+    if telegram_id is not None:
+        on_commit(session, lambda: user_cache.pop(telegram_id))
+
+
+async def _recount_referrals(session):
+    """Recompute every users.referral_count (after bulk changes to referrer_id)."""
+    referred = select(func.count()).select_from(Referred).where(Referred.referrer_id == User.id).scalar_subquery()
+    await session.execute(update(User).values(referral_count=referred))
+    on_commit(session, user_cache.clear)
+
+
+async def bulk_upsert_users(rows: list, chunk_size: int = 500, session=None):
+    """Insert many users at once; existing telegram_ids get the provided fields updated.
+
+    Every row needs telegram_id; other keys must be users columns. Returns the row count.
+    """
+    columns = set(UserSnapshot._fields) - {'id', 'referral_code', 'referral_count', 'created_at'}
+    now = datetime.datetime.utcnow()
+    by_keys = {}
+    for r in rows:
+        unknown = set(r) - columns
+        if unknown:
+            raise ValueError(f"unknown users columns: {sorted(unknown)}")
+        by_keys.setdefault(frozenset(r), []).append(r)
+    total = 0
+    async with session_scope(session) as s:
+        for keys, group in by_keys.items():
+            for i in range(0, len(group), chunk_size):
+                chunk = [dict(r, referral_code=secrets.token_urlsafe(6), created_at=now) for r in group[i:i + chunk_size]]
+                stmt = _insert(User).values(chunk)
+                updates = {k: stmt.excluded[k] for k in keys if k != 'telegram_id'}
+                if updates:
+                    stmt = stmt.on_conflict_do_update(index_elements=[User.telegram_id], set_=updates)
+                else:
+                    stmt = stmt.on_conflict_do_nothing(index_elements=[User.telegram_id])
+                await s.execute(stmt)
+                total += len(chunk)
+        # bulk imports are rare; recount instead of tracking which rows were new
+        await _set_counters(s, await _count_stats(s, 'users', 'partners'))
+        if any('referrer_id' in keys for keys in by_keys):
+            await _recount_referrals(s)
+        tids = [r['telegram_id'] for r in rows]
+        on_commit(s, lambda: [user_cache.pop(t) for t in tids])
+    return total
+
+
+async def iter_user_telegram_ids(batch_size: int = 5000):
+    """Yield the telegram_id of every user."""
+    q = select(User.telegram_id).order_by(User.telegram_id).execution_options(yield_per=batch_size)
+    async with get_read_session() as s:
+        result = await s.stream_scalars(q)
+        async for telegram_id in result:
+            yield telegram_id
+
+
+async def set_referrer(telegram_id: int, ref_code: str, session=None):
+    """Set the referrer of a user that has none yet, if ref_code matches another user's referral_code.
+
+    Returns the updated user, or None when nothing changed (unknown code, own code,
+    or the user already has a referrer).
+    """
+    referrer_id = select(Referrer.id).where(Referrer.referral_code == ref_code).scalar_subquery()
+    stmt = (
+        update(User)
+        .where(User.telegram_id == telegram_id, User.referrer_id.is_(None), User.id != referrer_id)
+        .values(referrer_id=referrer_id)
+        .returning(*User.__table__.c)
+    )
+    async with session_scope(session) as s:
+        row = (await s.execute(stmt)).first()
+        if row is None:
             return None
-        user.referrer_id = ref.id
-        await session.commit()
-        await session.refresh(user)
-        return user
-
-
-async def count_referrals(referrer_telegram_id: int):
-    async with get_session() as session:
-        # find user id by telegram id
-        q = await session.execute(select(User).where(User.telegram_id == referrer_telegram_id))
-        ref = q.scalars().first()
-        if not ref:
-            return 0
-        q2 = await session.execute(select(func.count()).select_from(User).where(User.referrer_id == ref.id))
-        return q2.scalar_one()
-
-
-async def admin_stats():
-    async with get_session() as session:
-        total_users = await session.execute(select(func.count()).select_from(User))
-        total_users = total_users.scalar_one()
-        total_partners = await session.execute(select(func.count()).select_from(User).where(User.is_partner == True))
-        total_partners = total_partners.scalar_one()
+        await _referral_add(s, row.referrer_id)
+        return _remember_user(row, s)
+
+
+async def count_referrals(referrer_telegram_id: int, session=None):
+    """How many users this user referred (users.referral_count, usually from the user cache)."""
+    ref = user_cache.get(referrer_telegram_id)
+    if ref is None:
+        async with session_scope(session) as s:
+            row = (await s.execute(select(*User.__table__.c).where(User.telegram_id == referrer_telegram_id))).first()
+            if row is None:
+                return 0
+            ref = _remember_user(row)
+    return ref.referral_count
+
+
+async def referral_tree(telegram_id: int, depth: int = 3, limit: int = 1000, session=None):
+    """Users referred by this user, directly (level 1) or through others, down to depth levels.
+
+    Returns at most limit rows of (id, telegram_id, first_name, referrer_id, referral_count, level),
+    ordered by level. Each level is one index lookup per user of the level above.
+    """
+    root = select(User.id).where(User.telegram_id == telegram_id).scalar_subquery()
+    tree = (
+        select(User.id, User.telegram_id, User.first_name, User.referrer_id, User.referral_count, literal(1).label('level'))
+        .where(User.referrer_id == root)
+        .cte('referral_tree', recursive=True)
+    )
+    tree = tree.union_all(
+        select(Referred.id, Referred.telegram_id, Referred.first_name, Referred.referrer_id, Referred.referral_count, tree.c.level + 1)
+        .join(tree, Referred.referrer_id == tree.c.id)
+        # the depth bound also ends cycles (A referred B, B later referred A)
+        .where(tree.c.level < depth)
+    )
+    q = select(tree).order_by(tree.c.level).limit(limit)
+    async with session_scope(session) as s:
+        return (await s.execute(q)).all()
+
+
+async def referral_tree_counts(telegram_id: int, depth: int = 3, session=None):
+    """{level: number of users} of this user's referral tree, down to depth levels."""
+    root = select(User.id).where(User.telegram_id == telegram_id).scalar_subquery()
+    tree = select(User.id, literal(1).label('level')).where(User.referrer_id == root).cte('referral_levels', recursive=True)
+    tree = tree.union_all(
+        select(Referred.id, tree.c.level + 1).join(tree, Referred.referrer_id == tree.c.id).where(tree.c.level < depth)
+    )
+    q = select(tree.c.level, func.count()).group_by(tree.c.level).order_by(tree.c.level)
+    async with session_scope(session) as s:
+        return dict((await s.execute(q)).all())
+
+
+async def top_referrers(limit: int = 10, session=None):
+    """Users with the most referrals: (id, telegram_id, first_name, referral_count), best first."""
+    q = (
+        select(User.id, User.telegram_id, User.first_name, User.referral_count)
+        .where(User.referral_count > 0)
+        .order_by(User.referral_count.desc(), User.id.desc())
+        .limit(limit)
+    )
+    async with session_scope(session) as s:
+        return (await s.execute(q)).all()
+
+
+async def _count_stats(s, *names):
+    """Full-table counts behind the stat counters (the slow path /stats used to take)."""
+    queries = {
+        'users': select(func.count()).select_from(User),
+        'partners': select(func.count()).select_from(User).where(User.is_partner == True),
         # renters = users who have rentals
-        q = await session.execute(select(func.count(func.distinct(Rental.user_id))))
-        total_renters = q.scalar_one()
-        return {'users': total_users, 'partners': total_partners, 'renters': total_renters}
+        'renters': select(func.count(func.distinct(Rental.user_id))),
+    }
+    return {name: (await s.execute(queries[name])).scalar_one() for name in names or STAT_NAMES}
+
+
+async def _set_counters(s, values: dict):
+    stmt = _insert(StatCounter).values([{'name': k, 'value': v} for k, v in values.items()])
+    await s.execute(stmt.on_conflict_do_update(index_elements=[StatCounter.name], set_={'value': stmt.excluded.value}))
+
+
+async def admin_stats(session=None):
+    """Current counter values: one primary-key read regardless of table sizes."""
+    async with session_scope(session) as s:
+        rows = dict((await s.execute(select(StatCounter.name, StatCounter.value))).all())
+        return {name: rows.get(name, 0) for name in STAT_NAMES}
+
+
+async def reconcile_stat_counters(fix: bool = False, session=None):
+    """Compare the counters with full-table counts; returns {name: (counter, actual)} for mismatches.
 
+    With fix=True mismatching counters are overwritten (this also backfills old databases).
+    On PostgreSQL counts and counters are read in one REPEATABLE READ snapshot, unless the
+    caller's session has already begun a transaction at its own isolation level.
+    """
+    async with session_scope(session) as s:
+        if engine.dialect.name == 'postgresql' and not s.in_transaction():
+            # only the connection a transaction has not begun on yet takes an isolation level
+            await s.connection(execution_options={'isolation_level': 'REPEATABLE READ'})
+        actual = await _count_stats(s)
+        have = await admin_stats(session=s)
+        mismatches = {k: (have[k], v) for k, v in actual.items() if have[k] != v}
+        if fix and mismatches:
+            await _set_counters(s, {k: v for k, (_, v) in mismatches.items()})
+        return mismatches
 
-async def list_available_bikes():
-    async with get_session() as session:
-        q = await session.execute(select(Bike).where(Bike.available == True))
+
+async def list_available_bikes(session=None):
+    async with session_scope(session) as s:
+        q = await s.execute(select(Bike).where(Bike.available == True))
         return q.scalars().all()
 
 
-async def create_rental(user_id: int, bike_id: int):
-    async with get_session() as session:
-        async with session.begin():
-            # lock the bike row for update to avoid race conditions
-            q = select(Bike).where(Bike.id == bike_id).with_for_update()
-            res = await session.execute(q)
-            bike = res.scalars().first()
-            if not bike or not bike.available:
-                return None
-            rental = Rental(user_id=user_id, bike_id=bike_id)
-            session.add(rental)
-            bike.available = False
-        # commit happens at context exit
-        await session.refresh(rental)
+async def _reserve_bike(s, bike_id: int, *extra_conditions):
+    """Compare-and-set bikes.available true -> false; returns the bike row, or None if it was not free.
+
+    A single UPDATE, so concurrent reservations of one bike cannot both succeed
+    on any backend (SQLite ignores SELECT ... FOR UPDATE).
+    """
+    stmt = (
+        update(Bike)
+        .where(Bike.id == bike_id, Bike.available == True, *extra_conditions)
+        .values(available=False)
+        .returning(*Bike.__table__.c)
+    )
+    row = (await s.execute(stmt)).first()
+    if row is not None:
+        _bike_changed(row, s)
+    return row
+
+
+async def create_rental(user_id: int, bike_id: int, session=None):
+    async with session_scope(session) as s:
+        if await _reserve_bike(s, bike_id) is None:
+            return None
+        # first rental makes the user a renter; concurrent first rentals can
+        # double count, which the periodic counter check corrects
+        first = (await s.execute(select(Rental.id).where(Rental.user_id == user_id).limit(1))).first() is None
+        if first:
+            await _counter_add(s, 'renters')
+        rental = Rental(user_id=user_id, bike_id=bike_id)
+        s.add(rental)
+        await s.flush()
+        _rental_changed(rental, s)
         return rental
 
 
-async def update_user_profile(telegram_id: int, **fields):
-    async with get_session() as session:
-        q = await session.execute(select(User).where(User.telegram_id == telegram_id))
-        user = q.scalars().first()
-        if not user:
+async def update_user_profile(telegram_id: int, session=None, **fields):
+    # referrer_id / referral_count change through set_referrer only, so the counts stay right
+    values = {k: v for k, v in fields.items() if k in UserSnapshot._fields and k not in ('id', 'telegram_id', 'referrer_id', 'referral_count')}
+    if values:
+        stmt = update(User).where(User.telegram_id == telegram_id).values(**values).returning(*User.__table__.c)
+    else:
+        stmt = select(*User.__table__.c).where(User.telegram_id == telegram_id)
+    async with session_scope(session) as s:
+        row = (await s.execute(stmt)).first()
+        if row is None:
             return None
-        for k, v in fields.items():
-            if hasattr(user, k):
-                setattr(user, k, v)
-        await session.commit()
-        await session.refresh(user)
-        return user
-
-
-async def register_partner(telegram_id: int):
-    async with get_session() as session:
-        q = await session.execute(select(User).where(User.telegram_id == telegram_id))
-        user = q.scalars().first()
-        if not user:
-            user = User(telegram_id=telegram_id, is_partner=True)
-            session.add(user)
-            await session.commit()
-            await session.refresh(user)
-            return user
-        user.is_partner = True
-        await session.commit()
-        await session.refresh(user)
-        return user
-
-
-async def create_bike_for_partner(partner_id: int, name: str, price_per_hour: float, image_file_id: str = None, code: str = None):
-    async with get_session() as session:
-        bike = Bike(name=name, price_per_hour=price_per_hour, partner_id=partner_id, image_file_id=image_file_id, code=code)
-        session.add(bike)
-        await session.commit()
-        await session.refresh(bike)
+        return _remember_user(row, s)
+
+
+async def register_partner(telegram_id: int, session=None):
+    code = secrets.token_urlsafe(6)
+    stmt = _insert(User).values(telegram_id=telegram_id, is_partner=True, referral_code=code)
+    # only touch rows that are not partners yet, so RETURNING tells us whether anything changed
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[User.telegram_id], set_={'is_partner': True}, where=User.is_partner.isnot(True),
+    ).returning(*User.__table__.c)
+    async with session_scope(session) as s:
+        row = (await s.execute(stmt)).first()
+        if row is None:
+            row = (await s.execute(select(*User.__table__.c).where(User.telegram_id == telegram_id))).one()
+        else:
+            await _counter_add(s, 'partners')
+            if row.referral_code == code:
+                await _counter_add(s, 'users')
+        return _remember_user(row, s)
+
+
+async def create_bike_for_partner(partner_id: int, name: str, price_per_hour: float, image_file_id: str = None, code: str = None, lat: float = None, lon: float = None, session=None):
+    async with session_scope(session) as s:
+        bike = Bike(name=name, price_per_hour=price_per_hour, partner_id=partner_id, image_file_id=image_file_id, code=code, lat=lat, lon=lon, available=True)
+        s.add(bike)
+        await s.flush()
+        _bike_changed(bike, s)
         return bike
 
 
-async def pick_available_bike():
+async def iter_bikes(batch_size: int = 5000):
+    """Yield every bikes row as a BikeSnapshot, in id order."""
+    q = select(*Bike.__table__.c).order_by(Bike.id).execution_options(yield_per=batch_size)
+    async with get_read_session() as s:
+        result = await s.stream(q)
+        async for row in result:
+            yield BikeSnapshot(*row)
+
+
+async def iter_available_bike_locations(batch_size: int = 5000):
+    """Yield (id, lat, lon) of available bikes that have coordinates."""
+    q = (
+        select(Bike.id, Bike.lat, Bike.lon)
+        .where(Bike.available == True, Bike.lat.isnot(None), Bike.lon.isnot(None))
+        .execution_options(yield_per=batch_size)
+    )
+    async with get_read_session() as s:
+        result = await s.stream(q)
+        async for row in result:
+            yield row
+
+
+async def pick_available_bike(session=None):
     """Pick one available bike (simple policy: lowest id)."""
-    async with get_session() as session:
-        q = await session.execute(select(Bike).where(Bike.available == True).order_by(Bike.id))
+    async with session_scope(session) as s:
+        q = await s.execute(select(Bike).where(Bike.available == True).order_by(Bike.id).limit(1))
         return q.scalars().first()
 
 
-async def set_main_bike(bike_id: int):
-    async with get_session() as session:
-        # unset previous mains
-        await session.execute(update(Bike).where(Bike.is_main == True).values(is_main=False))
-        b = await session.get(Bike, bike_id)
+async def set_main_bike(bike_id: int, session=None):
+    async with session_scope(session) as s:
+        b = await s.get(Bike, bike_id)
         if not b:
             return None
+        # unset previous mains
+        await s.execute(update(Bike).where(Bike.is_main == True, Bike.id != bike_id).values(is_main=False))
         b.is_main = True
-        await session.commit()
-        await session.refresh(b)
+        await s.flush()
+        _bike_changed(b, s)
         return b
 
 
-async def pick_main_bike():
-    async with get_session() as session:
-        q = await session.execute(select(Bike).where(Bike.is_main == True))
+async def pick_main_bike(session=None):
+    async with session_scope(session) as s:
+        q = await s.execute(select(Bike).where(Bike.is_main == True))
         return q.scalars().first()
 
 
-async def get_rental_by_id(rental_id: int):
-    async with get_session() as session:
-        return await session.get(Rental, rental_id)
-
-
-async def get_user_by_db_id(db_user_id: int):
-    async with get_session() as session:
-        return await session.get(User, db_user_id)
-
-
-async def assign_bike_to_rental(rental_id: int, bike_id: int):
-    async with get_session() as session:
-        async with session.begin():
-            # lock bike
-            q = select(Bike).where(Bike.id == bike_id).with_for_update()
-            res = await session.execute(q)
-            bike = res.scalars().first()
-            if not bike or not bike.available:
-                return None
-            rental = await session.get(Rental, rental_id)
-            if not rental:
-                return None
-            rental.bike_id = bike_id
-            bike.available = False
-        await session.refresh(rental)
-        return rental
+async def get_rental_by_id(rental_id: int, session=None):
+    async with session_scope(session) as s:
+        return await s.get(Rental, rental_id)
 
 
-async def set_rental_end(rental_id: int, hours: float):
-    async with get_session() as session:
-        async with session.begin():
-            rental = await session.get(Rental, rental_id)
-            if not rental:
-                return None
-            bike = await session.get(Bike, rental.bike_id)
-            if not bike:
-                return None
-            from datetime import datetime, timedelta
-            rental.end_at = datetime.utcnow()
-            rental.fee = (bike.price_per_hour or 0.0) * hours
-        await session.refresh(rental)
-        return rental
+async def get_user_by_db_id(db_user_id: int, session=None):
+    async with session_scope(session) as s:
+        return await s.get(User, db_user_id)
 
 
-async def list_rentals():
-    async with get_session() as session:
-        q = await session.execute(select(Rental))
+async def assign_bike_to_rental(rental_id: int, bike_id: int, session=None):
+    async with session_scope(session) as s:
+        # reserve only if the rental exists, so there is nothing to undo
+        rental_exists = select(Rental.id).where(Rental.id == rental_id).exists()
+        if await _reserve_bike(s, bike_id, rental_exists) is None:
+            return None
+        stmt = update(Rental).where(Rental.id == rental_id).values(bike_id=bike_id).returning(Rental)
+        return (await s.execute(stmt)).scalars().first()
+
+
+async def set_rental_end(rental_id: int, hours: float = None, fee_for=None, end_at: datetime.datetime = None, session=None):
+    """Close an open rental: set end_at and fee, free its bike and credit the partner.
+
+    The fee is price_per_hour * hours when hours is given, otherwise
+    fee_for(start_at, end_at, price_per_hour), where price_per_hour is None for a bike
+    without a price and 0.0 for a bike that no longer exists. Returns None if the rental does not
+    exist or is already closed, so concurrent closes bill only once.
+    """
+    if hours is None and fee_for is None:
+        raise ValueError("set_rental_end needs hours or fee_for")
+    end_at = end_at or datetime.datetime.utcnow()
+    async with session_scope(session) as s:
+        closed = (await s.execute(
+            update(Rental).where(Rental.id == rental_id, Rental.end_at.is_(None)).values(end_at=end_at).returning(Rental)
+        )).scalars().first()
+        if closed is None:
+            return None
+        freed = (await s.execute(update(Bike).where(Bike.id == closed.bike_id).values(available=True).returning(*Bike.__table__.c))).first()
+        price = freed.price_per_hour if freed is not None else 0.0
+        closed.fee = (price or 0.0) * hours if hours is not None else fee_for(closed.start_at, end_at, price)
+        if freed is not None:
+            _bike_changed(freed, s)
+            if freed.partner_id is not None and closed.fee:
+                await _ledger_add(s, freed.partner_id, earned=closed.fee)
+        await s.flush()
+        _rental_changed(closed, s)
+        return closed
+
+
+async def get_last_closed_rental(user_id: int, session=None):
+    """The user's most recently started rental that has ended, or None."""
+    async with session_scope(session) as s:
+        q = select(Rental).where(Rental.user_id == user_id, Rental.end_at.isnot(None)).order_by(Rental.id.desc()).limit(1)
+        return (await s.execute(q)).scalars().first()
+
+
+async def get_active_rental(user_id: int, session=None):
+    """The user's open rental (newest if several), or None."""
+    async with session_scope(session) as s:
+        q = select(Rental).where(Rental.user_id == user_id, Rental.end_at.is_(None)).order_by(Rental.id.desc()).limit(1)
+        return (await s.execute(q)).scalars().first()
+
+
+async def iter_active_rentals(batch_size: int = 5000):
+    """Yield (id, user_id, start_at) of every open rental."""
+    q = (
+        select(Rental.id, Rental.user_id, Rental.start_at)
+        .where(Rental.end_at.is_(None))
+        .order_by(Rental.id)
+        .execution_options(yield_per=batch_size)
+    )
+    async with get_read_session() as s:
+        result = await s.stream(q)
+        async for row in result:
+            yield row
+
+
+async def list_rentals(session=None):
+    async with session_scope(session) as s:
+        q = await s.execute(select(Rental))
         return q.scalars().all()
 
 
-async def partner_earnings(partner_id: int):
-    async with get_session() as session:
-        q = await session.execute(select(Rental).join(Bike).where(Bike.partner_id == partner_id))
-        rentals = q.scalars().all()
-        total = sum(r.fee or 0.0 for r in rentals)
-        return {'total': total, 'rentals': rentals}
-
-
-async def record_payout(partner_id: int, amount: float):
-    async with get_session() as session:
+def _rental_filters(status: str = None, day: datetime.date = None):
+    """status: 'active' / 'closed' / None; day: rentals started on that (UTC) date."""
+    conds = []
+    if status == 'active':
+        conds.append(Rental.end_at.is_(None))
+    elif status == 'closed':
+        conds.append(Rental.end_at.isnot(None))
+    if day is not None:
+        start = datetime.datetime.combine(day, datetime.time.min)
+        conds += [Rental.start_at >= start, Rental.start_at < start + datetime.timedelta(days=1)]
+    return conds
+
+
+async def list_rentals_page(after_id: int = None, before_id: int = None, status: str = None, day: datetime.date = None, limit: int = 20, session=None):
+    """One page of rentals, newest first, keyset-paginated on rentals.id.
+
+    after_id gives the page of older rentals (id < after_id), before_id the
+    page of newer ones (id > before_id). Returns {'rentals', 'has_older', 'has_newer'}.
+    """
+    conds = _rental_filters(status, day)
+    q = select(Rental)
+    if before_id is not None:
+        q = q.where(Rental.id > before_id, *conds).order_by(Rental.id.asc())
+    else:
+        if after_id is not None:
+            conds.append(Rental.id < after_id)
+        q = q.where(*conds).order_by(Rental.id.desc())
+    async with session_scope(session) as s:
+        rows = (await s.execute(q.limit(limit + 1))).scalars().all()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if before_id is not None:
+        rows.reverse()
+        return {'rentals': rows, 'has_older': True, 'has_newer': more}
+    return {'rentals': rows, 'has_older': more, 'has_newer': after_id is not None}
+
+
+async def iter_rentals(status: str = None, day: datetime.date = None, batch_size: int = 1000):
+    """Yield rental rows in id order from a server-side cursor, batch_size rows in memory at a time."""
+    q = (
+        select(Rental.id, Rental.user_id, Rental.bike_id, Rental.start_at, Rental.end_at, Rental.fee)
+        .where(*_rental_filters(status, day))
+        .order_by(Rental.id)
+        .execution_options(yield_per=batch_size)
+    )
+    async with get_read_session() as s:
+        result = await s.stream(q)
+        async for row in result:
+            yield row
+
+
+async def _ledger_row(partner_id: int, session=None):
+    async with session_scope(session) as s:
+        q = await s.execute(select(PartnerLedger.earned, PartnerLedger.paid).where(PartnerLedger.partner_id == partner_id))
+        return q.first()
+
+
+async def partner_earnings(partner_id: int, session=None):
+    row = await _ledger_row(partner_id, session=session)
+    return {'total': row.earned if row else 0.0}
+
+
+async def record_payout(partner_id: int, amount: float, session=None):
+    async with session_scope(session) as s:
         payout = Payout(partner_id=partner_id, amount=amount)
-        session.add(payout)
-        await session.commit()
-        await session.refresh(payout)
+        s.add(payout)
+        await _ledger_add(s, partner_id, paid=amount)
+        await s.flush()
         return payout
 
 
-async def list_partner_payouts(partner_id: int):
-    async with get_session() as session:
-        q = await session.execute(select(Payout).where(Payout.partner_id == partner_id))
+async def run_partner_payouts(min_amount: float, session=None):
+    """Pay out every partner whose ledger balance is at least min_amount, in one transaction.
+
+    One read of partner_ledger (rows locked on PostgreSQL, so two runs cannot pay the
+    same balance), one multi-row INSERT into payouts and one executemany UPDATE of the
+    ledger. Returns a dict per paid partner: partner_id, earned, paid (before) and amount.
+    """
+    now = datetime.datetime.utcnow()
+    ledger = PartnerLedger.__table__
+    async with session_scope(session) as s:
+        due = (await s.execute(
+            select(ledger.c.partner_id, ledger.c.earned, ledger.c.paid)
+            .where(ledger.c.earned - ledger.c.paid >= min_amount)
+            .order_by(ledger.c.partner_id)
+            .with_for_update()
+        )).all()
+        if not due:
+            return []
+        lines = [{'partner_id': r.partner_id, 'earned': r.earned, 'paid': r.paid, 'amount': r.earned - r.paid} for r in due]
+        await s.execute(insert(Payout.__table__), [{'partner_id': l['partner_id'], 'amount': l['amount'], 'created_at': now} for l in lines])
+        await s.execute(
+            update(ledger).where(ledger.c.partner_id == bindparam('pid'))
+            .values(paid=ledger.c.paid + bindparam('amt'), updated_at=now),
+            [{'pid': l['partner_id'], 'amt': l['amount']} for l in lines],
+        )
+        return lines
+
+
+async def list_partner_payouts(partner_id: int, session=None):
+    async with session_scope(session) as s:
+        q = await s.execute(select(Payout).where(Payout.partner_id == partner_id))
         return q.scalars().all()
 
 
-async def partner_balance(partner_id: int):
-    earnings = await partner_earnings(partner_id)
-    payouts = await list_partner_payouts(partner_id)
-    paid = sum(p.amount for p in payouts)
-    return {'earned': earnings['total'], 'paid': paid, 'balance': earnings['total'] - paid}
+async def partner_balance(partner_id: int, session=None):
+    row = await _ledger_row(partner_id, session=session)
+    earned, paid = (row.earned, row.paid) if row else (0.0, 0.0)
+    return {'earned': earned, 'paid': paid, 'balance': earned - paid}
+
+
+async def reconcile_partner_ledger(fix: bool = False, session=None):
+    """Compare the ledger with totals recomputed from rentals and payouts.
+
+    Returns the mismatching partners; with fix=True their ledger rows are
+    overwritten with the recomputed totals (this also backfills old databases).
+    On PostgreSQL the three aggregates read one REPEATABLE READ snapshot, unless
+    the caller's session has already begun a transaction at its own isolation level.
+    """
+    async with session_scope(session) as s:
+        if engine.dialect.name == 'postgresql' and not s.in_transaction():
+            # all three aggregates must see the same snapshot; the isolation level
+            # can only be set on the connection the transaction has not begun on yet
+            await s.connection(execution_options={'isolation_level': 'REPEATABLE READ'})
+        earned = dict((await s.execute(
+            select(Bike.partner_id, func.coalesce(func.sum(Rental.fee), 0.0))
+            .join(Rental, Rental.bike_id == Bike.id)
+            .where(Bike.partner_id.isnot(None))
+            .group_by(Bike.partner_id)
+        )).all())
+        paid = dict((await s.execute(select(Payout.partner_id, func.sum(Payout.amount)).group_by(Payout.partner_id))).all())
+        ledger = {r.partner_id: r for r in (await s.execute(select(PartnerLedger.partner_id, PartnerLedger.earned, PartnerLedger.paid))).all()}
+
+        mismatches = []
+        for pid in set(earned) | set(paid) | set(ledger):
+            want_earned, want_paid = float(earned.get(pid) or 0.0), float(paid.get(pid) or 0.0)
+            row = ledger.get(pid)
+            have_earned, have_paid = (row.earned, row.paid) if row else (0.0, 0.0)
+            if abs(want_earned - have_earned) > 1e-6 or abs(want_paid - have_paid) > 1e-6:
+                mismatches.append({'partner_id': pid, 'ledger_earned': have_earned, 'earned': want_earned, 'ledger_paid': have_paid, 'paid': want_paid})
+
+        if fix and mismatches:
+            now = datetime.datetime.utcnow()
+            for m in mismatches:
+                stmt = _insert(PartnerLedger).values(partner_id=m['partner_id'], earned=m['earned'], paid=m['paid'], updated_at=now)
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=[PartnerLedger.partner_id],
+                    set_={'earned': stmt.excluded.earned, 'paid': stmt.excluded.paid, 'updated_at': stmt.excluded.updated_at},
+                )
+                await s.execute(stmt)
+        return mismatches
+
+
+def _payment(row):
+    return PaymentSnapshot(*row) if row is not None else None
+
+
+async def create_payment_intent(idempotency_key: str, user_id: int, amount: float, currency: str, provider: str,
+                                rental_id: int = None, session=None):
+    """Insert a pending payment; returns (payment, created).
+
+    A second call with the same idempotency_key inserts nothing and returns the
+    existing row with created=False, also when both calls race.
+    """
+    now = datetime.datetime.utcnow()
+    stmt = _insert(Payment).values(
+        idempotency_key=idempotency_key, user_id=user_id, rental_id=rental_id, amount=amount,
+        currency=currency, provider=provider, status='pending', created_at=now, updated_at=now,
+    ).on_conflict_do_nothing(index_elements=[Payment.idempotency_key]).returning(*Payment.__table__.c)
+    async with session_scope(session) as s:
+        row = (await s.execute(stmt)).first()
+        if row is not None:
+            return _payment(row), True
+        row = (await s.execute(select(*Payment.__table__.c).where(Payment.idempotency_key == idempotency_key))).one()
+        return _payment(row), False
+
+
+async def get_payment(payment_id: int, session=None):
+    async with session_scope(session) as s:
+        return _payment((await s.execute(select(*Payment.__table__.c).where(Payment.id == payment_id))).first())
+
+
+async def get_payment_by_key(idempotency_key: str, session=None):
+    async with session_scope(session) as s:
+        return _payment((await s.execute(select(*Payment.__table__.c).where(Payment.idempotency_key == idempotency_key))).first())
+
+
+async def list_rental_payments(rental_id: int, session=None):
+    """Every payment attempt for a rental, oldest first."""
+    async with session_scope(session) as s:
+        q = select(*Payment.__table__.c).where(Payment.rental_id == rental_id).order_by(Payment.id)
+        return [_payment(row) for row in (await s.execute(q)).all()]
+
+
+async def set_payment_provider_ref(payment_id: int, provider_ref: str, session=None):
+    """Record the provider's id for a payment that has none yet; returns the row or None."""
+    stmt = (
+        update(Payment)
+        .where(Payment.id == payment_id, Payment.provider_ref.is_(None))
+        .values(provider_ref=provider_ref, updated_at=datetime.datetime.utcnow())
+        .returning(*Payment.__table__.c)
+    )
+    async with session_scope(session) as s:
+        return _payment((await s.execute(stmt)).first())
+
+
+async def transition_payment(payment_id: int, status: str, error: str = None, session=None):
+    """Move a payment to status if PAYMENT_TRANSITIONS allows it from its current status.
+
+    The check is part of the UPDATE, so concurrent callbacks cannot both win;
+    returns the updated row, or None if the payment was not in an allowed state.
+    """
+    allowed_from = [src for src, targets in PAYMENT_TRANSITIONS.items() if status in targets]
+    if not allowed_from:
+        raise ValueError(f"no transition leads to payment status {status!r}")
+    stmt = (
+        update(Payment)
+        .where(Payment.id == payment_id, Payment.status.in_(allowed_from))
+        .values(status=status, error=error, updated_at=datetime.datetime.utcnow())
+        .returning(*Payment.__table__.c)
+    )
+    async with session_scope(session) as s:
+        return _payment((await s.execute(stmt)).first())
+
+
+async def list_pending_payments(older_than: datetime.datetime, limit: int = 500, session=None):
+    """Pending payments created before older_than, oldest first."""
+    q = (
+        select(*Payment.__table__.c)
+        .where(Payment.status == 'pending', Payment.created_at < older_than)
+        .order_by(Payment.created_at)
+        .limit(limit)
+    )
+    async with session_scope(session) as s:
+        return [_payment(row) for row in (await s.execute(q)).all()]
+
+
+async def add_bike_photo(bike_id: int, partner_id: int, source_unique_id: str, phash: str, width: int = None, height: int = None,
+                         duplicate_of: int = None, thumb_file_id: str = None, catalog_file_id: str = None, session=None) -> int:
+    """Record a processed photo; returns its id."""
+    async with session_scope(session) as s:
+        photo = BikePhoto(bike_id=bike_id, partner_id=partner_id, source_unique_id=source_unique_id, phash=phash, width=width,
+                          height=height, duplicate_of=duplicate_of, thumb_file_id=thumb_file_id, catalog_file_id=catalog_file_id)
+        s.add(photo)
+        await s.flush()
+        return photo.id
+
+
+async def get_bike_photo_by_source(source_unique_id: str, session=None):
+    """The first photo made from this Telegram file, as a BikePhotoSnapshot, or None."""
+    q = select(*BikePhoto.__table__.c).where(BikePhoto.source_unique_id == source_unique_id).order_by(BikePhoto.id).limit(1)
+    async with session_scope(session) as s:
+        row = (await s.execute(q)).first()
+        return BikePhotoSnapshot(*row) if row else None
+
+
+async def iter_bike_photo_hashes(batch_size: int = 5000):
+    """Yield (id, bike_id, partner_id, phash) of every photo, in id order."""
+    q = select(BikePhoto.id, BikePhoto.bike_id, BikePhoto.partner_id, BikePhoto.phash).order_by(BikePhoto.id).execution_options(yield_per=batch_size)
+    async with get_read_session() as s:
+        result = await s.stream(q)
+        async for row in result:
+            yield row
@@ -1,55 +1,133 @@
+import asyncio
+import csv
+import datetime
+import os
+import tempfile
 from aiogram import Router
-from aiogram.types import Message
-from config import ADMIN_IDS
-from database.queries import list_rentals, pick_available_bike, update_user_profile, partner_earnings
-from database.queries import pick_main_bike, get_rental_by_id, assign_bike_to_rental, set_main_bike, get_user_by_db_id, record_payout, partner_balance
-from database.queries import admin_stats
+from aiogram.types import Message, CallbackQuery, FSInputFile
+from handlers.dispatch import command
+from keyboards.admin_menu import RentalsPage, rentals_nav
+from config import ADMIN_IDS, PAYOUT_MIN_AMOUNT
+from utils.logger import logger
+from database.queries import list_rentals_page, iter_rentals, update_user_profile, partner_earnings
+from database.queries import get_rental_by_id, assign_bike_to_rental, set_main_bike, get_user_by_db_id, record_payout, partner_balance
+from database.queries import run_partner_payouts
+from services.bike_service import bike_index
+from database.queries import user_cache, iter_user_telegram_ids
+from services.notifier import notifier
+from services.stats import stats_snapshot
 
-router = Router()
+# callback queries (inline buttons); text commands go through handlers.dispatch
+router = Router(name='admin')
+
+RENTALS_PAGE_SIZE = 20
+
+# running /broadcast and /payout_run notification tasks (kept referenced until they finish)
+_broadcasts = set()
 
 
 def is_admin(msg: Message) -> bool:
     return bool(msg.from_user and msg.from_user.id in ADMIN_IDS)
 
 
-@router.message(lambda msg: msg.text and msg.text.startswith('/admin'))
+@command('admin')
 async def admin_panel(message: Message):
     if not is_admin(message):
         return
-    await message.answer("Admin panel: /list_rentals, /assign_bike <rental_id>, /partner_earnings <partner_id>, /stats")
+    await message.answer("Admin panel: /list_rentals [active|closed] [YYYY-MM-DD] [export], /assign_bike <rental_id>, /partner_earnings <partner_id>, /payout_run [min_summa], /stats, /broadcast <matn>")
 
 
-@router.message(lambda msg: msg.text and msg.text.startswith('/stats'))
+@command('stats')
 async def cmd_stats(message: Message):
     if not is_admin(message):
         await message.answer("Bu buyruq faqat adminlar uchun.")
         return
     try:
-        st = await admin_stats()
+        st = await stats_snapshot.get()
         await message.answer(
-            "📊 Bot statistikasi:\n"
+            f"📊 Bot statistikasi ({int(stats_snapshot.age())} s oldingi holat):\n"
             f"👥 Jami foydalanuvchilar: {st['users']}\n"
             f"🤝 Hamkorlar: {st['partners']}\n"
-            f"🚲 Ijarachilar: {st['renters']}"
+            f"🚲 Ijarachilar: {st['renters']}\n"
+            f"🗂 Foydalanuvchi keshi: {user_cache.hits} hit / {user_cache.misses} miss\n"
+            "✉️ Xabarlar: {sent} yuborildi, {failed} xato, {queued} navbatda, {dropped} tashlab yuborildi".format(**notifier.stats())
         )
     except Exception as e:
         await message.answer("Statistikani olishda xatolik yuz berdi.")
 
 
-@router.message(lambda msg: msg.text and msg.text.startswith('/list_rentals'))
-async def cmd_list_rentals(message: Message):
+def _parse_rental_filters(args: str):
+    """'active 2024-05-01 export' -> ('active', date(2024, 5, 1), True)"""
+    status, day, export = '', None, False
+    for token in args.split():
+        token = token.lower()
+        if token in ('active', 'closed'):
+            status = token
+        elif token == 'export':
+            export = True
+        else:
+            day = datetime.date.fromisoformat(token)
+    return status, day, export
+
+
+async def _rentals_page(status: str, day, session, after_id=None, before_id=None):
+    page = await list_rentals_page(after_id=after_id, before_id=before_id, status=status or None, day=day, limit=RENTALS_PAGE_SIZE, session=session)
+    rentals = page['rentals']
+    if not rentals:
+        return 'Ijaralar topilmadi.', None
+    lines = [f"{r.id}: user={r.user_id} bike={r.bike_id} start={r.start_at} end={r.end_at} fee={r.fee}" for r in rentals]
+    kb = rentals_nav(rentals[0].id, rentals[-1].id, page['has_newer'], page['has_older'], status=status, day=day.isoformat() if day else '')
+    return '\n'.join(lines), kb
+
+
+async def _export_rentals(message: Message, status: str, day):
+    """Stream matching rentals into a CSV file and send it as a document."""
+    fd, path = tempfile.mkstemp(suffix='.csv')
+    count = 0
+    try:
+        with os.fdopen(fd, 'w', newline='', encoding='utf-8') as fh:
+            writer = csv.writer(fh)
+            writer.writerow(['id', 'user_id', 'bike_id', 'start_at', 'end_at', 'fee'])
+            async for row in iter_rentals(status=status or None, day=day):
+                writer.writerow(row)
+                count += 1
+        await message.answer_document(FSInputFile(path, filename='rentals.csv'), caption=f'{count} ta ijara')
+    finally:
+        os.remove(path)
+
+
+@command('list_rentals')
+async def cmd_list_rentals(message: Message, session, command_args: str = ''):
     if not is_admin(message):
         return
-    rentals = await list_rentals()
-    if not rentals:
-        await message.answer('Aktiv ijaralar topilmadi.')
+    try:
+        status, day, export = _parse_rental_filters(command_args)
+    except ValueError:
+        await message.answer('Foydalanish: /list_rentals [active|closed] [YYYY-MM-DD] [export]')
+        return
+    if export:
+        await _export_rentals(message, status, day)
+        return
+    text, kb = await _rentals_page(status, day, session)
+    await session.commit()
+    await message.answer(text, reply_markup=kb)
+
+
+@router.callback_query(RentalsPage.filter())
+async def rentals_page_nav(callback: CallbackQuery, callback_data: RentalsPage, session):
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer()
         return
-    lines = [f"{r.id}: user={r.user_id} bike={r.bike_id} start={r.start_at} fee={r.fee}" for r in rentals]
-    await message.answer('\n'.join(lines))
+    day = datetime.date.fromisoformat(callback_data.day) if callback_data.day else None
+    cursor = {'after_id' if callback_data.direction == 'older' else 'before_id': callback_data.cursor}
+    text, kb = await _rentals_page(callback_data.status, day, session, **cursor)
+    await session.commit()
+    await callback.message.edit_text(text, reply_markup=kb)
+    await callback.answer()
 
 
-@router.message(lambda msg: msg.text and msg.text.startswith('/assign_bike'))
-async def cmd_assign_bike(message: Message):
+@command('assign_bike')
+async def cmd_assign_bike(message: Message, session):
     if not is_admin(message):
         return
     parts = message.text.split()
@@ -63,28 +141,30 @@ async def cmd_assign_bike(message: Message):
         return
 
     # prefer main bike
-    bike = await pick_main_bike()
+    bike = bike_index.pick_main()
     if not bike:
         await message.answer('Bosh velosiped topilmadi')
         return
 
-    rental = await assign_bike_to_rental(rid, bike.id)
+    rental = await assign_bike_to_rental(rid, bike.id, session=session)
     if not rental:
+        if await get_rental_by_id(rid, session=session):
+            # the bike was taken in the meantime (e.g. by another instance)
+            bike_index.discard(bike.id)
+        await session.commit()
         await message.answer('Tayinlashda xato: velosiped band yoki rental topilmadi')
         return
 
     # notify renter
-    renter = await get_user_by_db_id(rental.user_id)
-    try:
-        await message.bot.send_message(renter.telegram_id, f"Sizga velosiped ajratildi. ID: {bike.id}, kodi: {bike.code}")
-    except Exception:
-        pass
+    renter = await get_user_by_db_id(rental.user_id, session=session)
+    await session.commit()
+    notifier.notify(renter.telegram_id, f"Sizga velosiped ajratildi. ID: {bike.id}, kodi: {bike.code}")
 
     await message.answer(f"Assigned bike {bike.id} (code: {bike.code}) to rental {rid}")
 
 
-@router.message(lambda msg: msg.text and msg.text.startswith('/set_main'))
-async def cmd_set_main(message: Message):
+@command('set_main')
+async def cmd_set_main(message: Message, session):
     if not is_admin(message):
         return
     parts = message.text.split()
@@ -96,15 +176,16 @@ async def cmd_set_main(message: Message):
     except Exception:
         await message.answer('Noto`g`ri bike id')
         return
-    b = await set_main_bike(bid)
+    b = await set_main_bike(bid, session=session)
+    await session.commit()
     if not b:
         await message.answer('Velosiped topilmadi')
         return
     await message.answer(f'Bike {b.id} belgilandi bosh velosipedga')
 
 
-@router.message(lambda msg: msg.text and msg.text.startswith('/pay_partner'))
-async def cmd_pay_partner(message: Message):
+@command('pay_partner')
+async def cmd_pay_partner(message: Message, session):
     if not is_admin(message):
         return
     parts = message.text.split()
@@ -118,24 +199,63 @@ async def cmd_pay_partner(message: Message):
         await message.answer('Noto`g`ri argumentlar. partner_id butun son, amount raqam bo`lishi kerak.')
         return
 
-    payout = await record_payout(pid, amount)
+    payout = await record_payout(pid, amount, session=session)
     if not payout:
         await message.answer('Payout yozilmadi, xatolik yuz berdi.')
         return
+    await session.commit()
 
     # notify partner
-    try:
-        await message.bot.send_message(pid, f"Sizga to'lov chiqarildi: {amount}. Admin tomonidan.")
-    except Exception:
-        pass
+    notifier.notify(pid, f"Sizga to'lov chiqarildi: {amount}. Admin tomonidan.")
 
     # show updated balance
-    bal = await partner_balance(pid)
+    bal = await partner_balance(pid, session=session)
+    await session.commit()
     await message.answer(f"Payout yozildi. Partner balance: earned={bal['earned']} paid={bal['paid']} balance={bal['balance']}")
 
 
-@router.message(lambda msg: msg.text and msg.text.startswith('/partner_earnings'))
-async def cmd_partner_earnings(message: Message):
+def _background(coro):
+    task = asyncio.create_task(coro)
+    _broadcasts.add(task)
+    task.add_done_callback(_broadcasts.discard)
+
+
+@command('payout_run')
+async def cmd_payout_run(message: Message, session, command_args: str = ''):
+    """Pay every partner's outstanding balance at once and send the admin a CSV summary."""
+    if not is_admin(message):
+        return
+    try:
+        min_amount = float(command_args) if command_args.strip() else PAYOUT_MIN_AMOUNT
+    except ValueError:
+        await message.answer('Foydalanish: /payout_run [min_summa]')
+        return
+    lines = await run_partner_payouts(min_amount, session=session)
+    await session.commit()
+    if not lines:
+        await message.answer("To'lanadigan hamkor yo'q.")
+        return
+    total = sum(l['amount'] for l in lines)
+    logger.info("Payout run by %s: %d partners, %.2f total", message.from_user.id, len(lines), total)
+    _background(notifier.send_bulk(
+        (l['partner_id'], f"Sizga to'lov chiqarildi: {l['amount']:.2f}. Admin tomonidan.") for l in lines
+    ))
+
+    fd, path = tempfile.mkstemp(suffix='.csv')
+    try:
+        with os.fdopen(fd, 'w', newline='', encoding='utf-8') as fh:
+            writer = csv.writer(fh)
+            writer.writerow(['partner_id', 'earned', 'paid_before', 'amount'])
+            for l in lines:
+                writer.writerow([l['partner_id'], f"{l['earned']:.2f}", f"{l['paid']:.2f}", f"{l['amount']:.2f}"])
+        await message.answer_document(FSInputFile(path, filename=f'payouts-{datetime.date.today()}.csv'),
+                                      caption=f"{len(lines)} ta hamkorga jami {total:.2f} to'landi")
+    finally:
+        os.remove(path)
+
+
+@command('partner_earnings')
+async def cmd_partner_earnings(message: Message, session):
     if not is_admin(message):
         return
     parts = message.text.split()
@@ -147,5 +267,28 @@ async def cmd_partner_earnings(message: Message):
     except Exception:
         await message.answer('Noto`g`ri partner id')
         return
-    res = await partner_earnings(pid)
+    res = await partner_earnings(pid, session=session)
+    await session.commit()
     await message.answer(f"Partner jami daromadi: {res['total']}")
+
+
+async def _broadcast(admin_id: int, text: str):
+    try:
+        count = await notifier.broadcast(iter_user_telegram_ids(), text)
+        notifier.notify(admin_id, f"Xabar {count} ta foydalanuvchiga navbatga qo'yildi.")
+    except Exception:
+        logger.exception("Broadcast failed")
+        notifier.notify(admin_id, "Xabarni tarqatishda xatolik yuz berdi.")
+
+
+@command('broadcast')
+async def cmd_broadcast(message: Message, command_args: str = ''):
+    if not is_admin(message):
+        return
+    text = command_args.strip()
+    if not text:
+        await message.answer('Foydalanish: /broadcast <matn>')
+        return
+    # queued at the notifier's send rate in the background; the handler returns right away
+    _background(_broadcast(message.from_user.id, text))
+    await message.answer('Xabar tarqatish boshlandi.')
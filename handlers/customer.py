@@ -1,15 +1,19 @@
-from aiogram import Router
-from aiogram.types import Message, ContentType, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
-from database.queries import get_or_create_user, create_rental, pick_main_bike, update_user_profile
-from database.queries import set_referrer, count_referrals
-
-router = Router()
-
-# tiny per-user in-memory state. For production use FSM storage.
-_state = {}
-
-
-@router.message(lambda msg: msg.text and 'ijaraga' in msg.text.lower())
+from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
+from handlers.dispatch import command, keyword, step
+from utils.state_storage import conversations
+from database.queries import get_or_create_user, update_user_profile
+from database.queries import set_referrer, count_referrals, referral_tree_counts
+from database.queries import get_active_rental, set_rental_end
+from services.billing import compute_fee
+from services.referrals import leaderboard
+from config import REFERRAL_TREE_DEPTH
+from services.bike_service import bike_index, rent_bike
+from services.location import nearest_bikes
+
+FLOW = 'customer'
+
+
+@keyword('ijaraga')
 async def start_rental(message: Message):
     uid = message.from_user.id
     # detect referral code in message text (formats: 'ref:CODE' or '/start?ref=CODE')
@@ -26,97 +30,146 @@ async def start_rental(message: Message):
         except Exception:
             ref_code = ref_code
 
-    _state[uid] = {'step': 'name', 'ref_code': ref_code}
+    await conversations.set(uid, {'flow': FLOW, 'step': 'name', 'ref_code': ref_code})
     await message.answer('Iltimos, ismingiz va familiyangizni yuboring:')
 
 
-@router.message()
-async def customer_steps(message: Message):
-    uid = message.from_user.id
-    state = _state.get(uid)
-    if not state:
+@step(FLOW, 'name')
+async def name_step(message: Message, flow_state: dict):
+    # Expect full name: Familya Ism Otasining_ismi
+    text = (message.text or '').strip()
+    parts = text.split()
+    if len(parts) < 2:
+        await message.answer('Iltimos, to\'liq ismingizni kiriting (masalan: Abrorov Abror Abrorovich)')
         return
-    step = state.get('step')
-    if step == 'name':
-        # Expect full name: Familya Ism Otasining_ismi
-        text = (message.text or '').strip()
-        parts = text.split()
-        if len(parts) < 2:
-            await message.answer('Iltimos, to\'liq ismingizni kiriting (masalan: Abrorov Abror Abrorovich)')
-            return
-        state['first_name'] = parts[0]
-        state['last_name'] = ' '.join(parts[1:])  # combine rest as last name
-        state['step'] = 'phone'
-        await message.answer('Telefon raqamingizni yuboring (+998 formatida):')
+    flow_state['first_name'] = parts[0]
+    flow_state['last_name'] = ' '.join(parts[1:])  # combine rest as last name
+    flow_state['step'] = 'phone'
+    await conversations.set(message.from_user.id, flow_state)
+    await message.answer('Telefon raqamingizni yuboring (+998 formatida):')
+
+
+@step(FLOW, 'phone')
+async def phone_step(message: Message, flow_state: dict):
+    phone = (message.text or '').strip()
+    # Basic validation for Uzbek numbers
+    if not (phone.startswith('+998') and len(phone.replace('+','').replace(' ','')) == 12 and phone.replace('+','').replace(' ','').isdigit()):
+        await message.answer('Iltimos, telefon raqamini +998 formatida kiriting')
         return
-
-    if step == 'phone':
-        phone = (message.text or '').strip()
-        # Basic validation for Uzbek numbers
-        if not (phone.startswith('+998') and len(phone.replace('+','').replace(' ','')) == 12 and phone.replace('+','').replace(' ','').isdigit()):
-            await message.answer('Iltimos, telefon raqamini +998 formatida kiriting')
-            return
-        state['phone'] = phone
-        state['step'] = 'city'
-        await message.answer("Qaysi shahardan ekanligingiz? Iltimos shahar nomini yuboring (masalan: Tashkent yoki Namangan)")
+    flow_state['phone'] = phone
+    flow_state['step'] = 'city'
+    await conversations.set(message.from_user.id, flow_state)
+    await message.answer("Qaysi shahardan ekanligingiz? Iltimos shahar nomini yuboring (masalan: Tashkent yoki Namangan)")
+
+
+@step(FLOW, 'city')
+async def city_step(message: Message, flow_state: dict):
+    flow_state['city'] = (message.text or '').strip()
+    # ask for location via Telegram location button
+    kb = ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text="Share location", request_location=True)]], resize_keyboard=True, one_time_keyboard=True)
+    flow_state['step'] = 'location'
+    await conversations.set(message.from_user.id, flow_state)
+    await message.answer('Iltimos, joylashuvingizni ulashing ("Share location" tugmasini bosing):', reply_markup=kb)
+
+
+@step(FLOW, 'location')
+async def location_step(message: Message, flow_state: dict):
+    if not message.location:
+        await message.answer('Iltimos, ko‘rsatmalarga rioya qiling.')
         return
+    flow_state['lat'] = message.location.latitude
+    flow_state['lon'] = message.location.longitude
+    nearby = await nearest_bikes(flow_state['lat'], flow_state['lon'])
+    # reserved in this order at the passport step, main bike as fallback
+    flow_state['nearby'] = [bike.id for _, bike in nearby]
+    flow_state['step'] = 'passport'
+    await conversations.set(message.from_user.id, flow_state)
+    if nearby:
+        lines = [f"🚲 {bike.name} ({bike.code or bike.id}) - {dist:.1f} km" for dist, bike in nearby]
+        await message.answer("Yaqin atrofdagi velosipedlar:\n" + '\n'.join(lines))
+    # remove keyboard after getting location
+    await message.answer("Passport yoki shaxsiy ID raqamini yuboring:", reply_markup=ReplyKeyboardRemove())
+
+
+@step(FLOW, 'passport')
+async def passport_step(message: Message, flow_state: dict, session):
+    uid = message.from_user.id
+    flow_state['passport_id'] = (message.text or '').strip()
+    # finalize profile
+    user = await get_or_create_user(uid, session=session)
+    await update_user_profile(uid, first_name=flow_state.get('first_name'), last_name=flow_state.get('last_name'), phone=flow_state.get('phone'), lat=flow_state.get('lat'), lon=flow_state.get('lon'), passport_id=flow_state.get('passport_id'), session=session)
 
-    if step == 'city':
-        state['city'] = (message.text or '').strip()
-        # ask for location via Telegram location button
-        kb = ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text="Share location", request_location=True)]], resize_keyboard=True, one_time_keyboard=True)
-        state['step'] = 'location'
-        await message.answer('Iltimos, joylashuvingizni ulashing ("Share location" tugmasini bosing):', reply_markup=kb)
+    # if there was a referral code provided earlier, set referrer
+    if flow_state.get('ref_code'):
+        try:
+            await set_referrer(uid, flow_state.get('ref_code'), session=session)
+        except Exception:
+            pass
+
+    # nearest bike that is still free, otherwise the main bike
+    nearby = flow_state.get('nearby') or []
+    if not any(i in bike_index for i in nearby) and bike_index.pick_main() is None:
+        await session.commit()
+        await message.answer('Kechirasiz, hozircha bosh velosiped mavjud emas, admin bilan bog\'laning.')
+        await conversations.delete(uid)
         return
 
-    if step == 'location' and message.location:
-        state['lat'] = message.location.latitude
-        state['lon'] = message.location.longitude
-        state['step'] = 'passport'
-        # remove keyboard after getting location
-        await message.answer("Passport yoki shaxsiy ID raqamini yuboring:", reply_markup=ReplyKeyboardRemove())
+    rental, bike = await rent_bike(user.id, prefer=nearby, session=session)
+    if not rental:
+        await session.commit()
+        await message.answer('Velosipedni band qilishda xatolik yuz berdi.')
+        await conversations.delete(uid)
+        return
+    # the whole step is one transaction; commit before talking to Telegram
+    await session.commit()
+
+    await message.answer(f"Siz muvaffaqiyatli ijaraga oldingiz. Velosiped ID: {bike.id}, kodi: {bike.code}")
+    # show referral link for this user
+    try:
+        me = await message.bot.me()
+        ref_link = f"https://t.me/{me.username}?start=ref%3D{user.referral_code}"
+        cnt = await count_referrals(user.telegram_id, session=session)
+        await session.commit()
+        await message.answer(f"Sizning referal ligangiz: {ref_link}\nSiz tomonidan qo'shilganlar soni: {cnt}")
+    except Exception:
+        pass
+    await conversations.delete(uid)
+
+
+@command('end_rental')
+async def end_rental(message: Message, session):
+    user = await get_or_create_user(message.from_user.id, session=session)
+    rental = await get_active_rental(user.id, session=session)
+    if rental is None:
+        await session.commit()
+        await message.answer("Sizda faol ijara yo'q.")
+        return
+    closed = await set_rental_end(rental.id, fee_for=compute_fee, session=session)
+    if closed is None:
+        await session.commit()
+        await message.answer('Ijara allaqachon yopilgan.')
         return
+    await session.commit()
+    minutes = int((closed.end_at - closed.start_at).total_seconds() // 60)
+    await message.answer(f"Ijara yakunlandi. Davomiyligi: {minutes // 60} soat {minutes % 60} daqiqa, to'lov: {closed.fee}")
 
-    if step == 'passport':
-        state['passport_id'] = (message.text or '').strip()
-        # finalize profile
-        user = await get_or_create_user(uid)
-        await update_user_profile(uid, first_name=state.get('first_name'), last_name=state.get('last_name'), phone=state.get('phone'), lat=state.get('lat'), lon=state.get('lon'), passport_id=state.get('passport_id'))
-
-        # if there was a referral code provided earlier, set referrer
-        if state.get('ref_code'):
-            try:
-                await set_referrer(uid, state.get('ref_code'))
-            except Exception:
-                pass
-
-        # assign main bike to this user automatically
-        bike = await pick_main_bike()
-        if not bike:
-            await message.answer('Kechirasiz, hozircha bosh velosiped mavjud emas, admin bilan bog\'laning.')
-            _state.pop(uid, None)
-            return
-
-        rental = await create_rental(user.id, bike.id)
-        if not rental:
-            await message.answer('Velosipedni band qilishda xatolik yuz berdi.')
-            _state.pop(uid, None)
-            return
-
-        await message.answer(f"Siz muvaffaqiyatli ijaraga oldingiz. Velosiped ID: {bike.id}, kodi: {bike.code}")
-        # show referral link for this user
-        try:
-            # ensure user has a referral code
-            if not user.referral_code:
-                # user was created earlier with a code, but ensure
-                pass
-            ref_link = f"https://t.me/{message.bot.username}?start=ref%3D{user.referral_code}"
-            cnt = await count_referrals(user.telegram_id)
-            await message.answer(f"Sizning referal ligangiz: {ref_link}\nSiz tomonidan qo'shilganlar soni: {cnt}")
-        except Exception:
-            pass
-        _state.pop(uid, None)
+
+@command('my_referrals')
+async def my_referrals(message: Message, session):
+    levels = await referral_tree_counts(message.from_user.id, depth=REFERRAL_TREE_DEPTH, session=session)
+    await session.commit()
+    if not levels:
+        await message.answer("Siz hali hech kimni taklif qilmagansiz.")
         return
+    lines = [f"{level}-daraja: {count} kishi" for level, count in sorted(levels.items())]
+    await message.answer("Sizning referallaringiz:\n" + '\n'.join(lines) + f"\nJami: {sum(levels.values())}")
 
-    # fallback
-    await message.answer('Iltimos, ko‘rsatmalarga rioya qiling.')
+
+@command('top')
+async def top_referrers(message: Message):
+    rows = await leaderboard.get()
+    if not rows:
+        await message.answer("Reyting hali bo'sh.")
+        return
+    lines = [f"{i}. {r.first_name or r.telegram_id}: {r.referral_count}" for i, r in enumerate(rows, 1)]
+    await message.answer("🏆 Eng ko'p taklif qilganlar:\n" + '\n'.join(lines))
@@ -0,0 +1,105 @@
+"""Single message entry point for all handlers.
+
+A message is routed by dictionary lookups instead of a chain of filters:
+the command is parsed once and looked up in the command table, menu buttons
+are matched by keyword, and anything else goes to the handler registered for
+the sender's current wizard (flow, step).
+"""
+import inspect
+from aiogram import Router
+from aiogram.types import Message
+from services.metrics import handled_by
+from utils.state_storage import conversations
+
+
+def parse_command(text: str):
+    """'/cmd@bot arg1 arg2' -> ('cmd', 'arg1 arg2'); None for non-commands."""
+    if not text or text[0] != '/':
+        return None
+    head, _, args = text.partition(' ')
+    return head[1:].split('@', 1)[0].lower(), args.strip()
+
+
+class _Handler:
+    """Callback plus the extra keyword arguments it accepts, resolved once at registration.
+
+    label names the handler in metrics: '/cmd', 'flow.step' or '«word»'.
+    """
+
+    __slots__ = ('callback', 'params', 'varkw', 'label')
+
+    def __init__(self, callback, label: str):
+        self.label = label
+        params = list(inspect.signature(callback).parameters.values())[1:]
+        self.callback = callback
+        self.varkw = any(p.kind is p.VAR_KEYWORD for p in params)
+        self.params = tuple(p.name for p in params if p.kind is not p.VAR_KEYWORD)
+
+    def __call__(self, message: Message, data: dict):
+        handled_by(self.label)
+        if self.varkw:
+            return self.callback(message, **data)
+        return self.callback(message, **{k: data[k] for k in self.params if k in data})
+
+
+class MessageDispatch:
+    def __init__(self, store=conversations):
+        self.store = store
+        self.commands = {}
+        self.steps = {}
+        self.keywords = []
+        self.router = Router(name='dispatch')
+        self.router.message()(self.dispatch)
+
+    def command(self, *names):
+        def decorator(callback):
+            handler = _Handler(callback, f'/{names[0].lower()}')
+            for name in names:
+                self.commands[name.lower()] = handler
+            return callback
+        return decorator
+
+    def step(self, flow: str, name: str):
+        def decorator(callback):
+            self.steps[(flow, name)] = _Handler(callback, f'{flow}.{name}')
+            return callback
+        return decorator
+
+    def keyword(self, word: str):
+        """Start a flow when the text contains word (menu buttons)."""
+        def decorator(callback):
+            self.keywords.append((word.lower(), _Handler(callback, f'«{word.lower()}»')))
+            return callback
+        return decorator
+
+    async def dispatch(self, message: Message, **data):
+        text = message.text
+        parsed = parse_command(text)
+        if parsed is not None:
+            handler = self.commands.get(parsed[0])
+            if handler is not None:
+                data['command_args'] = parsed[1]
+                return await handler(message, data)
+
+        if text:
+            lowered = text.lower()
+            for word, handler in self.keywords:
+                if word in lowered:
+                    return await handler(message, data)
+
+        if message.from_user is None:
+            return None
+        state = await self.store.get(message.from_user.id)
+        if state:
+            handler = self.steps.get((state.get('flow'), state.get('step')))
+            if handler is not None:
+                data['flow_state'] = state
+                return await handler(message, data)
+        return None
+
+
+table = MessageDispatch()
+router = table.router
+command = table.command
+step = table.step
+keyword = table.keyword
@@ -1,5 +1,30 @@
-from aiogram import Router
+from aiogram.types import Message
+from handlers.dispatch import command
+from database.queries import get_or_create_user, get_last_closed_rental, list_rental_payments
+from services.payment_service import create_payment
 
-router = Router()
+STATUS_TEXT = {
+    'captured': "To'lov qabul qilindi: {amount} {currency}",
+    'pending': "To'lov jarayonda, natijasini xabar qilamiz.",
+    'failed': "To'lov amalga oshmadi ({error}). /pay orqali qayta urinib ko'ring.",
+    'refunded': "To'lov qaytarilgan: {amount} {currency}",
+}
 
-# Payment integration stubs
+
+@command('pay')
+async def cmd_pay(message: Message, session):
+    user = await get_or_create_user(message.from_user.id, session=session)
+    rental = await get_last_closed_rental(user.id, session=session)
+    if rental is None or not rental.fee:
+        await message.answer("To'lanadigan ijara yo'q.")
+        return
+    attempts = await list_rental_payments(rental.id, session=session)
+    # nothing may stay open while the provider is called
+    await session.commit()
+    open_or_paid = [p for p in attempts if p.status != 'failed']
+    if open_or_paid:
+        payment = open_or_paid[-1]
+    else:
+        # one key per attempt: a double tap reuses it, a retry after a decline gets a new one
+        payment = await create_payment(rental.fee, user.id, idempotency_key=f'rental:{rental.id}:{len(attempts)}', rental_id=rental.id)
+    await message.answer(STATUS_TEXT[payment.status].format(amount=payment.amount, currency=payment.currency, error=payment.error or 'xatolik'))
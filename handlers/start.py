@@ -1,28 +1,27 @@
-from aiogram import Router
 from aiogram.types import Message
-from aiogram.filters import Command
+from handlers.dispatch import command
 from keyboards.main_menu import main_menu
 from keyboards.admin_menu import admin_menu
 from keyboards.partner_menu import partner_menu
 from config import ADMIN_IDS
 from database.queries import get_or_create_user, set_referrer
 
-router = Router()
 
-
-@router.message(Command('start'))
-async def cmd_start(message: Message):
+@command('start')
+async def cmd_start(message: Message, session):
     uid = message.from_user.id
     # Handle referral code in start params
+    ref_code = None
     if message.text and '?start=ref' in message.text:
-        try:
-            ref_code = message.text.split('ref%3D')[1].strip()
-            await set_referrer(uid, ref_code)
-        except Exception:
-            pass  # ignore ref errors
-    
-    # Create or get user
-    user = await get_or_create_user(uid)
+        _, found, code = message.text.partition('ref%3D')
+        ref_code = code.strip() if found and code.strip() else None
+
+    # Create or get user; a new user gets the referrer in the same statement
+    user = await get_or_create_user(uid, ref_code=ref_code, session=session)
+    if ref_code and user.referrer_id is None:
+        user = await set_referrer(uid, ref_code, session=session) or user
+    # release the write lock before talking to Telegram
+    await session.commit()
 
     if message.from_user and message.from_user.id in ADMIN_IDS:
         await message.answer("Admin panelga xush kelibsiz.", reply_markup=admin_menu)
@@ -1,7 +1,25 @@
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
+from aiogram.filters.callback_data import CallbackData
+from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
 
 admin_menu = ReplyKeyboardMarkup(keyboard=[
     [KeyboardButton(text='/list_rentals')],
     [KeyboardButton(text='/assign_bike')],
     [KeyboardButton(text='/partner_earnings')]
 ], resize_keyboard=True)
+
+
+class RentalsPage(CallbackData, prefix='rl'):
+    # 'older' pages go to ids < cursor, 'newer' pages to ids > cursor
+    direction: str
+    cursor: int
+    status: str = ''
+    day: str = ''
+
+
+def rentals_nav(first_id: int, last_id: int, has_newer: bool, has_older: bool, status: str = '', day: str = ''):
+    buttons = []
+    if has_newer:
+        buttons.append(InlineKeyboardButton(text='⬅️ Oldingi', callback_data=RentalsPage(direction='newer', cursor=first_id, status=status, day=day).pack()))
+    if has_older:
+        buttons.append(InlineKeyboardButton(text='Keyingi ➡️', callback_data=RentalsPage(direction='older', cursor=last_id, status=status, day=day).pack()))
+    return InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
@@ -1,4 +1,118 @@
-from database.queries import list_available_bikes
+# In-process view of which bikes are free, so picking a bike does not query the database.
+#
+# The bikes table stays the source of truth: the index is loaded at startup, follows
+# committed bike changes via database.queries.bike_listeners and is reloaded every
+# BIKE_INDEX_REFRESH seconds to pick up other instances' writes. Reservations still go
+# through create_rental / assign_bike_to_rental, which re-check availability in the
+# database; a bike the database refuses is dropped from the index and the next one tried.
+import asyncio
+import heapq
+from config import BIKE_INDEX_REFRESH
+from database.queries import bike_listeners, create_rental, iter_bikes
+from utils.logger import logger
+
+
+class BikeAvailability:
+    def __init__(self):
+        self._free = {}   # bike_id -> BikeSnapshot of every available bike
+        self._heap = []   # ids of free bikes, lowest first; may hold stale ids (lazy deletion)
+        self.main_id = None
+
+    def __len__(self):
+        return len(self._free)
+
+    def __contains__(self, bike_id):
+        return bike_id in self._free
+
+    def clear(self):
+        self._free.clear()
+        self._heap.clear()
+        self.main_id = None
+
+    def on_bike_change(self, bike):
+        """database.queries.bike_listeners hook."""
+        if bike.is_main:
+            self.main_id = bike.id
+        elif self.main_id == bike.id:
+            self.main_id = None
+        if bike.available:
+            if bike.id not in self._free:
+                heapq.heappush(self._heap, bike.id)
+            self._free[bike.id] = bike
+        else:
+            self.discard(bike.id)
+
+    def discard(self, bike_id: int):
+        """Forget a bike the database says is taken."""
+        self._free.pop(bike_id, None)
+        # ids left in the heap are skipped when they surface; rebuild once mostly stale
+        if len(self._heap) > 2 * len(self._free) + 64:
+            self._heap = sorted(self._free)
+
+    def get(self, bike_id: int):
+        return self._free.get(bike_id)
+
+    def pick(self):
+        """Lowest-id free bike, or None."""
+        heap = self._heap
+        while heap and heap[0] not in self._free:
+            heapq.heappop(heap)
+        return self._free[heap[0]] if heap else None
+
+    def pick_main(self):
+        """The main bike if it is free, else None."""
+        return self._free.get(self.main_id)
+
+    def available(self):
+        return [self._free[i] for i in sorted(self._free)]
+
+    async def load(self):
+        """Rebuild from the bikes table."""
+        free, main_id = {}, None
+        async for bike in iter_bikes():
+            if bike.is_main:
+                main_id = bike.id
+            if bike.available:
+                free[bike.id] = bike
+        self._free, self._heap, self.main_id = free, sorted(free), main_id
+        return len(free)
+
+    async def run_refresher(self, interval: float = BIKE_INDEX_REFRESH):
+        if interval <= 0:
+            return
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.load()
+            except Exception:
+                logger.exception("Bike availability reload failed")
+
+
+bike_index = BikeAvailability()
+bike_listeners.append(bike_index.on_bike_change)
+
 
 async def get_available_bikes():
-    return await list_available_bikes()
+    return bike_index.available()
+
+
+async def pick_bike():
+    return bike_index.pick()
+
+
+async def pick_main_bike():
+    return bike_index.pick_main()
+
+
+async def rent_bike(user_id: int, prefer: list = (), session=None):
+    """Rent the first free bike of prefer, else the main bike; returns (rental, bike) or (None, None)."""
+    candidates = [bike_index.get(i) for i in prefer]
+    candidates.append(bike_index.pick_main())
+    for bike in candidates:
+        if bike is None:
+            continue
+        rental = await create_rental(user_id, bike.id, session=session)
+        if rental:
+            return rental, bike
+        bike_index.discard(bike.id)
+    return None, None
@@ -0,0 +1,37 @@
+# Rental pricing: the fee follows from start_at / end_at and the bike's hourly price.
+#
+# Billed minutes are rounded up to BILLING_ROUND_MINUTES with a floor of BILLING_MIN_MINUTES;
+# with RENT_DAILY_CAP set, no started 24 hours costs more than the cap. Money is computed in
+# Decimal and rounded half-up to FEE_DECIMALS places so repeated closes always agree.
+import datetime
+import math
+from decimal import Decimal, ROUND_HALF_UP
+from config import BILLING_ROUND_MINUTES, BILLING_MIN_MINUTES, RENT_DAILY_CAP, FEE_DECIMALS, RENT_PRICE_PER_HOUR
+
+DAY_MINUTES = 24 * 60
+
+
+def billed_minutes(start_at: datetime.datetime, end_at: datetime.datetime,
+                   round_to: int = BILLING_ROUND_MINUTES, minimum: int = BILLING_MIN_MINUTES) -> int:
+    seconds = max(0.0, (end_at - start_at).total_seconds())
+    minutes = math.ceil(seconds / 60)
+    if round_to > 1:
+        minutes = -(-minutes // round_to) * round_to
+    return max(minutes, minimum)
+
+
+def compute_fee(start_at: datetime.datetime, end_at: datetime.datetime, price_per_hour: float = None,
+                daily_cap: float = RENT_DAILY_CAP) -> float:
+    """Fee for a rental from start_at to end_at.
+
+    price_per_hour None (a bike without a price) falls back to RENT_PRICE_PER_HOUR; 0 is free.
+    """
+    price = Decimal(str(RENT_PRICE_PER_HOUR if price_per_hour is None else price_per_hour))
+    minutes = billed_minutes(start_at, end_at)
+    if daily_cap > 0:
+        cap = Decimal(str(daily_cap))
+        days, rest = divmod(minutes, DAY_MINUTES)
+        fee = days * min(cap, price * 24) + min(cap, price * rest / 60)
+    else:
+        fee = price * minutes / 60
+    return float(fee.quantize(Decimal(1).scaleb(-FEE_DECIMALS), rounding=ROUND_HALF_UP))
@@ -0,0 +1,42 @@
+# Partner ledger reconciliation: checks running totals against rentals and payouts
+import argparse
+import asyncio
+from config import LEDGER_RECONCILE_INTERVAL, LEDGER_RECONCILE_FIX
+from database.queries import reconcile_partner_ledger
+from utils.logger import logger
+
+
+async def reconcile_once(fix: bool = LEDGER_RECONCILE_FIX):
+    mismatches = await reconcile_partner_ledger(fix=fix)
+    for m in mismatches:
+        logger.warning(
+            "Ledger mismatch for partner %s: earned %s (ledger %s), paid %s (ledger %s)%s",
+            m['partner_id'], m['earned'], m['ledger_earned'], m['paid'], m['ledger_paid'], ' - fixed' if fix else '',
+        )
+    return mismatches
+
+
+async def run_reconciler(interval: float = LEDGER_RECONCILE_INTERVAL):
+    """Reconcile right away (backfills a fresh ledger), then every interval seconds."""
+    if interval <= 0:
+        return
+    while True:
+        try:
+            await reconcile_once()
+        except Exception:
+            logger.exception("Ledger reconciliation failed")
+        await asyncio.sleep(interval)
+
+
+async def _main():
+    parser = argparse.ArgumentParser(description='Check the partner ledger against rentals and payouts')
+    parser.add_argument('--fix', action='store_true', help='overwrite mismatching ledger rows')
+    args = parser.parse_args()
+    from database.db import init_db
+    await init_db()
+    mismatches = await reconcile_once(fix=args.fix)
+    print(f"{len(mismatches)} mismatching partners{' fixed' if args.fix and mismatches else ''}")
+
+
+if __name__ == '__main__':
+    asyncio.run(_main())
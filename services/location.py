@@ -1,3 +1,137 @@
-# GPS location helpers (stub)
+# GPS location helpers: an in-memory grid index of available bikes for nearest-bike search.
+#
+# Bikes are bucketed into GEO_CELL_DEG x GEO_CELL_DEG cells (a fixed-precision geohash).
+# A query scans rings of cells around the user until the k-th best candidate is closer
+# than anything an outer ring could hold. The DB stays the source of truth: the index is
+# loaded at startup and follows committed bike changes via database.queries.bike_listeners,
+# so on several instances it can briefly offer a bike another instance just rented;
+# create_rental re-checks availability.
+import math
+from config import GEO_CELL_DEG, NEAREST_BIKES, NEAREST_MAX_KM
+from database.queries import bike_listeners, iter_available_bike_locations
+from services.bike_service import bike_index
+
+KM_PER_DEG_LAT = 110.57
+KM_PER_DEG_LON = 111.32
+
+
+def distance_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Equirectangular approximation; well within 1% at city distances."""
+    dx = (lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2)) * KM_PER_DEG_LON
+    dy = (lat2 - lat1) * KM_PER_DEG_LAT
+    return math.hypot(dx, dy)
+
+
+class GeoIndex:
+    def __init__(self, cell_deg: float = GEO_CELL_DEG):
+        self.cell_deg = cell_deg
+        self._cells = {}   # (ix, iy) -> {bike_id: (lat, lon)}
+        self._where = {}   # bike_id -> (ix, iy)
+
+    def _cell(self, lat: float, lon: float):
+        return int(math.floor(lon / self.cell_deg)), int(math.floor(lat / self.cell_deg))
+
+    def __len__(self):
+        return len(self._where)
+
+    def __contains__(self, bike_id):
+        return bike_id in self._where
+
+    def add(self, bike_id: int, lat: float, lon: float):
+        self.remove(bike_id)
+        cell = self._cell(lat, lon)
+        self._cells.setdefault(cell, {})[bike_id] = (lat, lon)
+        self._where[bike_id] = cell
+
+    def remove(self, bike_id: int):
+        cell = self._where.pop(bike_id, None)
+        if cell is None:
+            return
+        bucket = self._cells[cell]
+        del bucket[bike_id]
+        if not bucket:
+            del self._cells[cell]
+
+    def clear(self):
+        self._cells.clear()
+        self._where.clear()
+
+    def on_bike_change(self, bike):
+        """database.queries.bike_listeners hook: index available bikes that have coordinates."""
+        if bike.available and bike.lat is not None and bike.lon is not None:
+            self.add(bike.id, bike.lat, bike.lon)
+        else:
+            self.remove(bike.id)
+
+    def nearest(self, lat: float, lon: float, k: int = NEAREST_BIKES, max_km: float = NEAREST_MAX_KM):
+        """Up to k (distance_km, bike_id) pairs, closest first, within max_km."""
+        if not self._where or k <= 0:
+            return []
+        cx, cy = self._cell(lat, lon)
+        cos_lat = max(math.cos(math.radians(lat)), 0.01)
+        kx, ky = cos_lat * KM_PER_DEG_LON, KM_PER_DEG_LAT
+        # every point in ring r+1 is at least this many km per ring away from the query point
+        ring_km = self.cell_deg * min(kx, ky)
+        max_ring = int(max_km / ring_km) + 1
+        best = []  # (squared km, bike_id), at most k once full
+        limit = max_km * max_km
+        cells = self._cells
+        c = self.cell_deg
+        for r in range(max_ring + 1):
+            if r == 0:
+                ring = [(cx, cy)]
+            else:
+                ring = [(cx + dx, cy - r) for dx in range(-r, r + 1)] + [(cx + dx, cy + r) for dx in range(-r, r + 1)]
+                ring += [(cx - r, cy + dy) for dy in range(-r + 1, r)] + [(cx + r, cy + dy) for dy in range(-r + 1, r)]
+            for cell in ring:
+                bucket = cells.get(cell)
+                if not bucket:
+                    continue
+                if len(best) == k:
+                    # skip cells whose closest edge is farther than the current k-th best
+                    ix, iy = cell
+                    ex = max(ix * c - lon, 0.0, lon - (ix + 1) * c) * kx
+                    ey = max(iy * c - lat, 0.0, lat - (iy + 1) * c) * ky
+                    if ex * ex + ey * ey > limit:
+                        continue
+                for bike_id, (blat, blon) in bucket.items():
+                    dx = (blon - lon) * kx
+                    dy = (blat - lat) * ky
+                    d = dx * dx + dy * dy
+                    if d <= limit:
+                        best.append((d, bike_id))
+                if len(best) >= k:
+                    best.sort()
+                    del best[k:]
+                    limit = best[-1][0]
+            if len(best) == k:
+                reach = r * ring_km
+                if limit <= reach * reach:
+                    break
+        best.sort()
+        return [(math.sqrt(d), bike_id) for d, bike_id in best[:k]]
+
+    async def load(self):
+        """Rebuild from the bikes table."""
+        self.clear()
+        async for bike_id, lat, lon in iter_available_bike_locations():
+            self.add(bike_id, lat, lon)
+        return len(self)
+
+
+bike_locations = GeoIndex()
+bike_listeners.append(bike_locations.on_bike_change)
+
+
 async def process_location(latitude: float, longitude: float):
     return {'lat': latitude, 'lon': longitude}
+
+
+async def nearest_bikes(latitude: float, longitude: float, k: int = NEAREST_BIKES):
+    """k nearest available bikes as (distance_km, BikeSnapshot), closest first."""
+    found = []
+    for dist, bike_id in bike_locations.nearest(latitude, longitude, k):
+        bike = bike_index.get(bike_id)
+        if bike is not None:
+            found.append((dist, bike))
+    return found
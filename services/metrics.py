@@ -0,0 +1,339 @@
+# Metrics: update, SQL, connection pool and Bot API timings in Prometheus text format.
+#
+# Counters and fixed-bucket histograms live in a small in-process registry (no client library
+# needed) and are served on GET METRICS_PATH by a separate server on METRICS_PORT, off the
+# public webhook port. Updates are labelled with the dispatch-table handler that took them
+# (handlers/dispatch.py calls handled_by), SQL statements by verb and table, never by their
+# parameters. Statements slower than SLOW_QUERY_MS are logged with the handler that sent them.
+import bisect
+import contextvars
+import re
+import time
+import weakref
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import QueuePool
+from config import METRICS_HOST, METRICS_PORT, METRICS_PATH, SLOW_QUERY_MS, READY_PATH
+from utils.logger import logger
+
+# seconds
+UPDATE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SQL_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra: str = '') -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self._values = {}
+
+    def inc(self, *labels, amount: float = 1.0):
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0.0)
+
+    def samples(self):
+        for labels, value in sorted(self._values.items()):
+            yield f'{self.name}{_labels(self.labelnames, labels)} {value:g}'
+
+
+class Histogram:
+    """Cumulative-bucket histogram per label set; observe() is a bisect and two additions."""
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels=(), buckets=UPDATE_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # labels -> [per-bucket counts (last one is +Inf), sum]
+
+    def observe(self, value: float, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def count(self, *labels) -> int:
+        series = self._series.get(labels)
+        return sum(series[0]) if series else 0
+
+    def samples(self):
+        bounds = [f'{b:g}' for b in self.buckets] + ['+Inf']
+        for labels, (counts, total) in sorted(self._series.items()):
+            running = 0
+            for bound, n in zip(bounds, counts):
+                running += n
+                yield f'{self.name}_bucket{_labels(self.labelnames, labels, f"le={chr(34)}{bound}{chr(34)}")} {running}'
+            yield f'{self.name}_sum{_labels(self.labelnames, labels)} {total:g}'
+            yield f'{self.name}_count{_labels(self.labelnames, labels)} {running}'
+
+
+class Collected:
+    """A value read when scraped, e.g. a queue size or a counter kept by another module.
+
+    With labels, each label set gets its own reader through add().
+    """
+
+    def __init__(self, name: str, help: str, read=None, kind: str = 'gauge', labels=()):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labelnames = tuple(labels)
+        self._reads = {} if read is None else {(): read}
+
+    def add(self, read, *labels):
+        self._reads[labels] = read
+        return self
+
+    def samples(self):
+        for labels in sorted(self._reads):
+            try:
+                value = self._reads[labels]()
+            except Exception:
+                logger.exception("Reading metric %s failed", self.name)
+                continue
+            if value is not None:
+                yield f'{self.name}{_labels(self.labelnames, labels)} {value:g}'
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        """Add metric unless one of that name exists; returns the registered one."""
+        return self._metrics.setdefault(metric.name, metric)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+updates = registry.register(Histogram('velobike_update_seconds', 'Time to process an update, session commit included, by handler', ('handler',)))
+update_errors = registry.register(Counter('velobike_update_errors_total', 'Updates whose handler raised, by handler and exception', ('handler', 'error')))
+sql_seconds = registry.register(Histogram('velobike_sql_seconds', 'Statement execution time by verb and table', ('statement',), SQL_BUCKETS))
+sql_errors = registry.register(Counter('velobike_sql_errors_total', 'Statements that raised, by verb and table', ('statement',)))
+slow_queries = registry.register(Counter('velobike_sql_slow_total', 'Statements slower than SLOW_QUERY_MS, by verb and table', ('statement',)))
+pool_checkouts = registry.register(Counter('velobike_db_pool_checkouts_total', 'Connections handed out by the pool', ('pool',)))
+pool_waits = registry.register(Counter('velobike_db_pool_waits_total', 'Session transactions that had to wait for another one to return a connection', ('pool',)))
+pool_acquire = registry.register(Histogram('velobike_db_pool_acquire_seconds', 'Time from a session transaction starting to its connection having begun', ('pool',), SQL_BUCKETS))
+pool_checked_out = registry.register(Collected('velobike_db_pool_checked_out', 'Connections currently checked out', labels=('pool',)))
+pool_size = registry.register(Collected('velobike_db_pool_size', 'Connections the pool keeps open', labels=('pool',)))
+bot_api = registry.register(Histogram('velobike_bot_api_seconds', 'Bot API call latency by method', ('method',)))
+bot_api_errors = registry.register(Counter('velobike_bot_api_errors_total', 'Bot API calls that failed, by method and exception', ('method', 'error')))
+
+# {'handler': label} of the update being processed
+_update = contextvars.ContextVar('metrics_update', default=None)
+
+
+def handled_by(label: str):
+    """Name the handler of the current update (called by the dispatch table)."""
+    slot = _update.get()
+    if slot is not None:
+        slot['handler'] = label
+
+
+def current_handler():
+    slot = _update.get()
+    return slot.get('handler') if slot else None
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Outer update middleware: latency and errors per handler.
+
+    Register it before DbSessionMiddleware so the session commit is part of the time.
+    Updates no dispatch-table handler took are labelled with their type, e.g. '(callback_query)'.
+    """
+
+    async def __call__(self, handler, event, data):
+        slot = {}
+        token = _update.set(slot)
+        t0 = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            update_errors.inc(slot.get('handler') or f'({event.event_type})', type(e).__name__)
+            raise
+        finally:
+            updates.observe(time.perf_counter() - t0, slot.get('handler') or f'({event.event_type})')
+            _update.reset(token)
+
+
+class BotApiMetrics(BaseRequestMiddleware):
+    """Bot session middleware timing every outgoing API call, notifier sends included."""
+
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        t0 = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            bot_api_errors.inc(name, type(e).__name__)
+            raise
+        finally:
+            bot_api.observe(time.perf_counter() - t0, name)
+
+
+STATEMENT = re.compile(r'^\s*(\w+)\b.*?\b(?:FROM|INTO|UPDATE)\s+"?(\w+)', re.S | re.I)
+_statement_labels = {}
+
+
+def statement_label(sql: str) -> str:
+    """'SELECT users', 'UPDATE bikes', 'WITH users' (a recursive CTE over users), ..."""
+    label = _statement_labels.get(sql)
+    if label is not None:
+        return label
+    verb = sql.lstrip().split(None, 1)[0].upper()
+    if verb == 'UPDATE':
+        table = sql.split(None, 2)[1]
+    else:
+        m = STATEMENT.match(sql)
+        table = m.group(2) if m else '?'
+    label = f'{verb} {table.strip(chr(34))}'
+    # statements are cached SQL strings, but multi-row INSERTs vary with their row count
+    if len(_statement_labels) >= 2000:
+        _statement_labels.clear()
+    _statement_labels[sql] = label
+    return label
+
+
+# sync engine -> pool label, for the engines instrument_engine() was called on
+_pools = weakref.WeakKeyDictionary()
+
+
+def instrument_engine(engine, name: str = 'main', slow_ms: float = SLOW_QUERY_MS):
+    """Time statements and pool checkouts of an (async) engine under pool=name; safe to call more than once."""
+    sync = getattr(engine, 'sync_engine', engine)
+    if sync in _pools:
+        return
+    _pools[sync] = name
+
+    # the start time rides on the execution context, which lives for exactly one statement
+    @event.listens_for(sync, 'before_cursor_execute')
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        context._metrics_t0 = time.perf_counter()
+
+    @event.listens_for(sync, 'after_cursor_execute')
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - context._metrics_t0
+        label = statement_label(statement)
+        sql_seconds.observe(elapsed, label)
+        if slow_ms and elapsed * 1000 >= slow_ms:
+            slow_queries.inc(label)
+            logger.warning("Slow query: %.1f ms in %s: %s", elapsed * 1000, current_handler() or '-', ' '.join(statement.split())[:1000])
+
+    @event.listens_for(sync, 'handle_error')
+    def _error(ctx):
+        if ctx.statement:
+            sql_errors.inc(statement_label(ctx.statement))
+
+    # pool events on the engine also reach the pool engine.dispose() replaces it with
+    @event.listens_for(sync, 'checkout')
+    def _checkout(dbapi_conn, record, proxy):
+        pool_checkouts.inc(name)
+
+    @event.listens_for(sync, 'checkin')
+    def _checkin(dbapi_conn, record):
+        if record is not None:
+            record.info['metrics_checked_in'] = time.perf_counter()
+
+    pool_checked_out.add(lambda: sync.pool.checkedout() if isinstance(sync.pool, QueuePool) else None, name)
+    pool_size.add(lambda: sync.pool.size() if isinstance(sync.pool, QueuePool) else None, name)
+
+
+# The pool has no "connection requested" event. A session transaction is created right before
+# its connection is requested and after_begin fires once it has one, so the time in between is
+# the wait for the pool (plus BEGIN, which on SQLite is where the write lock is taken). The
+# transaction waited if the connection it got was returned only after it had asked.
+@event.listens_for(Session, 'after_transaction_create')
+def _session_transaction_start(session, transaction):
+    if transaction.parent is None and session.bind in _pools:
+        session.info['metrics_acquire'] = time.perf_counter()
+
+
+@event.listens_for(Session, 'after_begin')
+def _session_connection_begun(session, transaction, connection):
+    t0 = session.info.pop('metrics_acquire', None)
+    if t0 is None:
+        return
+    name = _pools[session.bind]
+    pool_acquire.observe(time.perf_counter() - t0, name)
+    if connection.connection.info.get('metrics_checked_in', 0.0) > t0:
+        pool_waits.inc(name)
+
+
+def instrument_bot(bot):
+    """Time the bot's outgoing API calls; safe to call more than once."""
+    if not any(isinstance(m, BotApiMetrics) for m in bot.session.middleware):
+        bot.session.middleware(BotApiMetrics())
+
+
+def _register_app_metrics():
+    from database.queries import user_cache
+    from services.notifier import notifier
+    from services.photos import photo_pipeline
+    from utils import logger as log
+
+    for name, help, read, kind in (
+        ('velobike_notify_queued', 'Notifications waiting to be sent', notifier.qsize, 'gauge'),
+        ('velobike_notify_sent_total', 'Notifications delivered', lambda: notifier.sent, 'counter'),
+        ('velobike_notify_failed_total', 'Notifications given up on', lambda: notifier.failed, 'counter'),
+        ('velobike_notify_dropped_total', 'Notifications dropped because the queue was full', lambda: notifier.dropped, 'counter'),
+        ('velobike_user_cache_hits_total', 'User cache hits', lambda: user_cache.hits, 'counter'),
+        ('velobike_user_cache_misses_total', 'User cache misses', lambda: user_cache.misses, 'counter'),
+        ('velobike_log_dropped_total', 'Log records dropped because the log queue was full', lambda: log.stats()['dropped'], 'counter'),
+        ('velobike_log_suppressed_total', 'Repeated warnings and errors not written', lambda: log.stats()['suppressed'], 'counter'),
+        ('velobike_photos_processed_total', 'Bike photos resized and hashed', lambda: photo_pipeline.processed, 'counter'),
+        ('velobike_photos_reused_total', 'Bike photos sent again, served from the earlier upload', lambda: photo_pipeline.reused, 'counter'),
+        ('velobike_photos_duplicate_total', 'Bike photos flagged as duplicates', lambda: photo_pipeline.duplicates, 'counter'),
+        ('velobike_photos_failed_total', 'Bike photos that could not be processed', lambda: photo_pipeline.failed, 'counter'),
+        ('velobike_photo_process_seconds_total', 'Time spent waiting on photo workers', lambda: photo_pipeline.process_seconds, 'counter'),
+    ):
+        registry.register(Collected(name, help, read, kind))
+
+
+async def handle_metrics(request):
+    from aiohttp import web
+
+    return web.Response(body=registry.render().encode(), headers={'Content-Type': CONTENT_TYPE})
+
+
+async def start_server(host: str = METRICS_HOST, port: int = METRICS_PORT, path: str = METRICS_PATH):
+    """Serve the metrics (and readiness) page; returns the aiohttp AppRunner."""
+    from aiohttp import web
+    from services.webhook import start_server as start_app
+    from utils.startup import handle_ready
+
+    _register_app_metrics()
+    app = web.Application()
+    app.router.add_get(path, handle_metrics)
+    app.router.add_get(READY_PATH, handle_ready)
+    runner = await start_app(app, host=host, port=port)
+    logger.info("Metrics on %s:%s%s", host, port, path)
+    return runner
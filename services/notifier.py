@@ -0,0 +1,193 @@
+# Outbound messages: bounded queue, worker pool and token buckets for Telegram's rate limits.
+#
+# Handlers call notifier.notify(...) / notify_photo(...), which only enqueue, so a handler
+# never waits on Telegram. Workers send at most NOTIFY_GLOBAL_RATE messages per second overall
+# and NOTIFY_CHAT_RATE per chat, back off on RetryAfter, retry network/server errors and give
+# up on permanent errors (bot blocked, chat not found).
+import asyncio
+import itertools
+import time
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+from config import NOTIFY_QUEUE_SIZE, NOTIFY_WORKERS, NOTIFY_GLOBAL_RATE, NOTIFY_CHAT_RATE, NOTIFY_MAX_RETRIES
+from utils.logger import logger
+
+URGENT, BULK = 0, 1
+
+
+class TokenBucket:
+    """rate tokens per second, bursts of up to capacity."""
+
+    def __init__(self, rate: float, capacity: float = None, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._clock = clock
+        self._tokens = self.capacity
+        self._updated = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self) -> float:
+        """Take a token; returns how long to wait before using it (0 if available now)."""
+        self._refill()
+        self._tokens -= 1
+        return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    async def acquire(self):
+        wait = self.delay()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class Notifier:
+    def __init__(self, maxsize: int = NOTIFY_QUEUE_SIZE, workers: int = NOTIFY_WORKERS,
+                 global_rate: float = NOTIFY_GLOBAL_RATE, chat_rate: float = NOTIFY_CHAT_RATE,
+                 max_retries: int = NOTIFY_MAX_RETRIES):
+        self.bot = None
+        self.concurrency = max(1, workers)
+        self.max_retries = max_retries
+        self.chat_rate = chat_rate
+        self._queue = asyncio.PriorityQueue(maxsize=maxsize)
+        # broadcasts may only fill half the queue, so direct notifications always fit
+        self._bulk_slots = asyncio.Semaphore(max(1, maxsize // 2))
+        self._seq = itertools.count()
+        self._global = TokenBucket(global_rate)
+        self._chat_next = {}  # chat_id -> monotonic time its next message may go out
+        self._paused_until = 0.0
+        self._workers = []
+        self.sent = self.failed = self.retried = self.dropped = self.rate_limited = 0
+        self._latency_total = 0.0
+
+    def start(self, bot: Bot):
+        self.bot = bot
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    def _offer(self, method: str, chat_id: int, kwargs: dict) -> bool:
+        try:
+            self._queue.put_nowait((URGENT, next(self._seq), (method, chat_id, kwargs, 0, time.monotonic())))
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logger.warning("Notification queue full, dropping %s to %s", method, chat_id)
+            return False
+
+    def notify(self, chat_id: int, text: str, **kwargs) -> bool:
+        """Queue a text message without waiting; False if the queue is full."""
+        return self._offer('send_message', chat_id, dict(kwargs, text=text))
+
+    def notify_photo(self, chat_id: int, photo, **kwargs) -> bool:
+        return self._offer('send_photo', chat_id, dict(kwargs, photo=photo))
+
+    async def broadcast(self, chat_ids, text: str, **kwargs) -> int:
+        """Queue text for every chat in chat_ids (sync or async iterable), waiting for room; returns the count.
+
+        Run it as a task: it paces itself to the send rate.
+        """
+        if hasattr(chat_ids, '__aiter__'):
+            async def messages():
+                async for chat_id in chat_ids:
+                    yield chat_id, text
+            return await self.send_bulk(messages(), **kwargs)
+        return await self.send_bulk(((chat_id, text) for chat_id in chat_ids), **kwargs)
+
+    async def send_bulk(self, messages, **kwargs) -> int:
+        """Like broadcast, for (chat_id, text) pairs that each carry their own text."""
+        count = 0
+
+        async def put(chat_id, text):
+            await self._bulk_slots.acquire()
+            await self._queue.put((BULK, next(self._seq), ('send_message', chat_id, dict(kwargs, text=text), 0, time.monotonic())))
+
+        if hasattr(messages, '__aiter__'):
+            async for chat_id, text in messages:
+                await put(chat_id, text)
+                count += 1
+        else:
+            for chat_id, text in messages:
+                await put(chat_id, text)
+                count += 1
+        return count
+
+    async def _wait_turn(self, chat_id: int):
+        if self.chat_rate > 0:
+            now = time.monotonic()
+            at = max(now, self._chat_next.get(chat_id, 0.0))
+            self._chat_next[chat_id] = at + 1.0 / self.chat_rate
+            if len(self._chat_next) > 10_000:
+                self._chat_next = {c: t for c, t in self._chat_next.items() if t > now}
+            if at > now:
+                await asyncio.sleep(at - now)
+        now = time.monotonic()
+        if self._paused_until > now:
+            await asyncio.sleep(self._paused_until - now)
+        await self._global.acquire()
+
+    def _requeue(self, entry):
+        try:
+            self._queue.put_nowait(entry)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            if entry[0] == BULK:
+                self._bulk_slots.release()
+
+    async def _worker(self):
+        while True:
+            priority, seq, (method, chat_id, kwargs, attempt, queued_at) = await self._queue.get()
+            requeue_after = None
+            try:
+                await self._wait_turn(chat_id)
+                await getattr(self.bot, method)(chat_id, **kwargs)
+                self.sent += 1
+                self._latency_total += time.monotonic() - queued_at
+            except TelegramRetryAfter as e:
+                # Telegram asks everyone to slow down: pause all workers, try again after
+                self.rate_limited += 1
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                requeue_after = 0.0
+            except (TelegramNetworkError, TelegramServerError):
+                requeue_after = min(30.0, 2.0 ** attempt) if attempt < self.max_retries else None
+                if requeue_after is None:
+                    self.failed += 1
+                    logger.warning("Giving up on %s to %s after %s attempts", method, chat_id, attempt + 1)
+            except TelegramAPIError as e:
+                # blocked by the user, chat not found, bad request: retrying will not help
+                self.failed += 1
+                logger.info("Could not deliver %s to %s: %s", method, chat_id, e)
+            except Exception:
+                self.failed += 1
+                logger.exception("Unexpected error sending %s to %s", method, chat_id)
+            finally:
+                self._queue.task_done()
+            if requeue_after is not None:
+                self.retried += 1
+                asyncio.get_running_loop().call_later(
+                    requeue_after, self._requeue, (priority, seq, (method, chat_id, kwargs, attempt + 1, queued_at)))
+            elif priority == BULK:
+                self._bulk_slots.release()
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    def stats(self) -> dict:
+        return {
+            'queued': self.qsize(), 'sent': self.sent, 'failed': self.failed, 'retried': self.retried,
+            'dropped': self.dropped, 'rate_limited': self.rate_limited,
+            'avg_latency_s': self._latency_total / self.sent if self.sent else 0.0,
+        }
+
+    async def stop(self, timeout: float = 10.0):
+        """Deliver what is queued (up to timeout), then stop the workers."""
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Dropping %s queued notifications on shutdown", self._queue.qsize())
+        for w in self._workers:
+            w.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+
+notifier = Notifier()
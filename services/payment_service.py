@@ -1,3 +1,283 @@
-# Payment service stub
-async def create_payment(amount: float, user_id: int):
-    return {'status': 'created', 'amount': amount}
+# Payments: intents in the payments table, charges through a pluggable provider.
+#
+# create_payment writes a pending row keyed by its idempotency key and commits, calls the
+# provider with no transaction open, then records the answer in a second short transaction.
+# Providers that confirm later report through handle_callback (the signed HTTP callback in
+# webhook mode) or are asked again by the reconciler. Every status change is a conditional
+# UPDATE checked against PAYMENT_TRANSITIONS, so callbacks, the reconciler and a resubmitted
+# request can race without capturing twice or moving a payment backwards.
+import abc
+import argparse
+import asyncio
+import datetime
+import hashlib
+import hmac
+import json
+import random
+import uuid
+from collections import namedtuple
+from config import PAYMENT_PROVIDER, PAYMENT_CURRENCY, PAYMENT_CALLBACK_SECRET, PAYMENT_PENDING_TIMEOUT
+from config import PAYMENT_RECONCILE_INTERVAL, FAKE_PAYMENT_LATENCY, FAKE_PAYMENT_FAIL_RATE
+from database.db import session_scope
+from database.queries import create_payment_intent, get_payment, get_payment_by_key, get_user_by_db_id
+from database.queries import list_pending_payments, set_payment_provider_ref, transition_payment
+from services.notifier import notifier
+from utils.logger import logger
+
+SIGNATURE_HEADER = 'X-Payment-Signature'
+
+# what a provider says about a charge or refund; status is 'pending', 'captured', 'failed' or 'refunded'
+ChargeResult = namedtuple('ChargeResult', 'ref status error', defaults=(None,))
+
+
+class PaymentError(Exception):
+    pass
+
+
+class PaymentProvider(abc.ABC):
+    """Interface every provider implements; all calls must be idempotent per key.
+
+    A provider missing one of the methods fails when it is constructed, not on its first payment.
+    """
+    name = None
+
+    @abc.abstractmethod
+    async def charge(self, idempotency_key: str, amount: float, currency: str) -> ChargeResult:
+        ...
+
+    @abc.abstractmethod
+    async def status(self, ref: str) -> ChargeResult:
+        ...
+
+    @abc.abstractmethod
+    async def refund(self, ref: str, amount: float, idempotency_key: str) -> ChargeResult:
+        ...
+
+
+class FakeProvider(PaymentProvider):
+    """In-process provider for development and benchmarks.
+
+    Each call takes latency seconds; fail_rate of the charges are declined. With
+    confirm_after set, charges stay pending and the outcome is delivered to
+    on_callback(idempotency_key, ChargeResult) that many seconds later, the way a
+    real provider's webhook would.
+    """
+    name = 'fake'
+
+    def __init__(self, latency: float = FAKE_PAYMENT_LATENCY, fail_rate: float = FAKE_PAYMENT_FAIL_RATE,
+                 confirm_after: float = None, on_callback=None, seed=None):
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.confirm_after = confirm_after
+        self.on_callback = on_callback
+        self._rng = random.Random(seed)
+        self._by_key = {}    # idempotency key -> ref
+        self._charges = {}   # ref -> [status, amount, error]
+        self._pending_callbacks = set()
+        self.charges = self.refunds = 0
+
+    async def _wait(self):
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+
+    def _result(self, ref: str) -> ChargeResult:
+        status, _, error = self._charges[ref]
+        return ChargeResult(ref, status, error)
+
+    async def charge(self, idempotency_key, amount, currency):
+        await self._wait()
+        ref = self._by_key.get(idempotency_key)
+        if ref is not None:
+            return self._result(ref)
+        ref = self._by_key[idempotency_key] = f'fake_{uuid.uuid4().hex}'
+        self.charges += 1
+        declined = self._rng.random() < self.fail_rate
+        outcome = ['failed', amount, 'card_declined'] if declined else ['captured', amount, None]
+        if self.confirm_after is None:
+            self._charges[ref] = outcome
+        else:
+            self._charges[ref] = ['pending', amount, None]
+            task = asyncio.create_task(self._confirm(idempotency_key, ref, outcome))
+            self._pending_callbacks.add(task)
+            task.add_done_callback(self._pending_callbacks.discard)
+        return self._result(ref)
+
+    async def _confirm(self, idempotency_key, ref, outcome):
+        await asyncio.sleep(self.confirm_after)
+        self._charges[ref] = outcome
+        if self.on_callback is not None:
+            try:
+                await self.on_callback(idempotency_key, self._result(ref))
+            except Exception:
+                logger.exception("Fake payment callback for %s failed", idempotency_key)
+
+    async def status(self, ref):
+        await self._wait()
+        return self._result(ref)
+
+    async def refund(self, ref, amount, idempotency_key):
+        await self._wait()
+        charge = self._charges[ref]
+        if charge[0] == 'captured':
+            charge[0] = 'refunded'
+            self.refunds += 1
+        elif charge[0] != 'refunded':
+            return ChargeResult(ref, charge[0], 'not_captured')
+        return self._result(ref)
+
+
+PROVIDERS = {
+    'fake': FakeProvider,
+}
+
+
+def _make_provider(name: str = PAYMENT_PROVIDER) -> PaymentProvider:
+    try:
+        return PROVIDERS[name]()
+    except KeyError:
+        raise RuntimeError(f"unknown PAYMENT_PROVIDER {name!r}, expected one of {', '.join(PROVIDERS)}") from None
+
+
+provider = _make_provider()
+
+
+async def _apply(payment, result: ChargeResult):
+    """Record what the provider said; returns (payment, changed status)."""
+    async with session_scope() as s:
+        if result.ref and payment.provider_ref is None:
+            payment = await set_payment_provider_ref(payment.id, result.ref, session=s) or payment
+        if result.status in ('captured', 'failed') and payment.status == 'pending':
+            moved = await transition_payment(payment.id, result.status, error=result.error, session=s)
+            if moved is not None:
+                return moved, True
+            payment = await get_payment(payment.id, session=s)
+        return payment, False
+
+
+async def create_payment(amount: float, user_id: int, idempotency_key: str = None, rental_id: int = None,
+                         currency: str = PAYMENT_CURRENCY):
+    """Charge user_id (users.id) and return the payment row.
+
+    Submitting the same idempotency_key again returns the first payment instead of
+    charging twice. Do not call this inside a transaction: the provider is called
+    between two short transactions of its own.
+    """
+    if amount <= 0:
+        raise PaymentError("amount must be positive")
+    key = idempotency_key or uuid.uuid4().hex
+    payment, created = await create_payment_intent(key, user_id, amount, currency, provider.name, rental_id=rental_id)
+    if not created:
+        return payment
+    try:
+        result = await provider.charge(key, amount, currency)
+    except Exception as e:
+        # stays pending; the reconciler charges again with the same key
+        logger.warning("Payment %s: provider call failed, left pending: %r", payment.id, e)
+        return payment
+    payment, _ = await _apply(payment, result)
+    return payment
+
+
+async def handle_callback(idempotency_key: str, result: ChargeResult):
+    """A provider reports the outcome of a charge; safe to receive more than once."""
+    payment = await get_payment_by_key(idempotency_key)
+    if payment is None:
+        return None
+    payment, changed = await _apply(payment, result)
+    if changed:
+        await _notify(payment)
+    return payment
+
+
+async def _notify(payment):
+    user = await get_user_by_db_id(payment.user_id)
+    if user is None:
+        return
+    if payment.status == 'captured':
+        notifier.notify(user.telegram_id, f"To'lov qabul qilindi: {payment.amount} {payment.currency}")
+    elif payment.status == 'failed':
+        notifier.notify(user.telegram_id, f"To'lov amalga oshmadi ({payment.error or 'xatolik'}). /pay orqali qayta urinib ko'ring.")
+
+
+async def refund_payment(payment_id: int):
+    """Refund a captured payment; a repeated call refunds once and returns the refunded row."""
+    payment = await get_payment(payment_id)
+    if payment is None:
+        raise PaymentError(f"payment {payment_id} not found")
+    if payment.status == 'refunded':
+        return payment
+    if payment.status != 'captured':
+        raise PaymentError(f"payment {payment_id} is {payment.status}, only captured payments can be refunded")
+    result = await provider.refund(payment.provider_ref, payment.amount, f'refund:{payment.idempotency_key}')
+    if result.status != 'refunded':
+        raise PaymentError(f"provider did not refund payment {payment_id}: {result.error or result.status}")
+    return await transition_payment(payment_id, 'refunded') or await get_payment(payment_id)
+
+
+def sign(body: bytes, secret: str = PAYMENT_CALLBACK_SECRET) -> str:
+    return hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+async def payment_callback(request):
+    """POST {"idempotency_key", "ref", "status", "error"} signed with PAYMENT_CALLBACK_SECRET."""
+    # aiohttp.web is only loaded by the servers (webhook mode), not on every start
+    from aiohttp import web
+
+    body = await request.read()
+    if not PAYMENT_CALLBACK_SECRET or not hmac.compare_digest(request.headers.get(SIGNATURE_HEADER, ''), sign(body)):
+        return web.Response(status=401)
+    try:
+        data = json.loads(body)
+        result = ChargeResult(data['ref'], data['status'], data.get('error'))
+        key = data['idempotency_key']
+    except (ValueError, KeyError, TypeError):
+        return web.Response(status=400)
+    if await handle_callback(key, result) is None:
+        return web.Response(status=404)
+    return web.Response()
+
+
+async def reconcile_once(older_than: float = PAYMENT_PENDING_TIMEOUT):
+    """Ask the provider about payments pending for longer than older_than seconds; returns how many settled."""
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=older_than)
+    settled = 0
+    for payment in await list_pending_payments(cutoff):
+        try:
+            if payment.provider_ref is None:
+                # the first charge call never answered; the key keeps the provider from charging twice
+                result = await provider.charge(payment.idempotency_key, payment.amount, payment.currency)
+            else:
+                result = await provider.status(payment.provider_ref)
+            payment, changed = await _apply(payment, result)
+        except Exception:
+            logger.exception("Payment %s: reconciliation failed", payment.id)
+            continue
+        if changed:
+            settled += 1
+            logger.info("Payment %s settled by reconciliation: %s", payment.id, payment.status)
+            await _notify(payment)
+    return settled
+
+
+async def run_reconciler(interval: float = PAYMENT_RECONCILE_INTERVAL):
+    if interval <= 0:
+        return
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await reconcile_once()
+        except Exception:
+            logger.exception("Payment reconciliation failed")
+
+
+async def _main():
+    parser = argparse.ArgumentParser(description='Settle pending payments with the provider')
+    parser.add_argument('--older-than', type=float, default=PAYMENT_PENDING_TIMEOUT, help='seconds a payment has been pending')
+    args = parser.parse_args()
+    from database.db import init_db
+    await init_db()
+    print(f"{await reconcile_once(args.older_than)} payments settled")
+
+
+if __name__ == '__main__':
+    asyncio.run(_main())
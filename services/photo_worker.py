@@ -0,0 +1,94 @@
+# Image work for services/photos.py, run in the photo worker processes.
+#
+# A worker is `python -m services.photo_worker`: a fresh interpreter that imports nothing but this
+# module and Pillow (no aiogram, config or database) and answers requests on stdin/stdout. It is not
+# a multiprocessing child, which would run the parent's __main__ (bot.py) again before its first task.
+# Sizes and quality are passed in by the caller. Pillow is imported on first use: the bot imports
+# this module for the message framing and only processes photos itself with PHOTO_WORKERS=0.
+import io
+import pickle
+import struct
+import sys
+from collections import namedtuple
+
+# thumb is None when it was not asked for
+PhotoResult = namedtuple('PhotoResult', 'phash width height catalog thumb')
+
+
+def dhash(image) -> int:
+    """64-bit difference hash of a PIL image: is each pixel of a 9x8 grayscale copy brighter than its right neighbour."""
+    from PIL import Image
+
+    px = image.convert('L').resize((9, 8), Image.Resampling.BOX).tobytes()
+    h = 0
+    for row in range(0, 72, 9):
+        for x in range(row, row + 8):
+            h = h << 1 | (px[x] > px[x + 1])
+    return h
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+def _jpeg(image, quality: int) -> bytes:
+    out = io.BytesIO()
+    image.save(out, 'JPEG', quality=quality, optimize=True)
+    return out.getvalue()
+
+
+def process_photo(data: bytes, catalog_size: int, thumb_size: int, quality: int, with_thumb: bool = True) -> PhotoResult:
+    """Decode an image; returns its hash and the JPEG variants."""
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as image:
+        # a JPEG decodes straight to the 1/2, 1/4 or 1/8 scale that still covers the catalog size
+        scale = min(1.0, catalog_size / max(image.size))
+        image.draft('RGB', (round(image.width * scale), round(image.height * scale)))
+        ImageOps.exif_transpose(image, in_place=True)
+        catalog = image if image.mode == 'RGB' else image.convert('RGB')
+        catalog.thumbnail((catalog_size, catalog_size))
+        thumb = catalog.copy()
+        thumb.thumbnail((thumb_size, thumb_size))
+        return PhotoResult(dhash(thumb), catalog.width, catalog.height, _jpeg(catalog, quality),
+                           _jpeg(thumb, quality) if with_thumb else None)
+
+
+def warm_up():
+    """Import Pillow and its JPEG and PNG plugins once, before the first photo."""
+    from PIL import Image
+
+    Image.preinit()
+
+
+# a message is a pickle behind its 4-byte length
+HEADER = struct.Struct('!I')
+
+
+def encode(obj) -> bytes:
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    return HEADER.pack(len(data)) + data
+
+
+def read_message(stream):
+    """The next message, or None at end of input."""
+    header = stream.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    return pickle.loads(stream.read(HEADER.unpack(header)[0]))
+
+
+def serve(stdin, stdout):
+    """Answer process_photo argument tuples with (True, result tuple) or (False, error text) until stdin closes."""
+    warm_up()
+    while (args := read_message(stdin)) is not None:
+        try:
+            reply = (True, tuple(process_photo(*args)))
+        except Exception as e:
+            reply = (False, f'{type(e).__name__}: {e}')
+        stdout.write(encode(reply))
+        stdout.flush()
+
+
+if __name__ == '__main__':
+    serve(sys.stdin.buffer, sys.stdout.buffer)
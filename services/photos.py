@@ -0,0 +1,254 @@
+# Partner bike photos: resized, compressed and hashed off the event loop, uploaded once.
+#
+# The photo step only submits the photo and answers the partner. A background task downloads the
+# original once and hands the bytes to a worker process (PHOTO_WORKERS, services/photo_worker.py),
+# which decodes it, re-encodes a catalog-size and a thumbnail JPEG and computes a 64-bit difference
+# hash, so the event loop never waits on Pillow. A photo whose hash is within PHOTO_DUPLICATE_DISTANCE
+# bits of an earlier one (a re-encoded, resized or slightly cropped copy) is flagged to the admins;
+# the very same Telegram file sent again is recognised by its file_unique_id and reuses the earlier
+# photo's variants without a download. Each variant is uploaded once and its file_id kept in bike_photos, so later sends never
+# upload it again. When anything fails the admins get the original file_id, as before.
+import asyncio
+import contextlib
+import functools
+import itertools
+import pickle
+import sys
+import time
+from asyncio.subprocess import PIPE
+from aiogram import Bot
+from aiogram.types import BufferedInputFile, InputMediaPhoto, PhotoSize
+from config import BASE_DIR, ADMIN_IDS, PHOTO_WORKERS, PHOTO_CATALOG_SIZE, PHOTO_THUMB_SIZE, PHOTO_JPEG_QUALITY, PHOTO_DUPLICATE_DISTANCE, PHOTO_STORE_CHAT_ID
+from database.queries import add_bike_photo, get_bike_photo_by_source, iter_bike_photo_hashes
+from services.notifier import notifier
+from services.photo_worker import HEADER, PhotoResult, encode, process_photo
+from utils.logger import logger
+
+
+@functools.lru_cache(maxsize=None)
+def _flips(bits: int, radius: int) -> tuple:
+    """Every bits-wide mask with at most radius bits set."""
+    return tuple(sum(1 << i for i in chosen) for r in range(radius + 1) for chosen in itertools.combinations(range(bits), r))
+
+
+class PhotoHashIndex:
+    """Photo hashes, searchable by Hamming distance (multi-index hashing).
+
+    Each hash is filed under each of its four 16-bit quarters. Two hashes at most d bits apart
+    differ in at most d // 4 bits in one of the quarters, so a lookup only reads the buckets of
+    its own quarters with up to d // 4 bits flipped: 4 x 17 buckets of ~1/65536 of the photos
+    each for d = 4..7, instead of every photo.
+    """
+
+    BANDS = 4
+    BITS = 16
+
+    def __init__(self):
+        self._bands = [{} for _ in range(self.BANDS)]  # quarter -> [(hash, photo id), ...]
+        self._photos = {}  # photo id -> (hash, bike_id, partner_id)
+
+    def __len__(self):
+        return len(self._photos)
+
+    def add(self, photo_id: int, phash: int, bike_id: int, partner_id: int):
+        self._photos[photo_id] = (phash, bike_id, partner_id)
+        mask = (1 << self.BITS) - 1
+        for band, buckets in enumerate(self._bands):
+            buckets.setdefault(phash >> (band * self.BITS) & mask, []).append((phash, photo_id))
+
+    def matches(self, phash: int, max_distance: int) -> list:
+        """(distance, photo_id, bike_id, partner_id) of the photos within max_distance bits, closest first."""
+        flips = _flips(self.BITS, max_distance // self.BANDS)
+        mask = (1 << self.BITS) - 1
+        found = {}
+        for band, buckets in enumerate(self._bands):
+            quarter = phash >> (band * self.BITS) & mask
+            for flip in flips:
+                for other, photo_id in buckets.get(quarter ^ flip, ()):
+                    distance = (phash ^ other).bit_count()
+                    if distance <= max_distance:
+                        found[photo_id] = distance
+        return sorted((distance, photo_id) + self._photos[photo_id][1:] for photo_id, distance in found.items())
+
+    async def load(self) -> int:
+        """Replace the contents with every hash in bike_photos; returns the count."""
+        self._bands = [{} for _ in range(self.BANDS)]
+        self._photos = {}
+        async for photo_id, bike_id, partner_id, phash in iter_bike_photo_hashes():
+            self.add(photo_id, int(phash, 16), bike_id, partner_id)
+        return len(self._photos)
+
+
+class PhotoPipeline:
+    def __init__(self, workers: int = PHOTO_WORKERS, catalog_size: int = PHOTO_CATALOG_SIZE, thumb_size: int = PHOTO_THUMB_SIZE,
+                 quality: int = PHOTO_JPEG_QUALITY, max_distance: int = PHOTO_DUPLICATE_DISTANCE, store_chat_id: int = PHOTO_STORE_CHAT_ID):
+        self.bot = None
+        self.workers = workers
+        self.catalog_size = catalog_size
+        self.thumb_size = thumb_size
+        self.quality = quality
+        self.max_distance = max_distance
+        self.store_chat_id = store_chat_id
+        self.index = PhotoHashIndex()
+        self._idle = None  # idle worker processes; None in the queue stands for one to (re)start
+        self._tasks = set()
+        self.processed = self.reused = self.duplicates = self.failed = 0
+        self.process_seconds = 0.0
+
+    async def start_workers(self):
+        """Start the worker processes (none when workers is 0: photos are then processed on a thread).
+
+        Returns once they are running; they import Pillow while the rest of startup goes on.
+        """
+        if self.workers <= 0 or self._idle is not None:
+            return
+        self._idle = asyncio.Queue()
+        for _ in range(self.workers):
+            self._idle.put_nowait(await self._spawn())
+
+    async def start(self, bot: Bot) -> int:
+        """Start the workers and load the hash index; returns how many photos are indexed."""
+        self.bot = bot
+        await self.start_workers()
+        return await self.index.load()
+
+    @staticmethod
+    async def _spawn(proc=None):
+        """proc if it still runs, else a new worker."""
+        if proc is not None and proc.returncode is None:
+            return proc
+        return await asyncio.create_subprocess_exec(sys.executable, '-m', 'services.photo_worker', stdin=PIPE, stdout=PIPE, cwd=BASE_DIR)
+
+    async def process(self, data: bytes, with_thumb: bool = True) -> PhotoResult:
+        """process_photo on a worker."""
+        t0 = time.perf_counter()
+        args = (data, self.catalog_size, self.thumb_size, self.quality, with_thumb)
+        try:
+            if self._idle is None:
+                return await asyncio.to_thread(process_photo, *args)
+            return await self._call(args)
+        finally:
+            self.process_seconds += time.perf_counter() - t0
+
+    async def _call(self, args: tuple) -> PhotoResult:
+        idle = self._idle
+        proc = await idle.get()
+        try:
+            proc = await self._spawn(proc)
+            proc.stdin.write(encode(args))
+            await proc.stdin.drain()
+            size, = HEADER.unpack(await proc.stdout.readexactly(HEADER.size))
+            ok, value = pickle.loads(await proc.stdout.readexactly(size))
+        except BaseException:
+            # the worker died (killed for memory?) or the photo was cancelled half way: either
+            # way its pipes are out of step, and the next photo starts a new one
+            if proc is not None:
+                with contextlib.suppress(ProcessLookupError):
+                    proc.kill()
+            proc = None
+            raise
+        finally:
+            idle.put_nowait(proc)
+        if not ok:
+            raise RuntimeError(f'photo worker: {value}')
+        return PhotoResult(*value)
+
+    def submit(self, bike_id: int, partner_id: int, photo: PhotoSize, caption: str):
+        """Process a partner's photo in the background, then send it to the admins with caption."""
+        if self.bot is None:
+            for aid in ADMIN_IDS:
+                notifier.notify_photo(aid, photo=photo.file_id, caption=caption)
+            return None
+        task = asyncio.create_task(self._run(bike_id, partner_id, photo, caption))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _run(self, bike_id: int, partner_id: int, photo: PhotoSize, caption: str):
+        admins = list(ADMIN_IDS)
+        file_id = photo.file_id
+        try:
+            earlier = await get_bike_photo_by_source(photo.file_unique_id)
+            if earlier is not None and earlier.catalog_file_id:
+                # the very same file again: nothing to download, process or upload
+                self.reused += 1
+                caption += self._duplicate_note((0, earlier.id, earlier.bike_id, earlier.partner_id), partner_id)
+                row = dict(phash=int(earlier.phash, 16), width=earlier.width, height=earlier.height, duplicate_of=earlier.id,
+                           thumb_file_id=earlier.thumb_file_id, catalog_file_id=earlier.catalog_file_id)
+            else:
+                data = await self.bot.download(photo.file_id)
+                result = await self.process(data.getvalue(), with_thumb=bool(self.store_chat_id))
+                self.processed += 1
+                found = self.index.matches(result.phash, self.max_distance)
+                if found:
+                    caption += self._duplicate_note(found[0], partner_id)
+                row = dict(phash=result.phash, width=result.width, height=result.height, duplicate_of=found[0][1] if found else None)
+                # the row is written once, with the file_ids of the uploaded variants
+                row.update(await self._upload(result, caption, admins))
+            phash = row.pop('phash')
+            photo_id = await add_bike_photo(bike_id, partner_id, photo.file_unique_id, f'{phash:016x}', **row)
+            self.index.add(photo_id, phash, bike_id, partner_id)
+            file_id = row.get('catalog_file_id') or file_id
+        except Exception:
+            self.failed += 1
+            logger.exception("Could not process the photo of bike %s", bike_id)
+        for aid in admins:
+            notifier.notify_photo(aid, photo=file_id, caption=caption)
+
+    def _duplicate_note(self, duplicate: tuple, partner_id: int) -> str:
+        self.duplicates += 1
+        distance, _, other_bike, other_partner = duplicate
+        note = f"\n⚠️ Rasm Bike ID {other_bike} rasmiga o'xshaydi ({distance} bit farq)"
+        return note + (', boshqa hamkor!' if other_partner != partner_id else '')
+
+    async def _upload(self, result: PhotoResult, caption: str, admins: list) -> dict:
+        """Upload the variants once; returns their file_ids.
+
+        With a store chat both go there as one album. Otherwise the catalog variant goes to the
+        first admin as the notification (and is taken off admins), and the size Telegram generated
+        for it closest to thumb_size stands in for the thumbnail.
+        """
+        if self.store_chat_id:
+            sent = await self.bot.send_media_group(self.store_chat_id, media=[
+                InputMediaPhoto(media=BufferedInputFile(result.catalog, 'catalog.jpg'), caption=caption),
+                InputMediaPhoto(media=BufferedInputFile(result.thumb, 'thumb.jpg')),
+            ])
+            return {'catalog_file_id': sent[0].photo[-1].file_id, 'thumb_file_id': sent[1].photo[-1].file_id}
+        if not admins:
+            return {}
+        message = await self.bot.send_photo(admins[0], BufferedInputFile(result.catalog, 'catalog.jpg'), caption=caption)
+        del admins[0]
+        thumb = min(message.photo, key=lambda size: abs(max(size.width, size.height) - self.thumb_size))
+        return {'catalog_file_id': message.photo[-1].file_id, 'thumb_file_id': thumb.file_id}
+
+    def stats(self) -> dict:
+        return {
+            'in_progress': len(self._tasks), 'processed': self.processed, 'reused': self.reused,
+            'duplicates': self.duplicates, 'failed': self.failed, 'indexed': len(self.index),
+            'avg_process_s': self.process_seconds / self.processed if self.processed else 0.0,
+        }
+
+    async def stop(self, timeout: float = 30.0):
+        """Finish the photos in progress (up to timeout), then stop the workers."""
+        if self._tasks:
+            _, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+            if pending:
+                logger.warning("Dropping %s photos in progress on shutdown", len(pending))
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+        if self._idle is not None:
+            idle, self._idle = self._idle, None
+            procs = [idle.get_nowait() for _ in range(idle.qsize())]
+            running = [proc for proc in procs if proc is not None and proc.returncode is None]
+            for proc in running:
+                proc.stdin.close()  # a worker exits at the end of its input
+            if running:
+                await asyncio.wait([asyncio.ensure_future(proc.wait()) for proc in running], timeout=5)
+            for proc in running:
+                if proc.returncode is None:
+                    proc.kill()
+        self.bot = None
+
+
+photo_pipeline = PhotoPipeline()
@@ -0,0 +1,36 @@
+# Referral leaderboard: the top referrers are read at most once per REFERRAL_TOP_MAX_AGE
+import asyncio
+import time
+from config import REFERRAL_TOP_N, REFERRAL_TOP_MAX_AGE
+from database.queries import top_referrers
+
+
+class Leaderboard:
+    """Last read of top_referrers(size), re-read when older than max_age."""
+
+    def __init__(self, size: int = REFERRAL_TOP_N, max_age: float = REFERRAL_TOP_MAX_AGE, clock=time.monotonic):
+        self.size = size
+        self.max_age = max_age
+        self._clock = clock
+        self._rows = None
+        self._taken_at = 0.0
+        self._lock = asyncio.Lock()
+
+    def age(self) -> float:
+        return self._clock() - self._taken_at if self._rows is not None else float('inf')
+
+    async def refresh(self) -> list:
+        self._rows = await top_referrers(self.size)
+        self._taken_at = self._clock()
+        return self._rows
+
+    async def get(self) -> list:
+        if self.age() <= self.max_age:
+            return self._rows
+        async with self._lock:
+            if self.age() <= self.max_age:
+                return self._rows
+            return await self.refresh()
+
+
+leaderboard = Leaderboard()
@@ -0,0 +1,134 @@
+# Deadlines of open rentals: reminder before MAX_RENT_TIME_HOURS runs out, automatic close after.
+#
+# Open rentals are loaded once at startup into a heap ordered by due time and followed
+# through database.queries.rental_listeners, so nothing polls the rentals table. One task
+# sleeps until the earliest deadline and is woken when an earlier one is added. Closed
+# rentals stay in the heap until they surface (lazy deletion). Closing goes through the
+# conditional set_rental_end, so a rental closed meanwhile by the user or another
+# instance is billed once.
+import asyncio
+import datetime
+import heapq
+import itertools
+from config import MAX_RENT_TIME_HOURS, RENT_REMIND_BEFORE_MINUTES
+from database.queries import rental_listeners, iter_active_rentals, set_rental_end, get_user_by_db_id
+from services.billing import compute_fee
+from services.notifier import notifier
+from utils.logger import logger
+
+REMIND, CLOSE = 'remind', 'close'
+RETRY_AFTER = datetime.timedelta(minutes=1)
+
+
+class RentalScheduler:
+    def __init__(self, max_hours: float = MAX_RENT_TIME_HOURS, remind_before: int = RENT_REMIND_BEFORE_MINUTES,
+                 clock=datetime.datetime.utcnow):
+        self.max_time = datetime.timedelta(hours=max_hours)
+        self.remind_before = datetime.timedelta(minutes=remind_before)
+        self._clock = clock
+        self._heap = []     # (due, seq, kind, rental_id); entries of closed rentals are skipped
+        self._active = {}   # rental_id -> (user_id, start_at) of every open rental
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self.reminded = self.closed = 0
+
+    def __len__(self):
+        return len(self._active)
+
+    def _entries(self, rental_id: int, start_at: datetime.datetime):
+        deadline = start_at + self.max_time
+        if self.remind_before and self.remind_before < self.max_time:
+            yield deadline - self.remind_before, next(self._seq), REMIND, rental_id
+        yield deadline, next(self._seq), CLOSE, rental_id
+
+    def add(self, rental_id: int, user_id: int, start_at: datetime.datetime):
+        self._active[rental_id] = (user_id, start_at)
+        head = self._heap[0][0] if self._heap else None
+        for entry in self._entries(rental_id, start_at):
+            heapq.heappush(self._heap, entry)
+        if head is None or self._heap[0][0] < head:
+            self._wakeup.set()
+
+    def discard(self, rental_id: int):
+        self._active.pop(rental_id, None)
+        # up to two entries per open rental; rebuild once mostly stale
+        if len(self._heap) > 4 * len(self._active) + 64:
+            self._heap = [e for e in self._heap if e[3] in self._active]
+            heapq.heapify(self._heap)
+
+    def on_rental_change(self, rental):
+        """database.queries.rental_listeners hook."""
+        if rental.end_at is None:
+            self.add(rental.id, rental.user_id, rental.start_at)
+        else:
+            self.discard(rental.id)
+
+    async def load(self):
+        """Rebuild from the open rentals; returns how many there are."""
+        active, heap = {}, []
+        async for rental_id, user_id, start_at in iter_active_rentals():
+            active[rental_id] = (user_id, start_at)
+            heap.extend(self._entries(rental_id, start_at))
+        heapq.heapify(heap)
+        self._active, self._heap = active, heap
+        self._wakeup.set()
+        return len(active)
+
+    def due(self, now: datetime.datetime = None):
+        """Pop the entries due by now whose rental is still open."""
+        now = now or self._clock()
+        heap, fired = self._heap, []
+        while heap and heap[0][0] <= now:
+            due, _, kind, rental_id = heapq.heappop(heap)
+            if rental_id in self._active:
+                fired.append((kind, rental_id))
+        return fired
+
+    def next_due(self):
+        while self._heap and self._heap[0][3] not in self._active:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    async def run(self):
+        while True:
+            self._wakeup.clear()
+            for kind, rental_id in self.due():
+                try:
+                    await (self._remind(rental_id) if kind == REMIND else self._close(rental_id))
+                except Exception:
+                    logger.exception("Rental %s: %s failed, retrying", rental_id, kind)
+                    heapq.heappush(self._heap, (self._clock() + RETRY_AFTER, next(self._seq), kind, rental_id))
+            head = self.next_due()
+            timeout = None if head is None else max(0.0, (head - self._clock()).total_seconds())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _chat_id(self, user_id: int):
+        user = await get_user_by_db_id(user_id)
+        return user.telegram_id if user else None
+
+    async def _remind(self, rental_id: int):
+        chat_id = await self._chat_id(self._active[rental_id][0])
+        if chat_id:
+            minutes = int(self.remind_before.total_seconds() // 60)
+            notifier.notify(chat_id, f"Ijara muddati tugashiga {minutes} daqiqa qoldi. Iltimos, velosipedni qaytaring.")
+        self.reminded += 1
+
+    async def _close(self, rental_id: int):
+        user_id, start_at = self._active[rental_id]
+        chat_id = await self._chat_id(user_id)
+        # billed up to the deadline, not up to whenever this ran
+        rental = await set_rental_end(rental_id, fee_for=compute_fee, end_at=start_at + self.max_time)
+        self.discard(rental_id)
+        if rental is None:
+            return
+        self.closed += 1
+        logger.info("Rental %s closed automatically, fee %s", rental_id, rental.fee)
+        if chat_id:
+            notifier.notify(chat_id, f"Ijara muddati tugadi va avtomatik yopildi. To'lov: {rental.fee}")
+
+
+rental_scheduler = RentalScheduler()
+rental_listeners.append(rental_scheduler.on_rental_change)
@@ -0,0 +1,83 @@
+# /stats snapshot: counters are read at most once per STATS_MAX_AGE and checked against the raw tables
+import argparse
+import asyncio
+import time
+from config import STATS_MAX_AGE, STATS_RECONCILE_INTERVAL, STATS_RECONCILE_FIX
+from database.queries import admin_stats, reconcile_stat_counters
+from utils.logger import logger
+
+
+class StatsSnapshot:
+    """Last read of the stat counters, refreshed when older than max_age."""
+
+    def __init__(self, max_age: float = STATS_MAX_AGE, clock=time.monotonic):
+        self.max_age = max_age
+        self._clock = clock
+        self._values = None
+        self._taken_at = 0.0
+        self._lock = asyncio.Lock()
+
+    def age(self) -> float:
+        return self._clock() - self._taken_at if self._values is not None else float('inf')
+
+    async def refresh(self) -> dict:
+        self._values = await admin_stats()
+        self._taken_at = self._clock()
+        return self._values
+
+    async def get(self) -> dict:
+        if self.age() <= self.max_age:
+            return self._values
+        async with self._lock:
+            # another caller may have refreshed while we waited
+            if self.age() <= self.max_age:
+                return self._values
+            return await self.refresh()
+
+    async def run_refresher(self):
+        """Keep the snapshot fresh so /stats never waits on the database."""
+        if self.max_age <= 0:
+            return
+        while True:
+            try:
+                await self.refresh()
+            except Exception:
+                logger.exception("Stats refresh failed")
+            await asyncio.sleep(self.max_age / 2)
+
+
+stats_snapshot = StatsSnapshot()
+
+
+async def reconcile_once(fix: bool = STATS_RECONCILE_FIX):
+    mismatches = await reconcile_stat_counters(fix=fix)
+    for name, (have, actual) in mismatches.items():
+        logger.warning("Stat counter %s is %s, tables say %s%s", name, have, actual, ' - fixed' if fix else '')
+    return mismatches
+
+
+async def run_reconciler(interval: float = STATS_RECONCILE_INTERVAL):
+    """Check right away (backfills fresh counters), then every interval seconds."""
+    if interval <= 0:
+        return
+    while True:
+        try:
+            if await reconcile_once():
+                await stats_snapshot.refresh()
+        except Exception:
+            logger.exception("Stats reconciliation failed")
+        await asyncio.sleep(interval)
+
+
+async def _main():
+    parser = argparse.ArgumentParser(description='Check the /stats counters against full-table counts')
+    parser.add_argument('--fix', action='store_true', help='overwrite mismatching counters')
+    args = parser.parse_args()
+    from database.db import init_db
+    await init_db()
+    mismatches = await reconcile_once(fix=args.fix)
+    print(f"{len(mismatches)} mismatching counters{' fixed' if args.fix and mismatches else ''}")
+
+
+if __name__ == '__main__':
+    asyncio.run(_main())
@@ -0,0 +1,123 @@
+# Webhook mode: embedded aiohttp server feeding a bounded update queue
+import asyncio
+import hmac
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from config import WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBAPP_HOST, WEBAPP_PORT
+from config import UPDATE_QUEUE_SIZE, HANDLER_CONCURRENCY, PAYMENT_CALLBACK_PATH, PAYMENT_CALLBACK_SECRET, READY_PATH
+from utils.logger import logger
+from utils.startup import handle_ready, startup
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class UpdateQueue:
+    """Bounded queue of incoming updates drained by a fixed pool of handler workers."""
+
+    def __init__(self, dp: Dispatcher, bot: Bot, maxsize: int = UPDATE_QUEUE_SIZE, concurrency: int = HANDLER_CONCURRENCY):
+        self.dp = dp
+        self.bot = bot
+        self.concurrency = max(1, concurrency)
+        self._queue = asyncio.Queue(maxsize=maxsize)
+        self._workers = []
+        self.rejected = 0
+
+    def start(self):
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    def offer(self, update: Update) -> bool:
+        """Enqueue without waiting; False means the queue is full."""
+        try:
+            self._queue.put_nowait(update)
+            return True
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    async def _worker(self):
+        while True:
+            update = await self._queue.get()
+            try:
+                await self.dp.feed_update(self.bot, update)
+            except Exception:
+                logger.exception("Failed to process update %s", update.update_id)
+            finally:
+                self._queue.task_done()
+
+    async def stop(self, timeout: float = 10.0):
+        """Let queued updates finish (up to timeout), then stop the workers."""
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Dropping %s queued updates on shutdown", self._queue.qsize())
+        for w in self._workers:
+            w.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+
+def create_app(bot: Bot, queue: UpdateQueue, path: str = WEBHOOK_PATH, secret: str = WEBHOOK_SECRET) -> web.Application:
+    if not secret:
+        # without it anyone who reaches the port could post updates, e.g. admin commands with a spoofed sender
+        raise ValueError("webhook secret must not be empty")
+    async def handle_update(request: web.Request):
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), secret):
+            return web.Response(status=401)
+        try:
+            update = Update.model_validate(await request.json(), context={'bot': bot})
+        except Exception:
+            return web.Response(status=400)
+        if not queue.offer(update):
+            # Telegram redelivers on non-2xx, so back-pressure is safe
+            return web.Response(status=503)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(path, handle_update)
+    app.router.add_get(READY_PATH, handle_ready)
+    if PAYMENT_CALLBACK_SECRET:
+        from services.payment_service import payment_callback
+        app.router.add_post(PAYMENT_CALLBACK_PATH, payment_callback)
+    return app
+
+
+async def start_server(app: web.Application, host: str = WEBAPP_HOST, port: int = WEBAPP_PORT) -> web.AppRunner:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, allowed_updates=None):
+    """Serve updates over a webhook until cancelled."""
+    if not WEBHOOK_URL:
+        raise RuntimeError("BOT_MODE=webhook requires WEBHOOK_URL")
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("BOT_MODE=webhook requires WEBHOOK_SECRET")
+    queue = UpdateQueue(dp, bot)
+    runner = None
+    try:
+        # state, indexes and the notifier must be loaded before the first update is handled
+        await dp.emit_startup(bot=bot)
+        queue.start()
+        runner = await start_server(create_app(bot, queue))
+        logger.info("Webhook server listening on %s:%s%s (workers=%s)", WEBAPP_HOST, WEBAPP_PORT, WEBHOOK_PATH, queue.concurrency)
+        await bot.set_webhook(
+            WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=allowed_updates,
+            max_connections=min(100, max(1, queue.concurrency)),
+        )
+        startup.mark('webhook')
+        startup.set_ready()
+        await asyncio.Event().wait()
+    finally:
+        startup.set_not_ready()
+        if runner is not None:
+            await runner.cleanup()
+        await queue.stop()
+        await dp.emit_shutdown(bot=bot)
@@ -0,0 +1,96 @@
+"""Rental fees at the edges: minimums, rounding up, the daily cap, half-up cents and unpriced bikes.
+
+Pins the billing settings so .env does not change the expected numbers. Run from the repo root:
+    python -m tests.billing_test
+"""
+import asyncio
+import datetime
+import os
+
+from tests.support import use_temp_database
+
+use_temp_database()
+os.environ.update({
+    'BILLING_ROUND_MINUTES': '15',
+    'BILLING_MIN_MINUTES': '15',
+    'FEE_DECIMALS': '2',
+    'RENT_PRICE_PER_HOUR': '5.0',
+    'RENT_DAILY_CAP': '0',
+})
+
+START = datetime.datetime(2024, 1, 1, 8, 0)
+
+
+def after(**delta):
+    return START + datetime.timedelta(**delta)
+
+
+def check_fees():
+    from services.billing import billed_minutes, compute_fee
+
+    cases = [
+        # (name, end_at, price_per_hour, daily_cap, minutes, fee)
+        ('0 min', after(), 6.0, 0, 15, 1.5),
+        ('1 min', after(minutes=1), 6.0, 0, 15, 1.5),
+        ('1 s', after(seconds=1), 6.0, 0, 15, 1.5),
+        ('end before start', after(minutes=-5), 6.0, 0, 15, 1.5),
+        ('exactly 15 min', after(minutes=15), 6.0, 0, 15, 1.5),
+        ('15 min 1 s', after(minutes=15, seconds=1), 6.0, 0, 30, 3.0),
+        ('exactly 24 h', after(hours=24), 6.0, 0, 1440, 144.0),
+        ('exactly 24 h, capped', after(hours=24), 6.0, 100, 1440, 100.0),
+        # one capped day, then 1 min rounded up to 15
+        ('24 h 1 min, capped', after(hours=24, minutes=1), 6.0, 100, 1455, 101.5),
+        ('48 h, capped', after(hours=48), 6.0, 100, 2880, 200.0),
+        ('cap above the daily price', after(hours=24, minutes=1), 6.0, 1000, 1455, 145.5),
+        # 4.02 * 15 / 60 = 1.005: half-up gives 1.01, float round() gives 1.0
+        ('half-up', after(minutes=15), 4.02, 0, 15, 1.01),
+        ('half-up, 0.025', after(minutes=15), 0.1, 0, 15, 0.03),
+        ('price 0 is free', after(hours=3), 0.0, 0, 180, 0.0),
+        ('price 0 is free, capped', after(hours=30), 0.0, 100, 1800, 0.0),
+        ('no price: RENT_PRICE_PER_HOUR', after(hours=1), None, 0, 60, 5.0),
+    ]
+    for name, end_at, price, cap, minutes, fee in cases:
+        got_minutes = billed_minutes(START, end_at)
+        got = compute_fee(START, end_at, price, daily_cap=cap)
+        assert got_minutes == minutes, f'{name}: billed {got_minutes} min, expected {minutes}'
+        assert got == fee, f'{name}: fee {got}, expected {fee}'
+    print(f'compute_fee: {len(cases)} cases OK')
+
+
+async def check_rental_close():
+    from database.db import init_db, get_session
+    from sqlalchemy import update
+    from database.models import Bike, Rental, User
+    from database.queries import set_rental_end
+    from services.billing import compute_fee
+
+    await init_db()
+    async with get_session() as s:
+        s.add(User(id=1, telegram_id=1))
+        s.add_all([
+            Bike(id=1, name='free', price_per_hour=0.0),
+            Bike(id=2, name='unpriced'),
+            Bike(id=3, name='priced', price_per_hour=8.0),
+        ])
+        # rental 4's bike was deleted
+        s.add_all([Rental(id=i, user_id=1, bike_id=i, start_at=START) for i in (1, 2, 3, 4)])
+        await s.flush()
+        # the ORM fills in the column default 0.0, so clear the price the way a NULL row would look
+        await s.execute(update(Bike).where(Bike.id == 2).values(price_per_hour=None))
+        await s.commit()
+
+    expected = {1: 0.0, 2: 5.0, 3: 8.0, 4: 0.0}
+    for rental_id, fee in expected.items():
+        closed = await set_rental_end(rental_id, fee_for=compute_fee, end_at=after(hours=1))
+        assert closed.fee == fee, f'rental {rental_id}: fee {closed.fee}, expected {fee}'
+    print('set_rental_end: free, unpriced, priced and deleted bikes OK')
+
+
+def main():
+    check_fees()
+    asyncio.run(check_rental_close())
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
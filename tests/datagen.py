@@ -0,0 +1,203 @@
+"""Synthetic data for the benchmarks: users, referrals, bikes, rentals, payouts and payments.
+
+Dataset(n) decides every row from a seed, so two runs at the same scale see the same
+database. seed() bulk-inserts it and then brings the partner ledger and the stat
+counters in line, the way a live database would have them. Rows for scale n:
+
+- users: n; every 20th is a partner, two thirds were referred (preferential attachment,
+  so a few users have thousands of referrals); id == telegram_id
+- bikes: n // 10, owned by the partners, one of them the main bike
+- rentals: n over the last 90 days; the newest n // 40 are still open, on a quarter of the bikes
+- payouts: n // 10; payments: n // 2, one per closed rental, 5% still pending
+- bike photos: one hash per bike; synthetic_photo() makes JPEGs for tests/photo_bench.py
+"""
+import datetime
+import io
+import random
+from array import array
+
+SCALES = {'10k': 10_000, '100k': 100_000, '1m': 1_000_000}
+
+# around Tashkent, like the coordinates partners share
+LAT, LON = (41.20, 41.40), (69.15, 69.35)
+
+
+def parse_scale(text: str) -> int:
+    """'10k', '1m' or a plain row count."""
+    text = text.strip().lower()
+    if text in SCALES:
+        return SCALES[text]
+    for suffix, factor in (('k', 1_000), ('m', 1_000_000)):
+        if text.endswith(suffix):
+            return int(float(text[:-1]) * factor)
+    return int(text)
+
+
+def referral_graph(n: int, rng, referred: float = 2 / 3):
+    """(referrer, counts) for users 1..n: referrer[i] is None or an earlier user.
+
+    Referrers are picked with preferential attachment: a user who already referred
+    k others is k + 1 times as likely to refer the next one.
+    """
+    referrer = [None] * (n + 1)
+    counts = array('l', [0]) * (n + 1)
+    pool = array('l')  # one entry per user plus one per referral made
+    for i in range(1, n + 1):
+        if pool and rng.random() < referred:
+            r = pool[int(rng.random() * len(pool))]
+            referrer[i] = r
+            counts[r] += 1
+            pool.append(r)
+        pool.append(i)
+    return referrer, counts
+
+
+class Dataset:
+    """Row generators for every table, plus the ids benchmarks need to pick arguments."""
+
+    def __init__(self, n: int, seed: int = 1, now: datetime.datetime = None):
+        self.n = n
+        self.seed = seed
+        self.now = (now or datetime.datetime.utcnow()).replace(microsecond=0)
+        rng = self._rng('users')
+        self.referrer, self.referral_count = referral_graph(n, rng)
+        self.partners = list(range(20, n + 1, 20)) or [1]
+        self.bikes = max(n // 10, 20)
+        self.rentals = n
+        self.payouts = n // 10
+        self.payments = n // 2
+        self.photos = self.bikes  # one per bike
+        # the newest rentals are still open, on bikes 1..open_rentals; every other bike is free
+        self.open_rentals = self.bikes // 4
+        self.first_open = self.rentals - self.open_rentals + 1
+        self.main_bike = self.open_rentals + 1
+        rng = self._rng('rental_users')
+        self.rental_user = array('l', (rng.randint(1, n) for _ in range(self.rentals + 1)))
+
+    def _rng(self, table: str):
+        return random.Random(f'{self.seed}:{table}')
+
+    def top_referrers(self, k: int):
+        return sorted(range(1, self.n + 1), key=self.referral_count.__getitem__)[-k:]
+
+    def is_pending_payment(self, payment_id: int) -> bool:
+        return payment_id % 20 == 0
+
+    def user_rows(self):
+        for i in range(1, self.n + 1):
+            yield {
+                'id': i, 'telegram_id': i, 'is_partner': i % 20 == 0, 'referral_code': f'c{i}',
+                'referrer_id': self.referrer[i], 'referral_count': self.referral_count[i],
+                'first_name': f'user{i}', 'created_at': self.now - datetime.timedelta(seconds=(self.n - i) * 10),
+            }
+
+    def bike_rows(self):
+        rng = self._rng('bikes')
+        for i in range(1, self.bikes + 1):
+            yield {
+                'id': i, 'name': f'bike{i}', 'code': f'B{i}', 'partner_id': self.partners[i % len(self.partners)],
+                'price_per_hour': float(rng.randint(3, 10)), 'available': i > self.open_rentals, 'is_main': i == self.main_bike,
+                'lat': rng.uniform(*LAT), 'lon': rng.uniform(*LON),
+            }
+
+    def rental_rows(self):
+        rng = self._rng('rentals')
+        span = 90 * 24 * 3600
+        for i in range(1, self.rentals + 1):
+            if i >= self.first_open:
+                start = self.now - datetime.timedelta(seconds=rng.uniform(60, 6 * 3600))
+                yield {'id': i, 'user_id': self.rental_user[i], 'bike_id': i - self.first_open + 1, 'start_at': start, 'end_at': None, 'fee': 0.0}
+                continue
+            # ids follow start time, as they do in production
+            start = self.now - datetime.timedelta(seconds=span * (1 - i / self.rentals) + 6 * 3600)
+            minutes = rng.randint(10, 180)
+            yield {
+                'id': i, 'user_id': self.rental_user[i], 'bike_id': rng.randint(1, self.bikes), 'start_at': start,
+                'end_at': start + datetime.timedelta(minutes=minutes), 'fee': round(minutes / 60 * 5.0, 2),
+            }
+
+    def payout_rows(self):
+        rng = self._rng('payouts')
+        for i in range(1, self.payouts + 1):
+            yield {'id': i, 'partner_id': rng.choice(self.partners), 'amount': 1.0,
+                   'created_at': self.now - datetime.timedelta(seconds=rng.uniform(0, 90 * 24 * 3600))}
+
+    def payment_rows(self):
+        rng = self._rng('payments')
+        for i in range(1, self.payments + 1):
+            pending = self.is_pending_payment(i)
+            status = 'pending' if pending else 'failed' if rng.random() < 0.02 else 'captured'
+            created = self.now - datetime.timedelta(seconds=(self.payments - i) * 5 + 60)
+            yield {
+                'id': i, 'idempotency_key': f'rental:{i}:0', 'user_id': self.rental_user[i], 'rental_id': i,
+                'amount': 5.0, 'currency': 'UZS', 'status': status, 'provider': 'fake',
+                'provider_ref': None if pending else f'fake_{i}', 'error': 'card_declined' if status == 'failed' else None,
+                'created_at': created, 'updated_at': created,
+            }
+
+
+    def photo_rows(self):
+        rng = self._rng('photos')
+        for i in range(1, self.photos + 1):
+            yield {
+                'id': i, 'bike_id': i, 'partner_id': self.partners[i % len(self.partners)], 'source_unique_id': f'src{i}',
+                'phash': f'{rng.getrandbits(64):016x}', 'width': 1280, 'height': 960,
+                'thumb_file_id': f'thumb{i}', 'catalog_file_id': f'catalog{i}', 'created_at': self.now,
+            }
+
+
+def synthetic_photo(seed: int, size=(1280, 960), quality: int = 90) -> bytes:
+    """A JPEG with a gradient sky, a ground, a few shapes and sensor noise; different for every seed."""
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(seed)
+    w, h = size
+    image = Image.linear_gradient('L').resize(size).convert('RGB')
+    image = Image.blend(image, Image.new('RGB', size, tuple(rng.randrange(256) for _ in range(3))), 0.6)
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((0, int(h * rng.uniform(0.5, 0.8)), w, h), fill=tuple(rng.randrange(256) for _ in range(3)))
+    for _ in range(12):
+        x, y = rng.randrange(w), rng.randrange(h)
+        r = rng.randrange(w // 40, w // 5)
+        shape = draw.ellipse if rng.random() < 0.5 else draw.rectangle
+        shape((x - r, y - r, x + r, y + r), fill=tuple(rng.randrange(256) for _ in range(3)))
+    noise = Image.effect_noise(size, 24).convert('RGB')
+    image = Image.blend(image, noise, 0.08)
+    out = io.BytesIO()
+    image.save(out, 'JPEG', quality=quality)
+    return out.getvalue()
+
+
+def _chunks(rows, size: int):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+async def seed(data: Dataset, chunk: int = 50_000):
+    """Insert data into the configured database (tables must exist and be empty)."""
+    from sqlalchemy import insert
+    from database.db import engine
+    from database.models import Bike, BikePhoto, Payment, Payout, Rental, User
+    from database.queries import reconcile_partner_ledger, reconcile_stat_counters
+
+    tables = ((User, data.user_rows), (Bike, data.bike_rows), (Rental, data.rental_rows),
+              (Payout, data.payout_rows), (Payment, data.payment_rows), (BikePhoto, data.photo_rows))
+    async with engine.begin() as conn:
+        for model, rows in tables:
+            for batch in _chunks(rows(), chunk):
+                await conn.execute(insert(model), batch)
+        if engine.dialect.name == 'postgresql':
+            # ids were inserted explicitly; move the sequences past them
+            for model, _ in tables:
+                name = model.__tablename__
+                await conn.exec_driver_sql(f"SELECT setval(pg_get_serial_sequence('{name}', 'id'), (SELECT max(id) FROM {name}))")
+    await reconcile_partner_ledger(fix=True)
+    await reconcile_stat_counters(fix=True)
+    async with engine.begin() as conn:
+        await conn.exec_driver_sql('ANALYZE')
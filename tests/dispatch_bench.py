@@ -0,0 +1,117 @@
+"""Update-throughput microbenchmark: filter/catch-all router chain vs the dispatch tables.
+
+Handlers are no-ops, so only routing cost is measured.
+Run from the repo root:  python -m tests.dispatch_bench -n 20000
+"""
+import argparse
+import asyncio
+import os
+import time
+
+os.environ.setdefault('STATE_STORAGE_URL', 'memory://')
+
+ADMIN_COMMANDS = ['admin', 'stats', 'list_rentals', 'assign_bike', 'set_main', 'pay_partner', 'partner_earnings']
+STEPS = ['name', 'phone', 'city', 'location', 'passport', 'photo']
+
+
+async def noop(message, **kwargs):
+    return None
+
+
+def legacy_routers(customer_state: dict, partner_state: dict, skip_when_idle: bool):
+    """The pre-dispatch router chain from bot.py: start, customer, partner, admin."""
+    from aiogram import Router
+    from aiogram.dispatcher.event.bases import SkipHandler
+    from aiogram.filters import Command
+
+    start, customer, partner, admin = Router(), Router(), Router(), Router()
+    start.message(Command('start'))(noop)
+
+    def catch_all(states):
+        async def steps(message, **kwargs):
+            if not states.get(message.from_user.id):
+                if skip_when_idle:
+                    raise SkipHandler()
+                return None
+        return steps
+
+    customer.message(lambda msg: msg.text and 'ijaraga' in msg.text.lower())(noop)
+    customer.message()(catch_all(customer_state))
+    partner.message(lambda msg: msg.text and 'hamkor' in msg.text.lower())(noop)
+    partner.message()(catch_all(partner_state))
+    partner.message(lambda msg: msg.text and msg.text.startswith('/my_earnings'))(noop)
+    for name in ADMIN_COMMANDS:
+        admin.message(lambda msg, p='/' + name: msg.text and msg.text.startswith(p))(noop)
+    return [start, customer, partner, admin]
+
+
+def table_router(store):
+    from handlers.dispatch import MessageDispatch
+
+    table = MessageDispatch(store=store)
+    table.command('start', 'my_earnings', *ADMIN_COMMANDS)(noop)
+    table.keyword('ijaraga')(noop)
+    table.keyword('hamkor')(noop)
+    for flow in ('customer', 'partner'):
+        for s in STEPS:
+            table.step(flow, s)(noop)
+    return table.router
+
+
+def workload(n: int):
+    from aiogram.types import Update
+    texts = ['/start', '/stats', '/partner_earnings 5', 'Ijaraga olish', 'Hamkorlik', 'Ali Valiyev', '+998901234567', 'salom']
+    updates = []
+    for i in range(n):
+        uid = 1000 + i % 200  # users 1000..1099 are mid-wizard
+        updates.append(Update.model_validate({
+            'update_id': i,
+            'message': {
+                'message_id': i, 'date': 0,
+                'chat': {'id': uid, 'type': 'private'},
+                'from': {'id': uid, 'is_bot': False, 'first_name': 'U'},
+                'text': texts[i % len(texts)],
+            },
+        }))
+    return updates
+
+
+async def run(label: str, routers, updates):
+    from aiogram import Bot, Dispatcher
+    from tests.mock_session import MockSession
+
+    dp = Dispatcher()
+    for r in routers:
+        dp.include_router(r)
+    bot = Bot(token='42:MOCK', session=MockSession())
+    for u in updates[:500]:
+        await dp.feed_update(bot, u)
+    t0 = time.perf_counter()
+    for u in updates:
+        await dp.feed_update(bot, u)
+    elapsed = time.perf_counter() - t0
+    print(f'{label}: {len(updates) / elapsed:,.0f} updates/s ({elapsed / len(updates) * 1e6:.1f} us/update)')
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=20000)
+    args = parser.parse_args()
+
+    from utils.state_storage import StateStore
+
+    updates = workload(args.n)
+    in_flow = range(1000, 1100)
+    customer_state = {uid: {'step': 'phone'} for uid in in_flow if uid % 2}
+    partner_state = {uid: {'step': 'phone'} for uid in in_flow if not uid % 2}
+    store = StateStore(ttl=3600, max_entries=10000)
+    for uid in in_flow:
+        await store.set(uid, {'flow': 'customer' if uid % 2 else 'partner', 'step': 'phone'})
+
+    await run('router chain (as shipped, catch-all swallows)', legacy_routers(customer_state, partner_state, False), updates)
+    await run('router chain (catch-alls skip when idle)', legacy_routers(customer_state, partner_state, True), updates)
+    await run('dispatch tables', [table_router(store)], updates)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
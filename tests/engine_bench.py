@@ -0,0 +1,89 @@
+"""Concurrent rental throughput under each engine profile (database/db.py ENGINE_PROFILES).
+
+Every profile runs in a fresh subprocess against a fresh database: writers create users
+and rentals while readers page through /list_rentals.
+
+Run from the repo root:  python -m tests.engine_bench -n 2000 -c 32
+PostgreSQL is included when BENCH_PG_URL is set (postgresql+asyncpg://...; its tables are dropped).
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+from tests.support import percentiles, temp_db_url
+
+
+async def run_profile(n: int, concurrency: int, readers: int):
+    from sqlalchemy import insert
+    from database.db import Base, engine, init_db
+    from database.models import Bike
+    from database.queries import create_rental, get_or_create_user, list_rentals_page
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+    await init_db()
+    async with engine.begin() as conn:
+        await conn.execute(insert(Bike), [{'name': f'b{i}', 'available': True} for i in range(n)])
+
+    errors = 0
+    read_latencies = []
+    todo = iter(range(1, n + 1))
+    done = asyncio.Event()
+
+    async def writer():
+        nonlocal errors
+        for i in todo:
+            try:
+                user = await get_or_create_user(1_000_000 + i)
+                await create_rental(user.id, i)
+            except Exception:
+                errors += 1
+
+    async def reader():
+        while not done.is_set():
+            t0 = time.perf_counter()
+            await list_rentals_page(status='active')
+            read_latencies.append((time.perf_counter() - t0) * 1000)
+            await asyncio.sleep(0)
+
+    read_tasks = [asyncio.create_task(reader()) for _ in range(readers)]
+    t0 = time.perf_counter()
+    await asyncio.gather(*(writer() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - t0
+    done.set()
+    await asyncio.gather(*read_tasks)
+    await engine.dispose()
+    q = percentiles(read_latencies)
+    return {'rentals_per_s': round(n / elapsed, 1), 'errors': errors, 'reads': len(read_latencies), 'read_p50_ms': round(q['p50'], 2), 'read_p95_ms': round(q['p95'], 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=2000, help='rentals per profile')
+    parser.add_argument('-c', type=int, default=32, help='concurrent writers')
+    parser.add_argument('-r', type=int, default=4, help='concurrent readers')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(asyncio.run(run_profile(args.n, args.c, args.r))))
+        return
+
+    runs = [('sqlite', 'default'), ('sqlite', 'sqlite')]
+    if os.getenv('BENCH_PG_URL'):
+        runs += [('postgresql', 'default'), ('postgresql', 'postgresql')]
+    for backend, profile in runs:
+        url = os.environ['BENCH_PG_URL'] if backend == 'postgresql' else temp_db_url()
+        env = dict(os.environ, DATABASE_URL=url, DB_PROFILE=profile)
+        out = subprocess.run([sys.executable, '-m', 'tests.engine_bench', '--child', '-n', str(args.n), '-c', str(args.c), '-r', str(args.r)],
+                             env=env, capture_output=True, text=True, check=True).stdout
+        result = json.loads(out.strip().splitlines()[-1])
+        print(f"{backend:10s} profile={profile:10s} " + ' '.join(f'{k}={v}' for k, v in result.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+"""Check that every query in database/queries.py is answered from an index, not a full table scan.
+
+Each public function runs against a seeded SQLite database while the statements it
+sends are recorded; every SELECT/UPDATE/DELETE is then run through EXPLAIN QUERY PLAN.
+A scan in index order that stops at a LIMIT (keyset pages) counts as bounded.
+Scanning the rows of a recursive CTE (referral trees) is not a table scan.
+Functions that read whole tables on purpose are listed in FULL_SCAN_OK.
+
+Run from the repo root:  python -m tests.explain_test
+"""
+import asyncio
+import contextvars
+import datetime
+import inspect
+import re
+import sys
+
+from tests.support import use_temp_database
+
+use_temp_database()
+
+# function -> why reading every row is expected
+FULL_SCAN_OK = {
+    'list_rentals': 'returns every rental',
+    'iter_rentals': 'CSV export of every rental',
+    'iter_bikes': 'loads the bike availability index',
+    'iter_bike_photo_hashes': 'loads the duplicate photo index',
+    'admin_stats': 'stat_counters holds one row per counter',
+    'bulk_upsert_users': 'recounts users (and referrals, when referrer_id is imported) after an import',
+    'reconcile_stat_counters': 'background check against full-table counts',
+    'reconcile_partner_ledger': 'background check against full-table sums',
+    'run_partner_payouts': 'pays every partner with a balance (one ledger row each)',
+}
+
+FULL_SCAN = re.compile(r'^SCAN (\w+)$')
+# scanning a CTE's own rows (recursive queries) is not a table scan
+CTE_NAME = re.compile(r'\bWITH (?:RECURSIVE )?(\w+)')
+
+current = contextvars.ContextVar('current', default=None)
+
+
+async def seed():
+    from sqlalchemy import insert
+    from database.db import engine
+    from database.models import User, Bike, BikePhoto, Rental, Payout, Payment
+
+    now = datetime.datetime.utcnow()
+    async with engine.begin() as conn:
+        await conn.execute(insert(User), [
+            {'telegram_id': 10_000 + i, 'referral_code': f'c{i}', 'is_partner': i < 50, 'created_at': now,
+             'referrer_id': i // 4 if i >= 4 else None, 'referral_count': 4 if i < 500 else 0}
+            for i in range(2000)
+        ])
+        await conn.execute(insert(Bike), [{'name': f'b{i}', 'partner_id': i % 50 + 1, 'available': i % 20 == 0, 'price_per_hour': 5.0} for i in range(500)])
+        await conn.execute(insert(Rental), [
+            {'user_id': i % 2000 + 1, 'bike_id': i % 500 + 1, 'start_at': now - datetime.timedelta(hours=i), 'end_at': None if i % 50 == 0 else now, 'fee': 1.0}
+            for i in range(5000)
+        ])
+        await conn.execute(insert(Payout), [{'partner_id': i % 50 + 1, 'amount': 1.0, 'created_at': now} for i in range(500)])
+        await conn.execute(insert(Payment), [
+            {'idempotency_key': f'k{i}', 'user_id': i % 2000 + 1, 'rental_id': i + 1, 'amount': 1.0, 'currency': 'UZS', 'provider': 'fake',
+             'provider_ref': f'r{i}', 'status': 'pending' if i % 100 == 0 else 'captured', 'created_at': now - datetime.timedelta(minutes=i)}
+            for i in range(3000)
+        ])
+        await conn.execute(insert(BikePhoto), [
+            {'bike_id': i + 1, 'partner_id': i % 50 + 1, 'source_unique_id': f'u{i}', 'phash': f'{i * 2654435761 % 2**64:016x}', 'created_at': now}
+            for i in range(500)
+        ])
+
+
+async def exercise(q):
+    """Call every public query function at least once; returns the names called."""
+    calls = [
+        ('get_or_create_user', lambda: q.get_or_create_user(10_001)),
+        ('get_or_create_user', lambda: q.get_or_create_user(99_999, ref_code='c3')),
+        ('bulk_upsert_users', lambda: q.bulk_upsert_users([{'telegram_id': 10_002, 'phone': '+998'}])),
+        ('bulk_upsert_users', lambda: q.bulk_upsert_users([{'telegram_id': 10_006, 'referrer_id': 2}])),
+        ('iter_user_telegram_ids', lambda: _drain(q.iter_user_telegram_ids())),
+        ('set_referrer', lambda: q.set_referrer(10_003, 'c1')),
+        ('count_referrals', lambda: q.count_referrals(10_001)),
+        ('referral_tree', lambda: q.referral_tree(10_001)),
+        ('referral_tree_counts', lambda: q.referral_tree_counts(10_001)),
+        ('top_referrers', lambda: q.top_referrers()),
+        ('admin_stats', lambda: q.admin_stats()),
+        ('reconcile_stat_counters', lambda: q.reconcile_stat_counters()),
+        ('list_available_bikes', lambda: q.list_available_bikes()),
+        ('create_rental', lambda: q.create_rental(5, 21)),
+        ('update_user_profile', lambda: q.update_user_profile(10_004, first_name='A')),
+        ('register_partner', lambda: q.register_partner(10_005)),
+        ('create_bike_for_partner', lambda: q.create_bike_for_partner(1, 'new', 3.0, code='X1')),
+        ('iter_bikes', lambda: _drain(q.iter_bikes())),
+        ('iter_available_bike_locations', lambda: _drain(q.iter_available_bike_locations())),
+        ('pick_available_bike', lambda: q.pick_available_bike()),
+        ('set_main_bike', lambda: q.set_main_bike(41)),
+        ('pick_main_bike', lambda: q.pick_main_bike()),
+        ('get_rental_by_id', lambda: q.get_rental_by_id(7)),
+        ('get_user_by_db_id', lambda: q.get_user_by_db_id(7)),
+        ('assign_bike_to_rental', lambda: q.assign_bike_to_rental(8, 61)),
+        ('set_rental_end', lambda: q.set_rental_end(51, 2)),
+        ('get_active_rental', lambda: q.get_active_rental(52)),
+        ('get_last_closed_rental', lambda: q.get_last_closed_rental(52)),
+        ('iter_active_rentals', lambda: _drain(q.iter_active_rentals())),
+        ('list_rentals', lambda: q.list_rentals()),
+        ('list_rentals_page', lambda: q.list_rentals_page()),
+        ('list_rentals_page', lambda: q.list_rentals_page(after_id=2500, status='active')),
+        ('list_rentals_page', lambda: q.list_rentals_page(before_id=2500, status='closed')),
+        ('list_rentals_page', lambda: q.list_rentals_page(day=datetime.date.today())),
+        ('iter_rentals', lambda: _drain(q.iter_rentals())),
+        ('iter_rentals', lambda: _drain(q.iter_rentals(status='active'))),
+        ('partner_earnings', lambda: q.partner_earnings(3)),
+        ('record_payout', lambda: q.record_payout(3, 2.0)),
+        ('run_partner_payouts', lambda: q.run_partner_payouts(1.0)),
+        ('list_partner_payouts', lambda: q.list_partner_payouts(3)),
+        ('partner_balance', lambda: q.partner_balance(3)),
+        ('reconcile_partner_ledger', lambda: q.reconcile_partner_ledger()),
+        ('create_payment_intent', lambda: q.create_payment_intent('new', 5, 2.0, 'UZS', 'fake', rental_id=9)),
+        ('create_payment_intent', lambda: q.create_payment_intent('k5', 5, 2.0, 'UZS', 'fake')),
+        ('get_payment', lambda: q.get_payment(5)),
+        ('get_payment_by_key', lambda: q.get_payment_by_key('k7')),
+        ('list_rental_payments', lambda: q.list_rental_payments(9)),
+        ('set_payment_provider_ref', lambda: q.set_payment_provider_ref(3001, 'r-new')),
+        ('transition_payment', lambda: q.transition_payment(3001, 'captured')),
+        ('list_pending_payments', lambda: q.list_pending_payments(datetime.datetime.utcnow())),
+        ('add_bike_photo', lambda: q.add_bike_photo(3, 4, 'u-new', '00ff00ff00ff00ff', 1280, 960, duplicate_of=2, catalog_file_id='c')),
+        ('get_bike_photo_by_source', lambda: q.get_bike_photo_by_source('u7')),
+        ('iter_bike_photo_hashes', lambda: _drain(q.iter_bike_photo_hashes())),
+    ]
+    for name, call in calls:
+        q.user_cache.clear()
+        token = current.set(name)
+        try:
+            await call()
+        finally:
+            current.reset(token)
+    return {name for name, _ in calls}
+
+
+async def _drain(gen):
+    async for _ in gen:
+        pass
+
+
+async def main():
+    from sqlalchemy import event
+    from database.db import init_db, engine, read_engine
+    import database.queries as q
+
+    await init_db()
+    await seed()
+    async with engine.begin() as conn:
+        await conn.exec_driver_sql('ANALYZE')
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if current.get() and statement.lstrip().split(None, 1)[0].upper() in ('SELECT', 'UPDATE', 'DELETE', 'WITH'):
+            # executemany: one parameter set is enough for the plan
+            statements.append((current.get(), statement, parameters[0] if executemany else parameters))
+
+    # the iter_* streams run on the read engine
+    engines = {engine.sync_engine, read_engine.sync_engine}
+    for sync in engines:
+        event.listen(sync, 'before_cursor_execute', record)
+    called = await exercise(q)
+    for sync in engines:
+        event.remove(sync, 'before_cursor_execute', record)
+
+    public = {name for name, fn in inspect.getmembers(q, inspect.iscoroutinefunction) if fn.__module__ == q.__name__ and not name.startswith('_')}
+    public |= {name for name, fn in inspect.getmembers(q, inspect.isasyncgenfunction) if fn.__module__ == q.__name__ and not name.startswith('_')}
+    failures = [f'{name}: not exercised by this check' for name in sorted(public - called)]
+
+    seen = set()
+    async with engine.connect() as conn:
+        for name, statement, params in statements:
+            if (name, statement) in seen:
+                continue
+            seen.add((name, statement))
+            plan = [row[-1] for row in (await conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, params)).all()]
+            ctes = set(CTE_NAME.findall(statement))
+            scans = [m.group(1) for m in map(FULL_SCAN.match, plan) if m and m.group(1) not in ctes]
+            if scans and ' LIMIT ' in statement and not any('TEMP B-TREE' in p for p in plan):
+                scans = []  # walks the primary key in ORDER BY order and stops at the limit
+            status = 'ok'
+            if scans:
+                status = f'full scan allowed ({FULL_SCAN_OK[name]})' if name in FULL_SCAN_OK else 'FULL SCAN'
+                if name not in FULL_SCAN_OK:
+                    failures.append(f"{name}: full scan of {', '.join(scans)}\n    {' '.join(statement.split())}")
+            print(f"{name:30s} {status:12s} {' | '.join(plan)}")
+
+    if failures:
+        print('\nFAILED:\n' + '\n'.join(failures))
+        sys.exit(1)
+    print(f'\nOK: {len(called)} functions, {len(seen)} distinct statements')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
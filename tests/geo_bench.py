@@ -0,0 +1,66 @@
+"""Nearest-available-bike lookups on the in-memory grid index (services/location.py).
+
+Bikes are spread over a 40 x 40 km city; each size is checked against a brute-force
+scan for a sample of queries before it is timed.
+
+Run from the repo root:  python -m tests.geo_bench --sizes 10000 100000 1000000
+"""
+import argparse
+import random
+import time
+
+from tests.support import percentiles
+
+CITY = (41.15, 41.50, 69.05, 69.50)  # lat_min, lat_max, lon_min, lon_max (roughly Tashkent)
+
+
+def random_point(rng):
+    return rng.uniform(CITY[0], CITY[1]), rng.uniform(CITY[2], CITY[3])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('-k', type=int, default=5)
+    parser.add_argument('--queries', type=int, default=20_000)
+    parser.add_argument('--cell', type=float, default=None, help='grid cell in degrees (default GEO_CELL_DEG)')
+    args = parser.parse_args()
+
+    from services.location import GeoIndex, distance_km
+
+    rng = random.Random(42)
+    for n in args.sizes:
+        bikes = [(i, *random_point(rng)) for i in range(1, n + 1)]
+        index = GeoIndex(args.cell) if args.cell else GeoIndex()
+        t0 = time.perf_counter()
+        for bike_id, lat, lon in bikes:
+            index.add(bike_id, lat, lon)
+        build = time.perf_counter() - t0
+
+        for _ in range(50):
+            lat, lon = random_point(rng)
+            want = sorted((distance_km(lat, lon, blat, blon), bid) for bid, blat, blon in bikes)[:args.k]
+            got = index.nearest(lat, lon, args.k)
+            assert [b for _, b in got] == [b for _, b in want], (got, want)
+
+        latencies = []
+        for _ in range(args.queries):
+            lat, lon = random_point(rng)
+            t0 = time.perf_counter()
+            index.nearest(lat, lon, args.k)
+            latencies.append((time.perf_counter() - t0) * 1e6)
+
+        # a rental and a return: remove + add
+        t0 = time.perf_counter()
+        for bike_id, lat, lon in bikes[:10_000]:
+            index.remove(bike_id)
+            index.add(bike_id, lat, lon)
+        churn = (time.perf_counter() - t0) / min(n, 10_000) * 1e6
+
+        q = percentiles(latencies)
+        print(f'{n:>9,} bikes: build {build:.2f} s, k={args.k} nearest p50={q["p50"]:.1f} us p95={q["p95"]:.1f} us '
+              f'p99={q["p99"]:.1f} us, remove+add {churn:.1f} us')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+"""Offline end-to-end load test: scripted users driven through the real dispatcher.
+
+Builds the dispatcher exactly as bot.py does (build_dispatcher, startup hooks included)
+on a database seeded by tests/datagen.py. Telegram is replaced by a MockSession that
+records outgoing calls and answers after --api-latency. Every synthetic user then
+plays a script through Dispatcher.feed_update, one update after the other, with
+-c users active at a time:
+
+- start: /start from a new user (every third one with a referral link) or a known one
+- customer: /start, the rental wizard down to a reserved bike, /end_rental, /pay, /my_referrals
+- partner: /start and the partner wizard down to the bike photo, then /my_earnings
+- admin: /admin, /stats, /list_rentals (all and active), /partner_earnings, /top
+
+Reports updates per second, latency percentiles per handler (the whole update,
+session commit included), SQL statements per handler and latency per statement
+(verb and table), and the Bot API calls made.
+
+Run from the repo root:  python -m tests.load_test --scenario mix -u 2000 -c 50 --api-latency 0.05
+"""
+import argparse
+import asyncio
+import contextvars
+import json
+import random
+import time
+from collections import Counter, defaultdict
+
+from tests.support import percentiles, use_temp_database
+
+ADMIN_ID = 1
+use_temp_database(admin_ids=str(ADMIN_ID))
+
+SCENARIOS = ('start', 'customer', 'partner', 'admin')
+# share of the users playing each script in the mix scenario
+MIX = {'start': 50, 'customer': 30, 'partner': 10, 'admin': 10}
+
+# the update being processed: {'handler': label, 'sql': [(statement label, seconds), ...]}
+current = contextvars.ContextVar('current', default=None)
+
+class Scripts:
+    """Builds the update dicts each synthetic user sends."""
+
+    def __init__(self, data, rng):
+        self.data = data
+        self.rng = rng
+        self.update_id = 0
+        self.next_user = 10_000_000  # above every seeded telegram_id
+
+    def new_user(self) -> int:
+        self.next_user += 1
+        return self.next_user
+
+    def message(self, uid: int, text: str = None, location=None, photo: str = None) -> dict:
+        self.update_id += 1
+        m = {'message_id': self.update_id, 'date': int(time.time()), 'chat': {'id': uid, 'type': 'private'},
+             'from': {'id': uid, 'is_bot': False, 'first_name': f'U{uid}'}}
+        if text is not None:
+            m['text'] = text
+        if location is not None:
+            m['location'] = {'latitude': location[0], 'longitude': location[1]}
+        if photo is not None:
+            m['photo'] = [{'file_id': photo, 'file_unique_id': 'u' + photo, 'width': 800, 'height': 600}]
+        return {'update_id': self.update_id, 'message': m}
+
+    def location(self):
+        from tests.datagen import LAT, LON
+        return self.rng.uniform(*LAT), self.rng.uniform(*LON)
+
+    def start(self):
+        if self.rng.random() < 0.2:
+            return [self.message(self.rng.randint(2, self.data.n), '/start')]
+        uid = self.new_user()
+        if uid % 3 == 0:
+            code = f'c{self.rng.randint(1, self.data.n)}'
+            return [self.message(uid, f'/start https://t.me/velobike_bot?start=ref%3D{code}')]
+        return [self.message(uid, '/start')]
+
+    def customer(self):
+        uid = self.new_user()
+        texts = ['/start', 'Ijaraga olish', 'Ali Valiyev', f'+99890{uid % 10_000_000:07d}', 'Tashkent', None, f'AA{uid % 10_000_000:07d}',
+                 '/end_rental', '/pay', '/my_referrals']
+        return [self.message(uid, t) if t is not None else self.message(uid, location=self.location()) for t in texts]
+
+    def partner(self):
+        uid = self.new_user()
+        texts = ['/start', 'Hamkorlik', 'Bob Smith', f'+99891{uid % 10_000_000:07d}', 'Namangan', None, f'BB{uid % 10_000_000:07d}']
+        updates = [self.message(uid, t) if t is not None else self.message(uid, location=self.location()) for t in texts]
+        return updates + [self.message(uid, photo=f'photo{uid}'), self.message(uid, '/my_earnings')]
+
+    def admin(self):
+        partner = self.rng.choice(self.data.partners)
+        texts = ['/admin', '/stats', '/list_rentals', '/list_rentals active', f'/partner_earnings {partner}', '/top']
+        return [self.message(ADMIN_ID, t) for t in texts]
+
+    def build(self, scenario: str, users: int):
+        if scenario == 'mix':
+            kinds = self.rng.choices(list(MIX), weights=list(MIX.values()), k=users)
+        else:
+            kinds = [scenario] * users
+        return [(kind, getattr(self, kind)()) for kind in kinds]
+
+
+def instrument_handlers(table):
+    """Wrap every dispatch-table callback so the update records which handler took it."""
+    handlers = {id(h): h for h in (*table.commands.values(), *table.steps.values(), *(h for _, h in table.keywords))}
+    for h in handlers.values():
+        def wrap(callback, label=h.label):
+            async def timed(*args, **kwargs):
+                slot = current.get()
+                if slot is not None:
+                    slot['handler'] = label
+                return await callback(*args, **kwargs)
+            return timed
+        h.callback = wrap(h.callback)
+
+
+def latency(seconds: list) -> dict:
+    return dict({f'{k}_ms': round(v, 3) for k, v in percentiles(seconds, 1000).items()}, count=len(seconds))
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenario', choices=SCENARIOS + ('mix',), default='mix')
+    parser.add_argument('-u', '--users', type=int, default=2000, help='synthetic users, each playing one script')
+    parser.add_argument('-c', '--concurrency', type=int, default=50, help='users active at a time')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='seconds each Bot API call takes')
+    parser.add_argument('--scale', default='10k', help='seeded database (tests/datagen.py scale)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='write the report here')
+    args = parser.parse_args()
+
+    from aiogram import Bot
+    from aiogram.types import Update
+    from sqlalchemy import event
+    from bot import build_dispatcher
+    from database.db import engine, init_db
+    from handlers.dispatch import table
+    from tests.datagen import Dataset, parse_scale, seed, synthetic_photo
+    from services.metrics import statement_label
+    from tests.mock_session import MockSession
+    from utils.logger import logger
+
+    logger.setLevel('WARNING')
+    await init_db()
+    data = Dataset(parse_scale(args.scale), seed=args.seed)
+    await seed(data)
+
+    session = MockSession(api_latency=args.api_latency)
+    bot = Bot('42:LOAD', session=session)
+    dp = build_dispatcher()
+    instrument_handlers(table)
+    await dp.emit_startup(bot=bot)
+
+    scripts = Scripts(data, random.Random(args.seed)).build(args.scenario, args.users)
+    scripts = [(kind, [Update.model_validate(u, context={'bot': bot}) for u in updates]) for kind, updates in scripts]
+    # the bike photos partners send, for services/photos.py to download
+    photo = synthetic_photo(args.seed)
+    for _, updates in scripts:
+        for update in updates:
+            if update.message and update.message.photo:
+                session.files[update.message.photo[-1].file_id] = photo
+    total = sum(len(updates) for _, updates in scripts)
+
+    def before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('load_t0', []).append(time.perf_counter())
+
+    def after(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['load_t0'].pop()
+        slot = current.get()
+        if slot is not None:
+            slot['sql'].append((statement_label(statement), elapsed))
+
+    by_handler = defaultdict(list)
+    sql_by_handler = Counter()
+    sql_time_by_handler = Counter()
+    statements = defaultdict(list)
+    errors = Counter()
+    latencies = []
+    sem = asyncio.Semaphore(args.concurrency)
+
+    async def play(updates):
+        async with sem:
+            for update in updates:
+                slot = {'sql': []}
+                token = current.set(slot)
+                t0 = time.perf_counter()
+                try:
+                    await dp.feed_update(bot, update)
+                except Exception as e:
+                    errors[f"{slot.get('handler', '(unhandled)')}: {e!r}"[:200]] += 1
+                finally:
+                    current.reset(token)
+                elapsed = time.perf_counter() - t0
+                handler = slot.get('handler', '(unhandled)')
+                latencies.append(elapsed)
+                by_handler[handler].append(elapsed)
+                sql_by_handler[handler] += len(slot['sql'])
+                for label, seconds in slot['sql']:
+                    statements[label].append(seconds)
+                    sql_time_by_handler[handler] += seconds
+
+    event.listen(engine.sync_engine, 'before_cursor_execute', before)
+    event.listen(engine.sync_engine, 'after_cursor_execute', after)
+    t0 = time.perf_counter()
+    await asyncio.gather(*(play(updates) for _, updates in scripts))
+    wall = time.perf_counter() - t0
+    event.remove(engine.sync_engine, 'before_cursor_execute', before)
+    event.remove(engine.sync_engine, 'after_cursor_execute', after)
+    await dp.emit_shutdown(bot=bot)
+    await engine.dispose()
+
+    mix = Counter(kind for kind, _ in scripts)
+    api_calls = Counter(type(c).__name__ for c in session.calls)
+    report = {
+        'scenario': args.scenario, 'users': dict(mix), 'updates': total, 'concurrency': args.concurrency,
+        'api_latency': args.api_latency, 'wall_s': round(wall, 3), 'updates_per_s': round(total / wall, 1),
+        'latency': latency(latencies), 'errors': dict(errors), 'api_calls': dict(api_calls),
+        'handlers': {
+            h: dict(latency(v), sql_per_update=round(sql_by_handler[h] / len(v), 2), sql_ms_per_update=round(sql_time_by_handler[h] / len(v) * 1000, 3))
+            for h, v in sorted(by_handler.items())
+        },
+        'statements': {label: dict(latency(v), total_s=round(sum(v), 3)) for label, v in sorted(statements.items())},
+    }
+
+    print(f"{args.scenario}: {dict(mix)} users, {total:,} updates in {wall:.2f} s = {report['updates_per_s']:,.0f} updates/s "
+          f"at concurrency {args.concurrency}, api latency {args.api_latency * 1000:.0f} ms")
+    lat = report['latency']
+    print(f"per update: p50={lat['p50_ms']:.2f} ms p95={lat['p95_ms']:.2f} ms p99={lat['p99_ms']:.2f} ms max={lat['max_ms']:.2f} ms")
+    print(f"\n{'handler':28s} {'updates':>8s} {'p50 ms':>9s} {'p95 ms':>9s} {'p99 ms':>9s} {'SQL/upd':>8s} {'SQL ms/upd':>10s}")
+    for h, s in report['handlers'].items():
+        print(f"{h:28s} {s['count']:8d} {s['p50_ms']:9.2f} {s['p95_ms']:9.2f} {s['p99_ms']:9.2f} {s['sql_per_update']:8.2f} {s['sql_ms_per_update']:10.3f}")
+    print(f"\n{'statement':28s} {'count':>8s} {'p50 ms':>9s} {'p95 ms':>9s} {'p99 ms':>9s} {'total s':>8s}")
+    for label, s in sorted(report['statements'].items(), key=lambda kv: -kv[1]['total_s']):
+        print(f"{label:28s} {s['count']:8d} {s['p50_ms']:9.3f} {s['p95_ms']:9.3f} {s['p99_ms']:9.3f} {s['total_s']:8.2f}")
+    print(f"\nBot API calls: {dict(api_calls)}")
+    if errors:
+        print(f'errors: {dict(errors)}')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=1)
+    assert not errors
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
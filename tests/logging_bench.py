@@ -0,0 +1,124 @@
+"""Handler latency with logging under load: a synchronous StreamHandler vs the queue pipeline.
+
+Simulated handlers (-c at a time) each await --io seconds, as if talking to the database and
+Telegram, and log an INFO line and a DEBUG line per update. Every --error-every-th update
+fails and is logged with logger.exception, as in an error storm. Log output goes to a sink that
+takes --sink-latency seconds per write, like a container log pipe under backpressure.
+
+Each mode reports per-update latency and the event loop lag: how late a 1 ms timer fires.
+With the synchronous handler, every write blocks the loop, and every other user waits too.
+
+Run from the repo root:  python -m tests.logging_bench -n 5000 -c 100 --sink-latency 0.001
+"""
+import argparse
+import asyncio
+import logging
+import time
+
+from tests.support import percentiles
+
+
+class SlowSink:
+    """File-like sink whose writes block the calling thread for latency seconds."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.writes = 0
+
+    def write(self, text: str):
+        self.writes += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def flush(self):
+        pass
+
+
+def summary(ms: list) -> str:
+    return ' '.join(f'{k}={v:.2f}' for k, v in percentiles(ms).items()) + ' ms'
+
+
+async def run(log: logging.Logger, args) -> dict:
+    latencies = []
+    lag = []
+    done = asyncio.Event()
+
+    async def probe():
+        while not done.is_set():
+            t0 = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lag.append((time.perf_counter() - t0 - 0.001) * 1000)
+
+    async def handle(i: int):
+        t0 = time.perf_counter()
+        await asyncio.sleep(args.io)
+        log.info("Update %d from user %d", i, i % 997)
+        log.debug("Update %d state %s", i, {'flow': 'customer', 'step': 'phone'})
+        if args.error_every and i % args.error_every == 0:
+            try:
+                raise RuntimeError(f'provider timeout for update {i}')
+            except RuntimeError:
+                log.exception("Payment failed for update %d", i)
+        latencies.append((time.perf_counter() - t0) * 1000)
+
+    sem = asyncio.Semaphore(args.concurrency)
+
+    async def limited(i: int):
+        async with sem:
+            await handle(i)
+
+    probe_task = asyncio.create_task(probe())
+    t0 = time.perf_counter()
+    await asyncio.gather(*(limited(i) for i in range(1, args.updates + 1)))
+    wall = time.perf_counter() - t0
+    done.set()
+    await probe_task
+    return {'wall': wall, 'latency': latencies, 'lag': lag}
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--updates', type=int, default=5000)
+    parser.add_argument('-c', '--concurrency', type=int, default=100)
+    parser.add_argument('--io', type=float, default=0.005, help='seconds each handler awaits')
+    parser.add_argument('--sink-latency', type=float, default=0.001, help='seconds each log write blocks')
+    parser.add_argument('--error-every', type=int, default=10, help='every n-th update logs an exception (0 = none)')
+    parser.add_argument('--debug-sample', type=float, default=0.01, help='share of DEBUG records kept by the pipeline')
+    parser.add_argument('--repeat-limit', type=int, default=5, help='same error written at most this often per minute (0 = no limit)')
+    parser.add_argument('--mode', choices=('sync', 'queue', 'both'), default='both')
+    args = parser.parse_args()
+
+    from utils.logger import ContextFilter, TextFormatter, attach, stop
+
+    modes = ('sync', 'queue') if args.mode == 'both' else (args.mode,)
+    for mode in modes:
+        sink = SlowSink(args.sink_latency)
+        log = logging.getLogger(f'bench.{mode}')
+        log.propagate = False
+        log.setLevel(logging.DEBUG)
+        listener = None
+        if mode == 'sync':
+            # the pipeline this replaces: a StreamHandler writing on the caller's thread
+            handler = logging.StreamHandler(sink)
+            handler.setFormatter(TextFormatter())
+            log.addHandler(handler)
+        else:
+            context_filter = ContextFilter(debug_sample=args.debug_sample, repeat_limit=args.repeat_limit)
+            listener = attach(log, sink, fmt='json', context_filter=context_filter)
+        result = await run(log, args)
+        if listener is not None:
+            t0 = time.perf_counter()
+            stop(listener)
+            drain = time.perf_counter() - t0
+            extra = (f', {listener.handler.dropped} dropped, {context_filter.suppressed} suppressed, '
+                     f'{context_filter.sampled_out} debug sampled out, {drain:.2f} s to drain')
+        else:
+            extra = ''
+        print(f"{mode:5s}: {args.updates} updates in {result['wall']:.2f} s ({args.updates / result['wall']:.0f}/s), "
+              f"{sink.writes} writes{extra}")
+        print(f"       update latency {summary(result['latency'])}")
+        print(f"       loop lag       {summary(result['lag'])}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
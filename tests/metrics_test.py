@@ -0,0 +1,201 @@
+"""Metrics end to end: updates through the real dispatcher, then a scrape of the endpoint.
+
+Checks that every update, statement, pool checkout and Bot API call is counted under the
+expected labels, that the page parses as Prometheus text (cumulative buckets, _count equal
+to the +Inf bucket), that handler errors and slow statements are recorded, and prints what
+the instrumentation costs per update.
+
+Run from the repo root:  python -m tests.metrics_test
+"""
+import argparse
+import asyncio
+import re
+import time
+
+from tests.support import use_temp_database
+
+use_temp_database(admin_ids='1')
+
+SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{(?:[a-zA-Z_]\w*="(?:[^"\\]|\\.)*",?)*\})? (-?[0-9.e+-]+|\+Inf|NaN)$')
+
+
+def message(update_id: int, uid: int, text: str) -> dict:
+    return {'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': int(time.time()), 'chat': {'id': uid, 'type': 'private'},
+        'from': {'id': uid, 'is_bot': False, 'first_name': f'U{uid}'}, 'text': text}}
+
+
+def parse(page: str) -> dict:
+    """{'name{labels}': value}; fails on any line that is not valid exposition format."""
+    samples = {}
+    for line in page.splitlines():
+        if line.startswith('# HELP ') or line.startswith('# TYPE '):
+            continue
+        m = SAMPLE.match(line)
+        assert m, f'bad line: {line!r}'
+        samples[m.group(1) + (m.group(2) or '')] = float(m.group(3))
+    return samples
+
+
+def check_histograms(samples: dict):
+    series = {}
+    for key, value in samples.items():
+        if '_bucket{' in key:
+            name, labels = key.split('{', 1)
+            base = name[:-len('_bucket')] + '{' + re.sub(r',?le="[^"]*"', '', labels).lstrip(',')
+            series.setdefault(base, []).append(value)
+    for base, buckets in series.items():
+        assert buckets == sorted(buckets), f'{base}: buckets not cumulative'
+        name, labels = base.split('{', 1)
+        count = samples[f'{name}_count' + ('{' + labels if labels != '}' else '')]
+        assert count == buckets[-1], f'{base}: _count {count} != +Inf bucket {buckets[-1]}'
+    return len(series)
+
+
+async def overhead(n: int):
+    """Microseconds each instrumentation point adds."""
+    from types import SimpleNamespace
+    from sqlalchemy import create_engine, text
+    from services import metrics
+
+    async def noop(*args):
+        return None
+
+    mw = metrics.MetricsMiddleware()
+    api = metrics.BotApiMetrics()
+    event = SimpleNamespace(event_type='message')
+    method = SimpleNamespace(__api_method__='sendMessage')
+    sql = 'SELECT users.id, users.telegram_id FROM users WHERE users.telegram_id = :telegram_id'
+    results = {}
+
+    t0 = time.perf_counter()
+    for _ in range(n):
+        await noop(event, {})
+    base = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for _ in range(n):
+        await mw(noop, event, {})
+    results['update middleware'] = (time.perf_counter() - t0 - base) / n
+    t0 = time.perf_counter()
+    for _ in range(n):
+        await api(noop, None, method)
+    results['Bot API call'] = (time.perf_counter() - t0 - base) / n
+    # statements on a plain and an instrumented in-memory engine, event dispatch included;
+    # best of five rounds, since a statement itself only takes some 20 µs
+    timings = []
+    for instrumented in (False, True):
+        eng = create_engine('sqlite://')
+        if instrumented:
+            metrics.instrument_engine(eng, name='overhead', slow_ms=0)
+        with eng.connect() as conn:
+            stmt = text(sql)
+            conn.exec_driver_sql('CREATE TABLE users (id INTEGER, telegram_id INTEGER)')
+            best = float('inf')
+            for _ in range(5):
+                t0 = time.perf_counter()
+                for _ in range(n // 20):
+                    conn.execute(stmt, {'telegram_id': 7})
+                best = min(best, time.perf_counter() - t0)
+            timings.append(best)
+    results['SQL statement'] = (timings[1] - timings[0]) / (n // 20)
+    return results
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--users', type=int, default=50)
+    parser.add_argument('--overhead-iterations', type=int, default=100_000)
+    args = parser.parse_args()
+
+    import aiohttp
+    from aiogram import Bot
+    from aiogram.types import Update
+    from sqlalchemy import create_engine, text
+    from bot import build_dispatcher
+    from database.db import engine, init_db
+    from services import metrics
+    from tests.mock_session import MockSession
+    from utils.logger import logger
+
+    logger.setLevel('ERROR')
+    await init_db()
+    session = MockSession()
+    bot = Bot('42:METRICS', session=session)
+    dp = build_dispatcher()
+    await dp.emit_startup(bot=bot)
+    runner = await metrics.start_server(host='127.0.0.1', port=0)
+    url = f'http://127.0.0.1:{runner.addresses[0][1]}{metrics.METRICS_PATH}'
+
+    texts = ['/start', '/top', 'hello']
+    updates = [message(i, 100 + i // len(texts), t) for i, t in enumerate(texts * args.users)]
+    updates.append(message(len(updates), 1, '/stats'))
+    for u in updates:
+        await dp.feed_update(bot, Update.model_validate(u, context={'bot': bot}))
+
+    # a handler that raises
+    async def broken(event, data):
+        metrics.handled_by('/broken')
+        raise ValueError('boom')
+    try:
+        await metrics.MetricsMiddleware()(broken, Update.model_validate(message(0, 1, '/broken')), {})
+    except ValueError:
+        pass
+
+    # slow-query log on a throwaway engine: every statement counts as slow
+    slow_engine = create_engine('sqlite://')
+    metrics.instrument_engine(slow_engine, name='slow', slow_ms=1e-9)
+    with slow_engine.connect() as conn:
+        conn.execute(text('SELECT 1 FROM sqlite_master'))
+
+    async with aiohttp.ClientSession() as http:
+        async with http.get(url) as resp:
+            assert resp.status == 200
+            assert resp.headers['Content-Type'].startswith('text/plain; version=0.0.4'), resp.headers['Content-Type']
+            page = await resp.text()
+    await runner.cleanup()
+    await dp.emit_shutdown(bot=bot)
+    await engine.dispose()
+
+    samples = parse(page)
+    histograms = check_histograms(samples)
+    expect = {
+        'velobike_update_seconds_count{handler="/start"}': args.users,
+        'velobike_update_seconds_count{handler="/top"}': args.users,
+        'velobike_update_seconds_count{handler="(message)"}': args.users,
+        'velobike_update_seconds_count{handler="/stats"}': 1,
+        'velobike_update_errors_total{handler="/broken",error="ValueError"}': 1,
+        'velobike_sql_slow_total{statement="SELECT sqlite_master"}': 1,
+    }
+    for key, value in expect.items():
+        assert samples.get(key) == value, f'{key}: {samples.get(key)} != {value}'
+    api_calls = sum(v for k, v in samples.items() if k.startswith('velobike_bot_api_seconds_count'))
+    assert api_calls == len(session.calls), f'{api_calls} Bot API calls counted, {len(session.calls)} made'
+    assert samples.get('velobike_sql_seconds_count{statement="INSERT users"}', 0) >= args.users
+    # both pools: the main one for handlers, the read one for the startup loads (iter_*)
+    for pool in ('main', 'read'):
+        checkouts = samples[f'velobike_db_pool_checkouts_total{{pool="{pool}"}}']
+        acquired = samples[f'velobike_db_pool_acquire_seconds_count{{pool="{pool}"}}']
+        # engine.connect() outside a session (init_db) checks out without a session transaction
+        assert 0 < acquired <= checkouts, (pool, acquired, checkouts)
+        assert f'velobike_db_pool_checked_out{{pool="{pool}"}}' in samples, pool
+    for name in ('velobike_notify_sent_total', 'velobike_user_cache_hits_total'):
+        assert name in samples, name
+
+    statements = sorted(k[len('velobike_sql_seconds_count{statement="'):-2] for k in samples if k.startswith('velobike_sql_seconds_count'))
+    checkouts = sum(v for k, v in samples.items() if k.startswith('velobike_db_pool_checkouts_total'))
+    print(f'OK: {len(samples)} samples, {histograms} histogram series, {len(updates)} updates, '
+          f'{int(api_calls)} Bot API calls, {int(checkouts)} pool checkouts')
+    print(f'statements: {", ".join(statements)}')
+
+    per_update = sum(v for k, v in samples.items() if k.startswith('velobike_update_seconds_sum')) / len(updates)
+    costs = await overhead(args.overhead_iterations)
+    for name, seconds in costs.items():
+        print(f'overhead per {name}: {seconds * 1e6:.2f} µs')
+    sql_per_update = sum(v for k, v in samples.items() if k.startswith('velobike_sql_seconds_count')) / len(updates)
+    total = costs['update middleware'] + sql_per_update * costs['SQL statement'] + api_calls / len(updates) * costs['Bot API call']
+    print(f'per update: {total * 1e6:.1f} µs of {per_update * 1e3:.2f} ms ({total / per_update:.2%}) '
+          f'with {sql_per_update:.1f} statements and {api_calls / len(updates):.1f} API calls')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
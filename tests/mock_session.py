@@ -0,0 +1,92 @@
+import asyncio
+import datetime
+from aiogram.client.session.base import BaseSession
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+from aiogram.methods import GetFile, GetMe, GetUpdates, SendMediaGroup, SendPhoto
+from aiogram.types import Chat, File, Message, PhotoSize, User
+
+
+class MockSession(BaseSession):
+    """Bot session that records outgoing API calls instead of sending them to Telegram.
+
+    Updates put into ``updates`` are served to ``getUpdates`` so polling can be
+    driven offline; ``poll_rtt`` simulates the network round trip of each poll.
+    Every ``flood_every``-th call fails with RetryAfter(``retry_after``) and calls
+    to ``blocked_chats`` fail with Forbidden, like a user who blocked the bot.
+    Files in ``files`` (file_id -> bytes) can be downloaded; sent photos come back with
+    a 320 px and a full-size PhotoSize.
+    """
+
+    def __init__(self, api_latency: float = 0.0, poll_rtt: float = 0.0, flood_every: int = 0, retry_after: int = 1, blocked_chats=()):
+        super().__init__()
+        self.api_latency = api_latency
+        self.poll_rtt = poll_rtt
+        self.flood_every = flood_every
+        self.retry_after = retry_after
+        self.blocked_chats = set(blocked_chats)
+        self.attempts = 0
+        self.calls = []
+        self.updates = asyncio.Queue()
+        self.files = {}
+        self._message_id = 0
+
+    async def make_request(self, bot, method, timeout=None):
+        if isinstance(method, GetUpdates):
+            return await self._get_updates(method)
+        if self.api_latency:
+            await asyncio.sleep(self.api_latency)
+        self.attempts += 1
+        if self.flood_every and self.attempts % self.flood_every == 0:
+            raise TelegramRetryAfter(method=method, message='Too Many Requests', retry_after=self.retry_after)
+        if getattr(method, 'chat_id', None) in self.blocked_chats:
+            raise TelegramForbiddenError(method=method, message='Forbidden: bot was blocked by the user')
+        self.calls.append(method)
+        return self._result(method)
+
+    async def _get_updates(self, method: GetUpdates):
+        await asyncio.sleep(self.poll_rtt / 2)
+        try:
+            first = await asyncio.wait_for(self.updates.get(), timeout=method.timeout or 0.01)
+        except asyncio.TimeoutError:
+            return []
+        batch = [first]
+        while len(batch) < (method.limit or 100) and not self.updates.empty():
+            batch.append(self.updates.get_nowait())
+        await asyncio.sleep(self.poll_rtt / 2)
+        return batch
+
+    def _result(self, method):
+        if isinstance(method, GetMe):
+            return User(id=1, is_bot=True, first_name='Mock', username='mock_bot')
+        if isinstance(method, GetFile):
+            return File(file_id=method.file_id, file_unique_id='u' + method.file_id, file_path=method.file_id)
+        if isinstance(method, SendMediaGroup):
+            return [self._message(method.chat_id, item.media) for item in method.media]
+        returning = getattr(method, '__returning__', None)
+        if returning is bool:
+            return True
+        if returning is Message:
+            return self._message(getattr(method, 'chat_id', 0), method.photo if isinstance(method, SendPhoto) else None)
+        return None
+
+    def _message(self, chat_id, photo=None) -> Message:
+        self._message_id += 1
+        sizes = None
+        if photo is not None:
+            file_id = photo if isinstance(photo, str) else f'upload{self._message_id}'
+            sizes = [PhotoSize(file_id=f'{file_id}:320', file_unique_id=f'{file_id}:320', width=320, height=240),
+                     PhotoSize(file_id=file_id, file_unique_id=file_id, width=1280, height=960)]
+        return Message(
+            message_id=self._message_id,
+            date=datetime.datetime.now(),
+            chat=Chat(id=chat_id if isinstance(chat_id, int) else 0, type='private'),
+            photo=sizes,
+        )
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        data = self.files.get(url.rsplit('/', 1)[-1], b'')
+        for i in range(0, len(data), chunk_size):
+            yield data[i:i + chunk_size]
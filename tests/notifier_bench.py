@@ -0,0 +1,68 @@
+"""Broadcast throughput through services/notifier.py against a mock Telegram session.
+
+A broadcast to -n chats runs while single notifications keep arriving; the mock answers
+some calls with RetryAfter and has blocked users. Reports the achieved send rate
+against the configured one and how long the single notifications waited.
+
+Run from the repo root:  python -m tests.notifier_bench -n 100000 --rate 2000
+(--rate 30 is Telegram's real limit: 100k chats then take about 56 minutes.)
+"""
+import argparse
+import asyncio
+import time
+
+from aiogram import Bot
+
+from tests.support import percentiles
+from tests.mock_session import MockSession
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=20_000, help='broadcast recipients')
+    parser.add_argument('--rate', type=float, default=1000, help='global messages per second')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.005, help='mock Bot API latency (s)')
+    parser.add_argument('--flood-every', type=int, default=5000, help='every n-th call gets RetryAfter')
+    args = parser.parse_args()
+
+    from services.notifier import Notifier
+
+    session = MockSession(api_latency=args.latency, flood_every=args.flood_every, blocked_chats=range(1, args.n + 1, 100))
+    bot = Bot('42:TEST', session=session)
+    notifier = Notifier(maxsize=10_000, workers=args.workers, global_rate=args.rate)
+    notifier.start(bot)
+
+    urgent_waits = []
+
+    async def urgent():
+        # a handler notification every 50 ms while the broadcast runs
+        while True:
+            await asyncio.sleep(0.05)
+            chat_id = 10_000_000 + len(urgent_waits)
+            t0 = time.perf_counter()
+            notifier.notify(chat_id, 'assigned')
+            while not any(getattr(c, 'chat_id', None) == chat_id for c in session.calls[-50:]):
+                await asyncio.sleep(0.001)
+            urgent_waits.append((time.perf_counter() - t0) * 1000)
+
+    urgent_task = asyncio.create_task(urgent())
+    t0 = time.perf_counter()
+    queued = await notifier.broadcast(range(1, args.n + 1), 'hello')
+    await notifier._queue.join()
+    elapsed = time.perf_counter() - t0
+    urgent_task.cancel()
+    await notifier.stop()
+
+    st = notifier.stats()
+    attempts = st['sent'] + st['failed']
+    print(f"broadcast: {queued} queued, {st['sent']} sent, {st['failed']} failed (blocked), {st['rate_limited']} RetryAfter, "
+          f"{st['dropped']} dropped in {elapsed:.1f} s")
+    print(f"rate: {attempts / elapsed:.0f} msg/s achieved vs {args.rate:.0f} msg/s allowed")
+    if urgent_waits:
+        q = percentiles(urgent_waits)
+        print(f"single notifications during the broadcast: {len(urgent_waits)}, delivered p50={q['p50']:.1f} ms p95={q['p95']:.1f} ms")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
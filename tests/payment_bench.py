@@ -0,0 +1,131 @@
+"""Payment intents per second against the fake provider, and duplicate-submit safety.
+
+- throughput: -n payments with distinct keys, --concurrency at a time
+- duplicates: --keys keys, each submitted --dup times concurrently; every key must
+  end up as one payments row and one provider charge
+- callbacks: the provider confirms later and delivers every callback twice
+- reconciliation: the first provider call fails, reconcile_once settles the payment
+- no connection is checked out while the provider is being called
+
+Run from the repo root:  python -m tests.payment_bench -n 5000 --latency 0.02
+"""
+import argparse
+import asyncio
+import os
+import time
+
+from tests.support import percentiles, use_temp_database
+
+use_temp_database()
+# every payment is two short write transactions; under this much contention a SQLite
+# writer can wait longer than the default 5 s for its turn
+os.environ.setdefault('SQLITE_BUSY_TIMEOUT_MS', '30000')
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=5000, help='payments in the throughput run')
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.02, help='fake provider latency (s)')
+    parser.add_argument('--keys', type=int, default=500)
+    parser.add_argument('--dup', type=int, default=5, help='concurrent submits per key')
+    args = parser.parse_args()
+
+    from sqlalchemy import func, insert, select
+    from database.db import engine, init_db
+    from database.models import Payment, User
+    from services import payment_service as ps
+    from utils.logger import logger
+
+    logger.setLevel('ERROR')
+    await init_db()
+    async with engine.begin() as conn:
+        await conn.execute(insert(User), [{'telegram_id': i, 'referral_code': f'c{i}'} for i in range(1, 1001)])
+
+    class CheckedProvider(ps.FakeProvider):
+        """Fails the first charge of keys starting with 'flaky' and records open connections."""
+        checked_out = 0
+
+        async def charge(self, idempotency_key, amount, currency):
+            CheckedProvider.checked_out = max(CheckedProvider.checked_out, engine.pool.checkedout())
+            if idempotency_key.startswith('flaky') and idempotency_key not in self.flaked:
+                self.flaked.add(idempotency_key)
+                raise ConnectionError('provider unreachable')
+            return await super().charge(idempotency_key, amount, currency)
+
+    # 1. throughput
+    ps.provider = ps.FakeProvider(latency=args.latency, fail_rate=0.05, seed=1)
+    sem = asyncio.Semaphore(args.concurrency)
+    latencies = []
+
+    async def pay(i):
+        async with sem:
+            t0 = time.perf_counter()
+            await ps.create_payment(10.0, i % 1000 + 1, idempotency_key=f'tp{i}')
+            latencies.append(time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(pay(i) for i in range(args.n)))
+    elapsed = time.perf_counter() - t0
+    q = percentiles(latencies, 1000)
+    print(f'throughput: {args.n / elapsed:.0f} payments/s at concurrency {args.concurrency}, '
+          f'p50={q["p50"]:.1f} ms p95={q["p95"]:.1f} ms p99={q["p99"]:.1f} ms')
+
+    # 2. duplicate submits
+    ps.provider = ps.FakeProvider(latency=args.latency, seed=2)
+    results = await asyncio.gather(*(
+        ps.create_payment(5.0, k % 1000 + 1, idempotency_key=f'dup{k}') for k in range(args.keys) for _ in range(args.dup)
+    ))
+    async with engine.connect() as conn:
+        rows = (await conn.execute(select(func.count()).select_from(Payment).where(Payment.idempotency_key.like('dup%')))).scalar_one()
+    ids_per_key = {}
+    for p in results:
+        ids_per_key.setdefault(p.idempotency_key, set()).add(p.id)
+    print(f'duplicates: {len(results)} submits of {args.keys} keys -> {rows} rows, {ps.provider.charges} provider charges')
+    assert rows == args.keys and ps.provider.charges == args.keys and all(len(v) == 1 for v in ids_per_key.values())
+
+    # 3. asynchronous confirmation, every callback delivered twice
+    async def twice(key, result):
+        await asyncio.gather(ps.handle_callback(key, result), ps.handle_callback(key, result))
+
+    ps.provider = ps.FakeProvider(latency=args.latency, confirm_after=0.05, on_callback=twice, fail_rate=0.1, seed=3)
+    pending = await asyncio.gather(*(ps.create_payment(7.0, i + 1, idempotency_key=f'cb{i}') for i in range(500)))
+    await asyncio.gather(*list(ps.provider._pending_callbacks))
+    async with engine.connect() as conn:
+        statuses = dict((await conn.execute(
+            select(Payment.status, func.count()).where(Payment.idempotency_key.like('cb%')).group_by(Payment.status))).all())
+    print(f"callbacks: {sum(p.status == 'pending' for p in pending)} pending after submit, settled to {statuses}")
+    assert 'pending' not in statuses and sum(statuses.values()) == 500
+
+    # 4. provider down on the first try; 5. refund twice
+    provider = ps.provider = CheckedProvider(latency=args.latency, seed=4)
+    provider.flaked = set()
+    flaky = [await ps.create_payment(3.0, i + 1, idempotency_key=f'flaky{i}') for i in range(50)]
+    assert all(p.status == 'pending' and p.provider_ref is None for p in flaky)
+    settled = await ps.reconcile_once(older_than=0)
+    print(f'reconciliation: {settled} of {len(flaky)} unanswered payments settled, {provider.charges} provider charges')
+    assert settled == len(flaky) and provider.charges == len(flaky)
+    refunded = await asyncio.gather(ps.refund_payment(flaky[0].id), ps.refund_payment(flaky[0].id))
+    print(f'refund: {[p.status for p in refunded]}, provider refunds {provider.refunds}')
+    assert provider.refunds == 1 and all(p.status == 'refunded' for p in refunded)
+    print(f'connections checked out during provider calls: {CheckedProvider.checked_out}')
+    assert CheckedProvider.checked_out == 0
+
+    # 6. a provider without refund cannot be constructed
+    class ChargeOnly(ps.PaymentProvider):
+        async def charge(self, idempotency_key, amount, currency):
+            pass
+
+        async def status(self, ref):
+            pass
+    try:
+        ChargeOnly()
+    except TypeError as e:
+        print(f'incomplete provider: {e}')
+    else:
+        raise AssertionError('a provider without refund was constructed')
+    await engine.dispose()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,95 @@
+"""Paying every partner: /payout_run against one /pay_partner-style payout per partner.
+
+Seeds -p partners with --rentals closed rentals each and backfills the ledger. The old
+path (record_payout then partner_balance, one command per partner) is timed on --sample
+partners and extrapolated; /payout_run then runs through the dispatcher against a mock
+Telegram session. Afterwards the ledger must match rentals and payouts and every balance
+must be below the minimum.
+
+Run from the repo root:  python -m tests.payout_bench -p 10000
+"""
+import argparse
+import asyncio
+import datetime
+import time
+
+from tests.support import use_temp_database
+
+use_temp_database(admin_ids='1')
+
+
+def admin_command(update_id: int, text: str) -> dict:
+    chat = {'id': 1, 'type': 'private'}
+    return {'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': int(time.time()), 'chat': chat, 'from': {'id': 1, 'is_bot': False, 'first_name': 'a'}, 'text': text,
+    }}
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--partners', type=int, default=10_000)
+    parser.add_argument('--rentals', type=int, default=20, help='closed rentals per partner')
+    parser.add_argument('--sample', type=int, default=200, help='partners paid the old way')
+    args = parser.parse_args()
+
+    from aiogram import Bot
+    from aiogram.methods import SendDocument
+    from aiogram.types import Update
+    from sqlalchemy import func, insert, select
+    from bot import build_dispatcher
+    from database.db import engine, init_db
+    from database.models import Bike, PartnerLedger, Payout, Rental, User
+    from database.queries import partner_balance, record_payout, reconcile_partner_ledger
+    from tests.mock_session import MockSession
+    from utils.logger import logger
+
+    logger.setLevel('WARNING')
+    await init_db()
+    n = args.partners
+    now = datetime.datetime.utcnow()
+    async with engine.begin() as conn:
+        # partner ids are telegram ids here, as in handlers/partner.py
+        await conn.execute(insert(User), [{'telegram_id': 1000 + i, 'is_partner': True, 'referral_code': f'p{i}'} for i in range(n)])
+        await conn.execute(insert(Bike), [{'name': f'b{i}', 'partner_id': 1000 + i, 'price_per_hour': 5.0, 'available': True} for i in range(n)])
+        for lo in range(0, n * args.rentals, 50_000):
+            await conn.execute(insert(Rental), [
+                {'user_id': 1, 'bike_id': i % n + 1, 'start_at': now, 'end_at': now, 'fee': 1.0 + i % 7}
+                for i in range(lo, min(lo + 50_000, n * args.rentals))
+            ])
+    await reconcile_partner_ledger(fix=True)
+
+    sample = range(1000, 1000 + min(args.sample, n))
+    t0 = time.perf_counter()
+    for pid in sample:
+        balance = (await partner_balance(pid))['balance']
+        await record_payout(pid, balance)
+        await partner_balance(pid)
+    per_partner = (time.perf_counter() - t0) / len(sample)
+    print(f'one command per partner: {per_partner * 1000:.1f} ms of queries each -> {per_partner * n:.0f} s for {n:,} partners '
+          f'(plus {n:,} admin commands)')
+
+    session = MockSession()
+    bot = Bot('42:TEST', session=session)
+    dp = build_dispatcher()
+    t0 = time.perf_counter()
+    await dp.feed_update(bot, Update.model_validate(admin_command(1, '/payout_run'), context={'bot': bot}))
+    elapsed = time.perf_counter() - t0
+    documents = [c for c in session.calls if isinstance(c, SendDocument)]
+    print(f'/payout_run: {elapsed:.2f} s for {n - len(sample):,} partners, summary: {documents[0].caption if documents else None}')
+
+    await dp.feed_update(bot, Update.model_validate(admin_command(2, '/payout_run'), context={'bot': bot}))
+    print(f'second run: {session.calls[-1].text}')
+
+    mismatches = await reconcile_partner_ledger()
+    async with engine.connect() as conn:
+        left = (await conn.execute(select(func.count()).select_from(PartnerLedger).where(PartnerLedger.earned - PartnerLedger.paid >= 0.01))).scalar_one()
+        payouts = (await conn.execute(select(func.count()).select_from(Payout))).scalar_one()
+    print(f'{payouts:,} payouts, {left} partners with a balance left, {len(mismatches)} ledger mismatches')
+    for task in asyncio.all_tasks() - {asyncio.current_task()}:
+        task.cancel()
+    await engine.dispose()
+    assert documents and not mismatches and left == 0 and payouts == n
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
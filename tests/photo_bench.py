@@ -0,0 +1,302 @@
+"""Bike photo pipeline (services/photos.py): throughput, event loop lag, hash robustness, end to end.
+
+Synthetic phone-like JPEGs (--size) are run through process_photo (services/photo_worker.py):
+- in-process, one after the other: photos per second, and what the JPEG draft decode saves
+- on the worker processes (--workers, comma-separated), all at once: how long the workers take to
+  start and how much memory each holds, photos per second and per core, and how late a 1 ms timer
+  on the event loop fires meanwhile, next to running them on the loop
+- dHash distances between each photo and its re-encoded, resized, cropped and brightened copies,
+  and between different photos, against PHOTO_DUPLICATE_DISTANCE
+- PhotoHashIndex lookups among --index-size random hashes, next to a linear scan
+Finally the whole pipeline runs against a MockSession: new photos, re-encoded copies sent by
+another partner and the very same file sent again, checking downloads, uploads, duplicate
+flags and the file_ids kept in bike_photos.
+
+Run from the repo root:  python -m tests.photo_bench -n 40 --size 2560x1920 --workers 1,2
+"""
+import argparse
+import asyncio
+import io
+import os
+import random
+import statistics
+import time
+
+from tests.support import use_temp_database
+
+use_temp_database(admin_ids='1,2')
+
+
+def variants(data: bytes) -> dict:
+    """Copies of a photo as someone reusing it might send them."""
+    from PIL import Image, ImageEnhance
+
+    def jpeg(image, quality=85):
+        out = io.BytesIO()
+        image.save(out, 'JPEG', quality=quality)
+        return out.getvalue()
+
+    image = Image.open(io.BytesIO(data)).convert('RGB')
+    w, h = image.size
+    return {
+        're-encoded q60': jpeg(image, 60),
+        'resized to 50%': jpeg(image.resize((w // 2, h // 2))),
+        'cropped 5%': jpeg(image.crop((w // 40, h // 40, w - w // 40, h - h // 40))),
+        'brightened 15%': jpeg(ImageEnhance.Brightness(image).enhance(1.15)),
+    }
+
+
+def rate(count: int, seconds: float) -> str:
+    return f'{count / seconds:.1f} photos/s'
+
+
+def sizes() -> tuple:
+    from config import PHOTO_CATALOG_SIZE, PHOTO_THUMB_SIZE, PHOTO_JPEG_QUALITY
+    return PHOTO_CATALOG_SIZE, PHOTO_THUMB_SIZE, PHOTO_JPEG_QUALITY
+
+
+def children_rss_mb() -> list:
+    """Resident memory of this process's children, in MB (Linux only, else empty)."""
+    pid = os.getpid()
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            children = f.read().split()
+    except OSError:
+        return []
+    rss = []
+    for child in children:
+        with open(f'/proc/{child}/status') as f:
+            rss.append(next(int(line.split()[1]) for line in f if line.startswith('VmRSS')) / 1024)
+    return rss
+
+
+async def loop_lag(work) -> tuple:
+    """Run work(); returns (seconds it took, worst lag of a 1 ms timer in ms)."""
+    lag = []
+    done = asyncio.Event()
+
+    async def probe():
+        while not done.is_set():
+            t0 = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lag.append((time.perf_counter() - t0 - 0.001) * 1000)
+
+    task = asyncio.create_task(probe())
+    t0 = time.perf_counter()
+    await work()
+    wall = time.perf_counter() - t0
+    done.set()
+    await task
+    return wall, max(lag, default=0.0)
+
+
+def bench_in_process(photos: list):
+    from PIL import Image
+    from services.photo_worker import process_photo
+
+    process_photo(photos[0], *sizes())  # warm-up
+    t0 = time.perf_counter()
+    results = [process_photo(data, *sizes()) for data in photos]
+    wall = time.perf_counter() - t0
+    original = sum(map(len, photos)) / len(photos)
+    catalog = sum(len(r.catalog) for r in results) / len(results)
+    thumb = sum(len(r.thumb) for r in results) / len(results)
+    print(f'in-process: {rate(len(photos), wall)} ({wall / len(photos) * 1000:.1f} ms each); '
+          f'{original / 1024:.0f} KB original -> {catalog / 1024:.0f} KB catalog ({results[0].width}x{results[0].height}) '
+          f'+ {thumb / 1024:.0f} KB thumbnail')
+
+    def decode(data, draft):
+        with Image.open(io.BytesIO(data)) as image:
+            if draft:
+                image.draft('RGB', (results[0].width, results[0].height))
+            image.load()
+
+    for draft in (False, True):
+        t0 = time.perf_counter()
+        for data in photos:
+            decode(data, draft)
+        label = 'draft decode' if draft else 'full decode '
+        print(f'   {label} {(time.perf_counter() - t0) / len(photos) * 1000:.1f} ms per photo')
+
+
+async def bench_pool(photos: list, workers: list):
+    from services.photo_worker import process_photo
+    from services.photos import PhotoPipeline
+
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+
+    async def on_loop():
+        for data in photos:
+            process_photo(data, *sizes())
+            await asyncio.sleep(0)
+
+    wall, lag = await loop_lag(on_loop)
+    print(f'on the event loop: {rate(len(photos), wall)}, timer late by up to {lag:.1f} ms')
+    for n in workers:
+        pipeline = PhotoPipeline(workers=n)
+        t0 = time.perf_counter()
+        await pipeline.start_workers()
+        await asyncio.gather(*(pipeline.process(photos[0]) for _ in range(n or 1)))  # each worker has imported Pillow
+        if n:
+            rss = ', '.join(f'{mb:.0f}' for mb in children_rss_mb())
+            print(f'{n} worker process{"es" if n != 1 else ""} ready to take photos in {(time.perf_counter() - t0) * 1000:.0f} ms, '
+                  f'resident memory {rss or "?"} MB')
+
+        async def on_pool():
+            await asyncio.gather(*(pipeline.process(data) for data in photos))
+
+        wall, lag = await loop_lag(on_pool)
+        used = min(n, cores) if n else 1
+        label = f'{n} worker process{"es" if n != 1 else ""}' if n else 'thread (PHOTO_WORKERS=0)'
+        print(f'{label}: {rate(len(photos), wall)}, {len(photos) / wall / used:.1f} per core ({cores} cores), '
+              f'timer late by up to {lag:.1f} ms')
+        await pipeline.stop()
+
+
+def bench_hashes(photos: list, max_distance: int):
+    from PIL import Image
+    from services.photo_worker import dhash, hamming, process_photo
+
+    def phash(data):
+        return process_photo(data, *sizes(), with_thumb=False).phash
+
+    hashes = [phash(data) for data in photos]
+    copies = {}
+    for data, h in zip(photos[:10], hashes):
+        for name, copy in variants(data).items():
+            copies.setdefault(name, []).append(hamming(h, phash(copy)))
+    for name, distances in copies.items():
+        caught = sum(d <= max_distance for d in distances)
+        print(f'   {name:15s} distance median {statistics.median(distances):4.1f}, max {max(distances):2d}: '
+              f'{caught}/{len(distances)} flagged')
+    different = [hamming(a, b) for i, a in enumerate(hashes) for b in hashes[i + 1:]]
+    false = sum(d <= max_distance for d in different)
+    print(f'   {"other photos":15s} distance median {statistics.median(different):4.1f}, min {min(different):2d}: '
+          f'{false}/{len(different)} pairs flagged')
+    image = Image.open(io.BytesIO(photos[0]))
+    image.draft('RGB', (320, 320))
+    image = image.convert('RGB')
+    t0 = time.perf_counter()
+    for _ in range(1000):
+        dhash(image)
+    print(f'   dhash of a {image.width}x{image.height} image: {(time.perf_counter() - t0) * 1000:.0f} µs')
+
+
+def bench_index(size: int, max_distance: int):
+    from services.photos import PhotoHashIndex
+
+    rng = random.Random(1)
+    index = PhotoHashIndex()
+    hashes = [rng.getrandbits(64) for _ in range(size)]
+    t0 = time.perf_counter()
+    for i, h in enumerate(hashes):
+        index.add(i, h, i, i % 100)
+    build = time.perf_counter() - t0
+    # half the lookups are near copies of indexed photos, half are new
+    queries = [hashes[rng.randrange(size)] ^ (1 << rng.randrange(64)) if i % 2 else rng.getrandbits(64) for i in range(1000)]
+    t0 = time.perf_counter()
+    found = sum(bool(index.matches(q, max_distance)) for q in queries)
+    banded = (time.perf_counter() - t0) / len(queries)
+    t0 = time.perf_counter()
+    for q in queries[:50]:
+        [i for i, h in enumerate(hashes) if (q ^ h).bit_count() <= max_distance]
+    linear = (time.perf_counter() - t0) / 50
+    print(f'index of {size} hashes: built in {build:.2f} s, lookup {banded * 1e6:.0f} µs '
+          f'({found}/{len(queries)} matched), linear scan {linear * 1e3:.1f} ms')
+
+
+async def end_to_end(photos: list):
+    from aiogram import Bot
+    from aiogram.methods import SendPhoto
+    from aiogram.types import PhotoSize
+    from database.db import engine, init_db
+    from database.queries import create_bike_for_partner, get_bike_photo_by_source
+    from services.notifier import notifier
+    from services.photos import PhotoPipeline
+    from tests.mock_session import MockSession
+    from utils.logger import logger
+
+    logger.setLevel('ERROR')
+    await init_db()
+    session = MockSession()
+    bot = Bot('42:PHOTOS', session=session)
+    notifier.start(bot)
+
+    def photo(file_id: str, data: bytes) -> PhotoSize:
+        session.files[file_id] = data
+        return PhotoSize(file_id=file_id, file_unique_id='u' + file_id, width=1280, height=960)
+
+    async def run(pipeline, sends):
+        tasks = []
+        for n, (partner, p) in enumerate(sends):
+            bike = await create_bike_for_partner(partner, f'bike{n}', 5.0)
+            tasks.append(pipeline.submit(bike.id, partner, p, f'Bike ID: {bike.id}'))
+        await asyncio.gather(*tasks)
+
+    for run_no, store_chat_id in enumerate((0, -100)):
+        # fresh photos for each run: the second pipeline loads the first one's hashes
+        originals = photos[run_no * 5:run_no * 5 + 5]
+        new = [(100 + i, photo(f'new{run_no}.{i}', data)) for i, data in enumerate(originals)]
+        copies = [(200 + i, photo(f'copy{run_no}.{i}', variants(data)['re-encoded q60'])) for i, data in enumerate(originals)]
+        again = [(300 + i, p) for i, (_, p) in enumerate(new)]
+        pipeline = PhotoPipeline(workers=1, store_chat_id=store_chat_id)
+        await pipeline.start(bot)
+        for name, sends in (('new', new), ('re-encoded copies', copies), ('same file again', again)):
+            session.calls.clear()
+            await run(pipeline, sends)
+            await notifier._queue.join()
+            calls = [type(c).__name__ for c in session.calls]
+            sent = [c for c in session.calls if isinstance(c, SendPhoto)]
+            flagged = sum('⚠️' in (c.caption or '') for c in sent)
+            print(f"   store chat {store_chat_id or 'none'}, {name}: {calls.count('GetFile')} downloads, "
+                  f"{calls.count('SendMediaGroup')} sendMediaGroup, {len(sent)} sendPhoto ({flagged} flagged as duplicates)")
+            # every admin gets every photo, exactly once
+            assert len(sent) == 2 * len(sends), calls
+            assert flagged == (0 if name == 'new' else len(sent)), [c.caption for c in sent]
+            if name == 'same file again':
+                assert not calls.count('GetFile') and not calls.count('SendMediaGroup'), 'a resent file was processed again'
+                assert all(isinstance(c.photo, str) for c in sent), 'a resent file was uploaded again'
+            else:
+                assert calls.count('GetFile') == len(sends), 'each photo is downloaded exactly once'
+                uploads = calls.count('SendMediaGroup') if store_chat_id else sum(not isinstance(c.photo, str) for c in sent)
+                assert uploads == len(sends), 'each photo is uploaded exactly once'
+        stored = await get_bike_photo_by_source(new[0][1].file_unique_id)
+        assert stored.catalog_file_id and stored.thumb_file_id, stored
+        stats = pipeline.stats()
+        assert stats['failed'] == 0 and stats['reused'] == len(again), stats
+        assert stats['duplicates'] == len(copies) + len(again), stats
+        print(f'   {stats}')
+        await pipeline.stop()
+    await notifier.stop()
+    await engine.dispose()
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--photos', type=int, default=40)
+    parser.add_argument('--size', default='2560x1920', help='WxH of the synthetic originals')
+    parser.add_argument('--workers', default='0,1,2', help='comma-separated pool sizes (0 = a thread)')
+    parser.add_argument('--index-size', type=int, default=100_000)
+    args = parser.parse_args()
+
+    from config import PHOTO_DUPLICATE_DISTANCE
+    from tests.datagen import synthetic_photo
+
+    size = tuple(int(x) for x in args.size.split('x'))
+    args.photos = max(args.photos, 10)  # the end-to-end check uses ten
+    t0 = time.perf_counter()
+    photos = [synthetic_photo(seed, size) for seed in range(args.photos)]
+    print(f'{len(photos)} synthetic {args.size} photos, {sum(map(len, photos)) / len(photos) / 1024:.0f} KB each '
+          f'(made in {time.perf_counter() - t0:.1f} s)')
+    bench_in_process(photos)
+    await bench_pool(photos, [int(w) for w in args.workers.split(',')])
+    print(f'dHash, flagged at <= {PHOTO_DUPLICATE_DISTANCE} bits:')
+    bench_hashes(photos, PHOTO_DUPLICATE_DISTANCE)
+    bench_index(args.index_size, PHOTO_DUPLICATE_DISTANCE)
+    print('end to end:')
+    await end_to_end(photos)
+    print('OK')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,333 @@
+"""Latency and throughput of every function in database/queries.py on synthetic data.
+
+Each (backend, scale) pair runs in a fresh subprocess against a database seeded by
+tests/datagen.py. Every case is run at each --concurrency level and reports p50/p95/p99
+latency and calls per second. Read cases run --iterations times. Write cases draw fresh
+rows (open rentals, free bikes, pending payments), so they stop early when the data runs
+out. Cases that read whole tables run --scan-iterations times. Like explain_test, the
+run fails when a public query function has no case.
+
+--json writes the results (and the commit they were measured on). --compare BASE compares
+this run with BASE, and --compare BASE NEW compares two saved runs without running
+anything. It exits with 1 when a case got slower by more than --threshold (and by more
+than --min-delta-ms) or started failing.
+
+Run from the repo root:
+    python -m tests.query_bench --scales 10k,100k --json bench.json
+    python -m tests.query_bench --scales 10k -c 1,16 --compare bench.json
+    python -m tests.query_bench --compare before.json after.json
+PostgreSQL is included when BENCH_PG_URL is set (postgresql+asyncpg://...; its tables are dropped).
+"""
+import argparse
+import asyncio
+import datetime
+import inspect
+import json
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import time
+from collections import namedtuple
+
+from tests.support import percentiles, remove_db, temp_db_path
+
+# kind: 'read', 'write' or 'scan'; pool: how many fresh rows a write case can use (None = unlimited);
+# cold: clear the user cache before each call so the database is measured, not the cache
+Case = namedtuple('Case', 'name kind call pool cold', defaults=(None, False))
+
+METRICS = ('p50_ms', 'p95_ms', 'p99_ms', 'mean_ms')
+
+
+def cases(d, q):
+    """Benchmark cases for Dataset d; a name is 'function' or 'function:variant'."""
+    n = d.n
+    now = datetime.datetime.utcnow()
+    top = d.top_referrers(20)
+    free = list(range(d.open_rentals + 1, d.bikes + 1))
+    half = len(free) // 2
+    pending = [p for p in range(1, d.payments + 1) if d.is_pending_payment(p)]
+
+    def user(i):
+        return i * 7919 % n + 1
+
+    def rental(i):
+        return i * 7919 % (d.first_open - 1) + 1
+
+    def payment(i):
+        return i * 7919 % d.payments + 1
+
+    def partner(i):
+        return d.partners[i % len(d.partners)]
+
+    def new_user(kind, i):
+        # telegram ids no seeded user has, one range of ten million per kind
+        return n + 1 + kind * 10_000_000 + i
+
+    return [
+        Case('get_or_create_user:existing', 'read', lambda i: q.get_or_create_user(user(i)), cold=True),
+        Case('count_referrals', 'read', lambda i: q.count_referrals(user(i)), cold=True),
+        Case('referral_tree', 'read', lambda i: q.referral_tree(top[i % len(top)])),
+        Case('referral_tree_counts', 'read', lambda i: q.referral_tree_counts(user(i))),
+        Case('referral_tree_counts:top', 'read', lambda i: q.referral_tree_counts(top[i % len(top)])),
+        Case('top_referrers', 'read', lambda i: q.top_referrers()),
+        Case('admin_stats', 'read', lambda i: q.admin_stats()),
+        Case('pick_available_bike', 'read', lambda i: q.pick_available_bike()),
+        Case('pick_main_bike', 'read', lambda i: q.pick_main_bike()),
+        Case('get_rental_by_id', 'read', lambda i: q.get_rental_by_id(rental(i))),
+        Case('get_user_by_db_id', 'read', lambda i: q.get_user_by_db_id(user(i))),
+        Case('get_active_rental', 'read', lambda i: q.get_active_rental(d.rental_user[d.first_open + i % d.open_rentals])),
+        Case('get_last_closed_rental', 'read', lambda i: q.get_last_closed_rental(d.rental_user[rental(i)])),
+        Case('list_rentals_page', 'read', lambda i: q.list_rentals_page()),
+        Case('list_rentals_page:older', 'read', lambda i: q.list_rentals_page(after_id=rental(i))),
+        Case('list_rentals_page:newer_closed', 'read', lambda i: q.list_rentals_page(before_id=rental(i), status='closed')),
+        Case('list_rentals_page:active', 'read', lambda i: q.list_rentals_page(status='active')),
+        Case('list_rentals_page:day', 'read', lambda i: q.list_rentals_page(day=(now - datetime.timedelta(days=i % 90)).date())),
+        Case('partner_earnings', 'read', lambda i: q.partner_earnings(partner(i))),
+        Case('partner_balance', 'read', lambda i: q.partner_balance(partner(i))),
+        Case('list_partner_payouts', 'read', lambda i: q.list_partner_payouts(partner(i))),
+        Case('get_payment', 'read', lambda i: q.get_payment(payment(i))),
+        Case('get_payment_by_key', 'read', lambda i: q.get_payment_by_key(f'rental:{payment(i)}:0')),
+        Case('list_rental_payments', 'read', lambda i: q.list_rental_payments(payment(i))),
+        Case('list_pending_payments', 'read', lambda i: q.list_pending_payments(now)),
+        Case('get_bike_photo_by_source', 'read', lambda i: q.get_bike_photo_by_source(f'src{i % d.photos + 1}')),
+
+        Case('list_available_bikes', 'scan', lambda i: q.list_available_bikes()),
+        Case('iter_user_telegram_ids', 'scan', lambda i: _drain(q.iter_user_telegram_ids())),
+        Case('iter_bikes', 'scan', lambda i: _drain(q.iter_bikes())),
+        Case('iter_available_bike_locations', 'scan', lambda i: _drain(q.iter_available_bike_locations())),
+        Case('iter_active_rentals', 'scan', lambda i: _drain(q.iter_active_rentals())),
+        Case('list_rentals', 'scan', lambda i: q.list_rentals()),
+        Case('iter_rentals', 'scan', lambda i: _drain(q.iter_rentals())),
+        Case('reconcile_stat_counters', 'scan', lambda i: q.reconcile_stat_counters()),
+        Case('reconcile_partner_ledger', 'scan', lambda i: q.reconcile_partner_ledger()),
+        Case('iter_bike_photo_hashes', 'scan', lambda i: _drain(q.iter_bike_photo_hashes())),
+
+        Case('get_or_create_user:new', 'write', lambda i: q.get_or_create_user(new_user(0, i))),
+        Case('get_or_create_user:ref_code', 'write', lambda i: q.get_or_create_user(new_user(1, i), ref_code=f'c{user(i)}')),
+        # the users get_or_create_user:new created have no referrer yet
+        Case('set_referrer', 'write', lambda i: q.set_referrer(new_user(0, i), f'c{user(i)}')),
+        Case('bulk_upsert_users', 'write', lambda i: q.bulk_upsert_users([{'telegram_id': new_user(2, i * 100 + j)} for j in range(100)])),
+        Case('update_user_profile', 'write', lambda i: q.update_user_profile(user(i), first_name=f'n{i}')),
+        Case('register_partner', 'write', lambda i: q.register_partner(user(i))),
+        Case('create_bike_for_partner', 'write', lambda i: q.create_bike_for_partner(partner(i), f'new{i}', 5.0, code=f'N{i}')),
+        Case('set_main_bike', 'write', lambda i: q.set_main_bike(free[i % len(free)])),
+        Case('create_rental', 'write', lambda i: q.create_rental(user(i), free[i]), pool=half),
+        Case('assign_bike_to_rental', 'write', lambda i: q.assign_bike_to_rental(rental(i), free[half + i]), pool=len(free) - half),
+        Case('set_rental_end', 'write', lambda i: q.set_rental_end(d.first_open + i, hours=1), pool=d.open_rentals),
+        Case('record_payout', 'write', lambda i: q.record_payout(partner(i), 1.0)),
+        Case('create_payment_intent', 'write', lambda i: q.create_payment_intent(f'bench:{i}', user(i), 5.0, 'UZS', 'fake', rental_id=rental(i))),
+        Case('create_payment_intent:duplicate', 'write', lambda i: q.create_payment_intent(f'rental:{payment(i)}:0', user(i), 5.0, 'UZS', 'fake')),
+        Case('set_payment_provider_ref', 'write', lambda i: q.set_payment_provider_ref(pending[i], f'bench_{i}'), pool=len(pending)),
+        Case('transition_payment', 'write', lambda i: q.transition_payment(pending[i], 'captured'), pool=len(pending)),
+        Case('add_bike_photo', 'write', lambda i: q.add_bike_photo(free[i % len(free)], partner(i), f'bench{i}', f'{i:016x}', 1280, 960, thumb_file_id=f't{i}', catalog_file_id=f'c{i}')),
+        # pays every partner at once; later calls would find nothing to pay
+        Case('run_partner_payouts', 'write', lambda i: q.run_partner_payouts(1.0), pool=1),
+    ]
+
+
+async def _drain(gen):
+    async for _ in gen:
+        pass
+
+
+def summarize(latencies: list, elapsed: float, concurrency: int, errors: int, error: str = None) -> dict:
+    ms = sorted(x * 1000 for x in latencies) or [0.0]
+    q = percentiles(ms)
+    stats = {
+        'calls': len(latencies), 'concurrency': concurrency, 'errors': errors,
+        'p50_ms': round(q['p50'], 4), 'p95_ms': round(q['p95'], 4), 'p99_ms': round(q['p99'], 4),
+        'mean_ms': round(statistics.fmean(ms), 4), 'max_ms': round(ms[-1], 4),
+        'ops_per_s': round(len(latencies) / elapsed, 1) if elapsed > 0 else 0.0,
+    }
+    if error:
+        stats['error'] = error
+    return stats
+
+
+async def run_case(case, first: int, count: int, concurrency: int, user_cache) -> dict:
+    """Call case.call(first) .. case.call(first + count - 1), at most concurrency at a time."""
+    sem = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = []
+
+    async def one(i):
+        async with sem:
+            if case.cold:
+                user_cache.clear()
+            t0 = time.perf_counter()
+            try:
+                await case.call(i)
+            except Exception as e:
+                errors.append(repr(e))
+            else:
+                latencies.append(time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(first, first + count)))
+    elapsed = time.perf_counter() - t0
+    return summarize(latencies, elapsed, concurrency, len(errors), errors[0] if errors else None)
+
+
+async def run_child(args) -> dict:
+    from database.db import Base, engine, init_db
+    import database.queries as q
+    from tests.datagen import Dataset, seed
+    from utils.logger import logger
+
+    logger.setLevel('WARNING')
+    t0 = time.perf_counter()
+    d = Dataset(args.scale, seed=args.seed)
+    todo = cases(d, q)
+    if args.k:
+        todo = [c for c in todo if re.search(args.k, c.name)]
+    else:
+        public = {name for name, fn in inspect.getmembers(q, inspect.iscoroutinefunction) if fn.__module__ == q.__name__ and not name.startswith('_')}
+        public |= {name for name, fn in inspect.getmembers(q, inspect.isasyncgenfunction) if fn.__module__ == q.__name__ and not name.startswith('_')}
+        missing = sorted(public - {c.name.split(':')[0] for c in todo})
+        if missing:
+            raise SystemExit(f"no benchmark case for {', '.join(missing)} (add one to cases() in tests/query_bench.py)")
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+    await init_db()
+    await seed(d)
+    print(f'[{engine.dialect.name} n={args.scale:,}] seeded in {time.perf_counter() - t0:.1f} s', file=sys.stderr, flush=True)
+
+    results = {}
+    levels = [int(c) for c in args.concurrency.split(',')]
+    for case in todo:
+        used = 0
+        for level in levels:
+            count = args.scan_iterations if case.kind == 'scan' else args.iterations
+            if case.pool is not None:
+                count = min(count, case.pool - used)
+            if count <= 0:
+                break
+            stats = await run_case(case, used, count, min(level, count), q.user_cache)
+            used += count
+            results[f'{case.name}/c{level}'] = stats
+            print(f"  {case.name:34s} c={level:<3d} {format_stats(stats)}", file=sys.stderr, flush=True)
+    await engine.dispose()
+    return results
+
+
+def format_stats(s: dict) -> str:
+    line = (f"p50={s['p50_ms']:9.3f} ms  p95={s['p95_ms']:9.3f} ms  p99={s['p99_ms']:9.3f} ms  "
+            f"{s['ops_per_s']:9.1f}/s  calls={s['calls']}")
+    if s['errors']:
+        line += f"  errors={s['errors']} ({s.get('error')})"
+    return line
+
+
+def compare(base: dict, new: dict, metric: str, threshold: float, min_delta_ms: float) -> list:
+    """Print base vs new per case; returns the keys that regressed."""
+    regressions = []
+    for key in sorted(set(base) & set(new)):
+        b, n = base[key], new[key]
+        change = (n[metric] - b[metric]) / b[metric] if b[metric] else 0.0
+        note = ''
+        if n['errors'] and not b['errors']:
+            note = f"REGRESSION: {n['errors']} errors"
+        elif change > threshold and n[metric] - b[metric] > min_delta_ms:
+            note = 'REGRESSION'
+        elif change < -threshold and b[metric] - n[metric] > min_delta_ms:
+            note = 'faster'
+        if note.startswith('REGRESSION'):
+            regressions.append(key)
+        print(f'{key:60s} {b[metric]:10.3f} -> {n[metric]:10.3f} ms  {change:+7.1%}  {note}')
+    only_base, only_new = sorted(set(base) - set(new)), sorted(set(new) - set(base))
+    if only_base:
+        print(f"{len(only_base)} cases only in the baseline, e.g. {', '.join(only_base[:3])}")
+    if only_new:
+        print(f"{len(only_new)} cases not in the baseline, e.g. {', '.join(only_new[:3])}")
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--scales', default='10k', help='comma-separated: 10k, 100k, 1m or row counts')
+    parser.add_argument('--backends', default=None, help='comma-separated: sqlite, postgresql (default: sqlite, plus postgresql when BENCH_PG_URL is set)')
+    parser.add_argument('-c', '--concurrency', default='1', help='comma-separated concurrency levels')
+    parser.add_argument('--iterations', type=int, default=200, help='calls per read/write case and level')
+    parser.add_argument('--scan-iterations', type=int, default=3, help='calls per whole-table case and level')
+    parser.add_argument('-k', default=None, help='only cases whose name matches this regex')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='write the results here')
+    parser.add_argument('--compare', nargs='+', metavar='FILE', help='BASE (compare with this run) or BASE NEW (no run)')
+    parser.add_argument('--metric', choices=METRICS, default='p50_ms')
+    parser.add_argument('--threshold', type=float, default=0.25, help='relative slowdown counted as a regression')
+    parser.add_argument('--min-delta-ms', type=float, default=0.05, help='smaller absolute slowdowns are noise')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--scale', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(asyncio.run(run_child(args))))
+        return
+    if args.compare and len(args.compare) > 2:
+        parser.error('--compare takes BASE or BASE NEW')
+    if args.compare and len(args.compare) == 2:
+        with open(args.compare[0]) as f, open(args.compare[1]) as g:
+            regressions = compare(json.load(f)['results'], json.load(g)['results'], args.metric, args.threshold, args.min_delta_ms)
+        if regressions:
+            print(f'\n{len(regressions)} regressions')
+        sys.exit(1 if regressions else 0)
+
+    from tests.datagen import parse_scale
+
+    backends = args.backends.split(',') if args.backends else ['sqlite'] + (['postgresql'] if os.getenv('BENCH_PG_URL') else [])
+    results = {}
+    for backend in backends:
+        for scale in map(parse_scale, args.scales.split(',')):
+            path = None
+            if backend == 'postgresql':
+                url = os.environ['BENCH_PG_URL']
+            else:
+                path = temp_db_path()
+                url = f'sqlite+aiosqlite:///{path}'
+            env = dict(os.environ, DATABASE_URL=url, STATE_STORAGE_URL='memory://')
+            cmd = [sys.executable, '-m', 'tests.query_bench', '--child', '--scale', str(scale), '-c', args.concurrency,
+                   '--iterations', str(args.iterations), '--scan-iterations', str(args.scan_iterations), '--seed', str(args.seed)]
+            if args.k:
+                cmd += ['-k', args.k]
+            try:
+                out = subprocess.run(cmd, env=env, stdout=subprocess.PIPE, text=True, check=True).stdout
+            finally:
+                # a scale's database is done with; don't keep them all until exit
+                if path:
+                    remove_db(path)
+            for key, stats in json.loads(out.strip().splitlines()[-1]).items():
+                results[f'{backend}/{scale}/{key}'] = stats
+
+    report = {
+        'meta': {
+            'commit': git_commit(), 'date': datetime.datetime.utcnow().isoformat(timespec='seconds'),
+            'python': platform.python_version(), 'platform': platform.platform(), 'seed': args.seed,
+            'iterations': args.iterations, 'scan_iterations': args.scan_iterations, 'concurrency': args.concurrency,
+        },
+        'results': results,
+    }
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+        print(f'{len(results)} results written to {args.json}')
+    if args.compare:
+        with open(args.compare[0]) as f:
+            regressions = compare(json.load(f)['results'], results, args.metric, args.threshold, args.min_delta_ms)
+        if regressions:
+            print(f'\n{len(regressions)} regressions')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""Referral queries on a synthetic referral graph of -n users.
+
+Two thirds of the users were referred, by an earlier user picked with preferential
+attachment, so a few users end up with thousands of referrals and deep trees.
+Times count_referrals against the COUNT(*) it replaced, set_referrer /
+get_or_create_user with a referral code, the recursive tree queries and the
+leaderboard, then checks a sample of referral_count values against COUNT(*).
+
+Run from the repo root:  python -m tests.referral_bench -n 1000000
+"""
+import argparse
+import asyncio
+import random
+import time
+
+from tests.support import percentiles, use_temp_database
+
+use_temp_database()
+
+
+async def seed(n: int, rng, chunk: int = 50_000):
+    from sqlalchemy import insert
+    from database.db import engine
+    from database.models import User
+    from tests.datagen import referral_graph
+
+    referrer, counts = referral_graph(n, rng)
+    async with engine.begin() as conn:
+        for lo in range(1, n + 1, chunk):
+            await conn.execute(insert(User), [
+                {'id': i, 'telegram_id': i, 'referral_code': f'c{i}', 'referrer_id': referrer[i], 'referral_count': counts[i]}
+                for i in range(lo, min(lo + chunk, n + 1))
+            ])
+        await conn.exec_driver_sql('ANALYZE')
+    return counts
+
+
+async def timed(label: str, calls):
+    latencies = []
+    for call in calls:
+        t0 = time.perf_counter()
+        await call()
+        latencies.append((time.perf_counter() - t0) * 1000)
+    q = percentiles(latencies)
+    print(f'{label:48s} p50={q["p50"]:8.3f} ms  p95={q["p95"]:8.3f} ms  p99={q["p99"]:8.3f} ms')
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=1_000_000)
+    parser.add_argument('--samples', type=int, default=500)
+    args = parser.parse_args()
+
+    from sqlalchemy import func, select
+    from database.db import engine, get_session, init_db
+    from database.models import User
+    import database.queries as q
+    from services.referrals import Leaderboard
+
+    rng = random.Random(11)
+    await init_db()
+    t0 = time.perf_counter()
+    counts = await seed(args.n, rng)
+    top = max(range(1, args.n + 1), key=counts.__getitem__)
+    print(f'{args.n:,} users seeded in {time.perf_counter() - t0:.0f} s; top referrer {top} has {counts[top]:,} direct referrals')
+
+    users = [rng.randint(1, args.n) for _ in range(args.samples)]
+    heavy = sorted(range(1, args.n + 1), key=counts.__getitem__)[-20:]
+
+    async def old_count(telegram_id):
+        async with get_session() as s:
+            ref = (await s.execute(select(User).where(User.telegram_id == telegram_id))).scalars().first()
+            return (await s.execute(select(func.count()).select_from(User).where(User.referrer_id == ref.id))).scalar_one()
+
+    def uncached(fn, *a):
+        async def call():
+            q.user_cache.clear()
+            return await fn(*a)
+        return call
+
+    await timed('count_referrals, old COUNT(*) (random users)', [lambda u=u: old_count(u) for u in users])
+    await timed('count_referrals, old COUNT(*) (top 20)', [lambda u=u: old_count(u) for u in heavy])
+    await timed('count_referrals, column, uncached (top 20)', [uncached(q.count_referrals, u) for u in heavy])
+    for u in users:
+        await q.count_referrals(u)
+    await timed('count_referrals, column, cached', [lambda u=u: q.count_referrals(u) for u in users])
+
+    new_ids = range(args.n + 1, args.n + 1 + args.samples)
+    await timed('get_or_create_user(new, ref_code)', [lambda i=i, u=u: q.get_or_create_user(i, ref_code=f'c{u}') for i, u in zip(new_ids, users)])
+    plain_ids = range(args.n + 1 + args.samples, args.n + 1 + 2 * args.samples)
+    for i in plain_ids:
+        await q.get_or_create_user(i)
+    await timed('set_referrer', [lambda i=i, u=u: q.set_referrer(i, f'c{u}') for i, u in zip(plain_ids, users)])
+
+    await timed('referral_tree_counts depth 3 (random users)', [lambda u=u: q.referral_tree_counts(u, depth=3) for u in users[:100]])
+    await timed('referral_tree_counts depth 3 (top 20)', [lambda u=u: q.referral_tree_counts(u, depth=3) for u in heavy])
+    await timed('referral_tree depth 3, first 1000 rows (top 20)', [lambda u=u: q.referral_tree(u, depth=3) for u in heavy])
+    await timed('top_referrers(10)', [lambda: q.top_referrers(10) for _ in range(100)])
+    board = Leaderboard(size=10, max_age=60)
+    await timed('leaderboard.get() (cached)', [board.get for _ in range(1000)])
+    levels = await q.referral_tree_counts(top, depth=3)
+    print(f'top referrer tree: {levels}')
+
+    # seeded users have id == telegram_id
+    wrong = 0
+    async with engine.connect() as conn:
+        for u in users + heavy:
+            have = (await conn.execute(select(User.referral_count).where(User.telegram_id == u))).scalar_one()
+            real = (await conn.execute(select(func.count()).select_from(User).where(User.referrer_id == u))).scalar_one()
+            wrong += have != real
+    print(f'referral_count vs COUNT(*): {wrong} mismatches in {len(users) + len(heavy)} users')
+    await engine.dispose()
+    assert wrong == 0
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,111 @@
+"""Concurrent create_rental calls against a small fleet: throughput and double-bookings.
+
+Every call targets a random bike of the fleet; afterwards each bike must have at most
+one rental and the number of successful calls must equal the number of rentals.
+--legacy runs the old SELECT ... FOR UPDATE + UPDATE path for comparison.
+
+Run from the repo root:  python -m tests.reservation_load -n 5000 --fleet 50
+PostgreSQL is included when BENCH_PG_URL is set (postgresql+asyncpg://...; its tables are dropped).
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+from tests.support import temp_db_url
+
+
+async def legacy_create_rental(user_id: int, bike_id: int):
+    """create_rental before the conditional UPDATE: read, check, then write."""
+    from sqlalchemy import select
+    from database.db import get_session
+    from database.models import Bike, Rental
+
+    async with get_session() as s:
+        bike = (await s.execute(select(Bike).where(Bike.id == bike_id).with_for_update())).scalars().first()
+        if not bike or not bike.available:
+            return None
+        rental = Rental(user_id=user_id, bike_id=bike_id)
+        s.add(rental)
+        bike.available = False
+        await s.commit()
+        return rental
+
+
+async def run(n: int, fleet: int, legacy: bool):
+    from sqlalchemy import func, insert, select
+    from database.db import Base, engine, init_db
+    from database.models import Bike, Rental, User
+    from database.queries import create_rental
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+    await init_db()
+    async with engine.begin() as conn:
+        await conn.execute(insert(User), [{'telegram_id': i, 'referral_code': f'c{i}'} for i in range(1, n + 1)])
+        await conn.execute(insert(Bike), [{'name': f'b{i}', 'available': True} for i in range(fleet)])
+
+    rent = legacy_create_rental if legacy else create_rental
+    rng = random.Random(7)
+    errors = 0
+
+    async def attempt(user_id: int):
+        nonlocal errors
+        try:
+            return await rent(user_id, rng.randint(1, fleet)) is not None
+        except Exception:
+            errors += 1
+            return False
+
+    t0 = time.perf_counter()
+    results = await asyncio.gather(*(attempt(u) for u in range(1, n + 1)))
+    elapsed = time.perf_counter() - t0
+
+    async with engine.connect() as conn:
+        rentals = (await conn.execute(select(func.count()).select_from(Rental))).scalar_one()
+        per_bike = select(Rental.bike_id).group_by(Rental.bike_id).having(func.count() > 1).subquery()
+        double_booked = (await conn.execute(select(func.count()).select_from(per_bike))).scalar_one()
+        still_free = (await conn.execute(select(func.count()).select_from(Bike).where(Bike.available == True))).scalar_one()
+    await engine.dispose()
+    return {
+        'calls_per_s': round(n / elapsed, 1), 'succeeded': sum(results), 'rentals': rentals,
+        'double_booked_bikes': double_booked, 'free_bikes_left': still_free, 'errors': errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=5000, help='concurrent create_rental calls')
+    parser.add_argument('--fleet', type=int, default=50)
+    parser.add_argument('--legacy', action='store_true', help='also run the old read-then-write path')
+    parser.add_argument('--child', choices=['new', 'legacy'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(asyncio.run(run(args.n, args.fleet, args.child == 'legacy'))))
+        return
+
+    backends = [('sqlite', None)]
+    if os.getenv('BENCH_PG_URL'):
+        backends.append(('postgresql', os.environ['BENCH_PG_URL']))
+    failed = False
+    for backend, url in backends:
+        for variant in (['legacy', 'new'] if args.legacy else ['new']):
+            env = dict(os.environ, DATABASE_URL=url or temp_db_url())
+            out = subprocess.run([sys.executable, '-m', 'tests.reservation_load', '--child', variant, '-n', str(args.n), '--fleet', str(args.fleet)],
+                                 env=env, capture_output=True, text=True, check=True).stdout
+            result = json.loads(out.strip().splitlines()[-1])
+            print(f"{backend:10s} {variant:6s} " + ' '.join(f'{k}={v}' for k, v in result.items()))
+            if variant == 'new' and (result['double_booked_bikes'] or result['succeeded'] != result['rentals'] or result['errors']):
+                failed = True
+    if failed:
+        print('FAILED: double bookings or errors with the conditional UPDATE')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
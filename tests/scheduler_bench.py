@@ -0,0 +1,102 @@
+"""Rental deadlines at scale: services/rental_scheduler.py with -n open rentals.
+
+Seeds a SQLite database with -n open rentals spread over the last MAX_RENT_TIME_HOURS,
+--overdue of them already past the limit, then reports how long loading takes, the
+cost of opening/closing a rental in the heap, that the idle scheduler sends no SQL,
+and how fast overdue rentals are closed and billed.
+
+Run from the repo root:  python -m tests.scheduler_bench -n 100000 --overdue 2000
+"""
+import argparse
+import asyncio
+import datetime
+import random
+import time
+
+from tests.support import use_temp_database
+
+use_temp_database()
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=100_000, help='open rentals')
+    parser.add_argument('--overdue', type=int, default=2000, help='of which past MAX_RENT_TIME_HOURS')
+    parser.add_argument('--idle', type=float, default=2.0, help='seconds to watch the idle scheduler')
+    args = parser.parse_args()
+
+    from sqlalchemy import event, func, insert, select
+    from database.db import engine, init_db
+    from database.models import Bike, Rental, User
+    from services.billing import compute_fee
+    from services.rental_scheduler import RentalScheduler
+    from utils.logger import logger
+
+    logger.setLevel('WARNING')  # one line per closed rental otherwise
+
+    await init_db()
+    now = datetime.datetime.utcnow()
+    rng = random.Random(3)
+    scheduler = RentalScheduler(max_hours=24, remind_before=30)
+    limit = scheduler.max_time.total_seconds()
+    async with engine.begin() as conn:
+        await conn.execute(insert(User), [{'telegram_id': i, 'referral_code': f'c{i}'} for i in range(1, args.n + 1)])
+        await conn.execute(insert(Bike), [{'name': f'b{i}', 'available': False, 'price_per_hour': 4.0} for i in range(args.n)])
+        await conn.execute(insert(Rental), [
+            {'user_id': i, 'bike_id': i,
+             'start_at': now - datetime.timedelta(seconds=limit + rng.uniform(60, 3600) if i <= args.overdue else rng.uniform(0, limit - 3600))}
+            for i in range(1, args.n + 1)
+        ])
+
+    t0 = time.perf_counter()
+    loaded = await scheduler.load()
+    load_s = time.perf_counter() - t0
+
+    # a rental opened and closed again, as the listeners see it
+    ops = 20_000
+    t0 = time.perf_counter()
+    for i in range(ops):
+        scheduler.add(10_000_000 + i, 1, now)
+        scheduler.discard(10_000_000 + i)
+    churn_us = (time.perf_counter() - t0) / ops * 1e6
+
+    statements = 0
+
+    def count(*_):
+        nonlocal statements
+        statements += 1
+
+    async def close_overdue():
+        for kind, rental_id in scheduler.due():
+            if kind == 'close':
+                await scheduler._close(rental_id)
+
+    t0 = time.perf_counter()
+    await close_overdue()
+    close_s = time.perf_counter() - t0
+
+    # with the overdue rentals handled, nothing is due for about an hour
+    event.listen(engine.sync_engine, 'before_cursor_execute', count)
+    task = asyncio.create_task(scheduler.run())
+    await asyncio.sleep(args.idle)
+    task.cancel()
+    event.remove(engine.sync_engine, 'before_cursor_execute', count)
+
+    async with engine.connect() as conn:
+        still_open = (await conn.execute(select(func.count()).select_from(Rental).where(Rental.end_at.is_(None)))).scalar_one()
+        free = (await conn.execute(select(func.count()).select_from(Bike).where(Bike.available == True))).scalar_one()
+        sample = (await conn.execute(select(Rental.start_at, Rental.end_at, Rental.fee).where(Rental.end_at.is_not(None)).limit(1))).first()
+    await engine.dispose()
+
+    print(f'{loaded:,} open rentals loaded in {load_s * 1000:.0f} ms ({len(scheduler._heap):,} heap entries)')
+    print(f'open+close in the heap: {churn_us:.2f} us')
+    print(f'{scheduler.closed:,} overdue rentals closed in {close_s:.2f} s ({scheduler.closed / close_s:.0f}/s), '
+          f'{free:,} bikes freed, {still_open:,} still open')
+    print(f'idle for {args.idle:.0f} s: {statements} SQL statements')
+    if sample:
+        assert sample.fee == compute_fee(sample.start_at, sample.end_at, 4.0), sample
+    assert scheduler.closed == args.overdue and still_open == args.n - args.overdue and statements == 0
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,112 @@
+"""Cold start: time from process start to accepting updates, phase by phase.
+
+Each run starts a fresh interpreter that imports bot.py and runs bot.main() in polling mode,
+against a mock Bot API session that answers after --api-latency. The child reports its phases
+(utils/startup.py), when it became ready and when the reply to a /start queued before the
+start arrived. 'fresh' runs start on an empty database, 'existing' runs on one created before,
+where the schema check short-circuits. Finally, init_db on the existing database is compared
+with the full create_all + migrate pass it replaces.
+
+Run from the repo root:  python -m tests.startup_bench --runs 5 --api-latency 0.1
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+async def child(args):
+    from utils.startup import startup
+    import bot
+    from aiogram.types import Update
+    from tests.mock_session import MockSession
+
+    session = MockSession(api_latency=args.api_latency)
+    session.updates.put_nowait(Update.model_validate({'update_id': 1, 'message': {
+        'message_id': 1, 'date': int(time.time()), 'chat': {'id': 7, 'type': 'private'},
+        'from': {'id': 7, 'is_bot': False, 'first_name': 'U7'}, 'text': '/start'}}))
+    run = asyncio.create_task(bot.main(session=session))
+    while not any(type(c).__name__ == 'SendMessage' for c in session.calls):
+        if run.done():
+            run.result()
+            raise RuntimeError('bot stopped before answering')
+        await asyncio.sleep(0.001)
+    first_reply = time.perf_counter() - startup.started
+    report = startup.report()
+    run.cancel()
+    try:
+        await run
+    except asyncio.CancelledError:
+        pass
+    print(json.dumps({'phases_ms': report['phases_ms'], 'first_reply_ms': round(first_reply * 1000, 1)}))
+
+
+def spawn(db: str, api_latency: float) -> dict:
+    env = dict(os.environ, DATABASE_URL=f'sqlite+aiosqlite:///{db}', STATE_STORAGE_URL='memory://',
+               TELEGRAM_TOKEN='42:STARTUP', BOT_MODE='polling', LOG_LEVEL='WARNING', METRICS_PORT='0')
+    t0 = time.perf_counter()
+    out = subprocess.run([sys.executable, '-m', 'tests.startup_bench', '--child', '--api-latency', str(api_latency)],
+                         env=env, capture_output=True, text=True, check=True)
+    result = json.loads(out.stdout.strip().splitlines()[-1])
+    result['process_ms'] = round((time.perf_counter() - t0) * 1000, 1)
+    return result
+
+
+def summarize(name: str, runs: list):
+    phases = list(runs[0]['phases_ms'])
+    print(f"{name}: process to first reply {statistics.median(r['process_ms'] for r in runs):.0f} ms, "
+          f"bot.py import to first reply {statistics.median(r['first_reply_ms'] for r in runs):.0f} ms (median of {len(runs)})")
+    print('   ' + ', '.join(f"{p} {statistics.median(r['phases_ms'].get(p, 0) for r in runs):.1f} ms" for p in phases))
+
+
+async def compare_schema_check(db: str, iterations: int):
+    os.environ['DATABASE_URL'] = f'sqlite+aiosqlite:///{db}'
+    from database.db import Base, engine, init_db
+    from database.migrations import migrate
+
+    async def full():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        await migrate(engine)
+
+    await init_db()
+    for name, fn in (('create_all + migrate', full), ('init_db', init_db)):
+        times = []
+        for _ in range(iterations):
+            await engine.dispose()  # a new process starts without pooled connections
+            t0 = time.perf_counter()
+            await fn()
+            times.append((time.perf_counter() - t0) * 1000)
+        print(f'{name:22s} median {statistics.median(times):.2f} ms on a current schema')
+    await engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--api-latency', type=float, default=0.1, help='seconds each Bot API call takes')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        asyncio.run(child(args))
+        return
+
+    fresh, existing = [], []
+    with tempfile.TemporaryDirectory() as tmp:
+        for i in range(args.runs):
+            fresh.append(spawn(os.path.join(tmp, f'fresh{i}.db'), args.api_latency))
+        db = os.path.join(tmp, 'fresh0.db')
+        for _ in range(args.runs):
+            existing.append(spawn(db, args.api_latency))
+        summarize('fresh database', fresh)
+        summarize('existing database', existing)
+        asyncio.run(compare_schema_check(db, 20))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""Conversation state store: lookups per second and memory per 100k idle sessions.
+
+Run from the repo root:  python -m tests.state_bench -n 100000
+"""
+import argparse
+import asyncio
+import time
+import tracemalloc
+
+from tests.support import remove_db, temp_db_path
+
+
+def session_record(i: int) -> dict:
+    return {'flow': 'customer', 'step': 'phone', 'ref_code': None, 'first_name': f'Ism{i}', 'last_name': 'Familiya Otchestvo'}
+
+
+async def bench_lookups(store, n: int, label: str):
+    keys = list(range(n))
+    t0 = time.perf_counter()
+    for k in keys:
+        await store.get(k)
+    hit = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for k in keys:
+        await store.get(n + k)
+    miss = time.perf_counter() - t0
+    print(f'{label}: get hit {n / hit:,.0f}/s, get miss {n / miss:,.0f}/s')
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=100000, help='idle sessions')
+    args = parser.parse_args()
+    n = args.n
+
+    from utils.state_storage import StateStore, SQLiteStateBackend
+
+    # memory only
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    store = StateStore(ttl=3600, max_entries=n)
+    t0 = time.perf_counter()
+    for i in range(n):
+        await store.set(i, session_record(i))
+    elapsed = time.perf_counter() - t0
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    print(f'memory: set {n / elapsed:,.0f}/s, {used / 1024 / 1024:.1f} MiB for {n:,} sessions '
+          f'({used / n:.0f} B/session, {used / n * 100000 / 1024 / 1024:.1f} MiB per 100k)')
+    await bench_lookups(store, n, 'memory')
+
+    # SQLite write-through, then a restart that warms the cache from disk
+    path = temp_db_path()
+    try:
+        durable = StateStore(ttl=3600, max_entries=n, backend=SQLiteStateBackend(path))
+        t0 = time.perf_counter()
+        for i in range(n):
+            await durable.set(i, session_record(i))
+        elapsed = time.perf_counter() - t0
+        print(f'sqlite write-through: set {n / elapsed:,.0f}/s')
+        await durable.close()
+
+        restarted = StateStore(ttl=3600, max_entries=n, backend=SQLiteStateBackend(path))
+        t0 = time.perf_counter()
+        await restarted.open()
+        print(f'sqlite warm start: {len(restarted):,} sessions restored in {time.perf_counter() - t0:.2f}s')
+        await bench_lookups(restarted, n, 'sqlite (warm)')
+        await restarted.close()
+
+        # cache smaller than the durable set: misses fall through to SQLite
+        capped = StateStore(ttl=3600, max_entries=n // 10, backend=SQLiteStateBackend(path))
+        await capped.open()
+        await bench_lookups(capped, n, f'sqlite (cache capped at {n // 10:,})')
+        print('capped cache stats:', capped.stats())
+        await capped.close()
+    finally:
+        remove_db(path)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
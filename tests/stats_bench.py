@@ -0,0 +1,75 @@
+"""/stats cost at scale: full-table aggregates vs counter read vs in-process snapshot.
+
+Run from the repo root:  python -m tests.stats_bench -n 1000000
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from tests.support import use_temp_database
+
+use_temp_database(keep_url=True)
+
+
+async def seed(n: int, chunk: int = 50_000):
+    """n users (every 10th a partner) and n rentals over half of them, inserted in bulk."""
+    import datetime
+    from sqlalchemy import insert
+    from database.db import engine
+    from database.models import User, Bike, Rental
+
+    now = datetime.datetime.utcnow()
+    async with engine.begin() as conn:
+        for lo in range(0, n, chunk):
+            await conn.execute(insert(User), [
+                {'telegram_id': i, 'is_partner': i % 10 == 0, 'referral_code': f'c{i}', 'created_at': now}
+                for i in range(lo + 1, min(lo + chunk, n) + 1)
+            ])
+        await conn.execute(insert(Bike), [{'name': 'b', 'partner_id': 10, 'available': True}])
+        for lo in range(0, n, chunk):
+            await conn.execute(insert(Rental), [
+                {'user_id': i % (n // 2) + 1, 'bike_id': 1, 'start_at': now, 'fee': 1.0}
+                for i in range(lo, min(lo + chunk, n))
+            ])
+
+
+async def timed(label: str, fn, repeat: int):
+    latencies = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = await fn()
+        latencies.append((time.perf_counter() - t0) * 1000)
+    print(f'{label}: median {statistics.median(latencies):.3f} ms, max {max(latencies):.3f} ms  {result}')
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=1_000_000, help='users and rentals to seed')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    from database.db import init_db, get_session
+    from database.queries import _count_stats, admin_stats
+    from services.stats import StatsSnapshot, reconcile_once
+
+    await init_db()
+    t0 = time.perf_counter()
+    await seed(args.n)
+    print(f'seeded {args.n} users and rentals in {time.perf_counter() - t0:.1f} s')
+    t0 = time.perf_counter()
+    await reconcile_once(fix=True)
+    print(f'counter backfill/check: {time.perf_counter() - t0:.2f} s')
+
+    async def aggregates():
+        async with get_session() as s:
+            return await _count_stats(s)
+
+    snapshot = StatsSnapshot(max_age=30)
+    await timed('full-table aggregates (before)', aggregates, args.repeat)
+    await timed('counter read                  ', admin_stats, args.repeat * 20)
+    await timed('snapshot (max_age=30s)        ', snapshot.get, args.repeat * 200)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,57 @@
+"""Shared setup for the test and benchmark scripts: throwaway SQLite databases and percentiles.
+
+use_temp_database() must run before anything reads config (database, services, bot), so call
+it right after the imports, as the scripts do:
+
+    from tests.support import use_temp_database
+    use_temp_database(admin_ids='1')
+
+Every database file made here, with its -wal, -shm and -journal files, is removed at exit.
+"""
+import atexit
+import os
+import statistics
+import tempfile
+
+
+def remove_db(path: str):
+    """Delete an SQLite file and its side files, whichever exist."""
+    for name in (path, path + '-wal', path + '-shm', path + '-journal'):
+        try:
+            os.remove(name)
+        except FileNotFoundError:
+            pass
+
+
+def temp_db_path() -> str:
+    """A new empty SQLite file, removed at exit."""
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    atexit.register(remove_db, path)
+    return path
+
+
+def temp_db_url() -> str:
+    return f'sqlite+aiosqlite:///{temp_db_path()}'
+
+
+def use_temp_database(keep_url: bool = False, admin_ids: str = None):
+    """Point DATABASE_URL at a new SQLite file and keep conversation state in memory.
+
+    keep_url=True leaves a DATABASE_URL that is already set alone, so the script can run on
+    Postgres. admin_ids replaces ADMIN_IDS (comma-separated).
+    """
+    if not (keep_url and os.environ.get('DATABASE_URL')):
+        os.environ['DATABASE_URL'] = temp_db_url()
+    os.environ['STATE_STORAGE_URL'] = 'memory://'
+    if admin_ids is not None:
+        os.environ['ADMIN_IDS'] = admin_ids
+
+
+def percentiles(values, scale: float = 1.0) -> dict:
+    """p50, p95, p99 and max of values times scale (1000 turns seconds into ms); zeros when empty."""
+    xs = sorted(v * scale for v in values)
+    if not xs:
+        return {'p50': 0.0, 'p95': 0.0, 'p99': 0.0, 'max': 0.0}
+    q = statistics.quantiles(xs, n=100, method='inclusive') if len(xs) > 1 else xs * 99
+    return {'p50': q[49], 'p95': q[94], 'p99': q[98], 'max': xs[-1]}
@@ -0,0 +1,77 @@
+"""Connection checkouts and latency of the customer passport step: one session per query vs one per update.
+
+Run from the repo root:  python -m tests.uow_bench -n 500
+"""
+import argparse
+import asyncio
+import time
+
+from tests.support import percentiles, use_temp_database
+
+use_temp_database(keep_url=True)
+
+
+async def passport_step(telegram_id: int, ref_code: str, session=None):
+    """The DB calls customer.passport_step makes, in the same order."""
+    from database.queries import get_or_create_user, update_user_profile, set_referrer, pick_main_bike, create_rental, count_referrals
+
+    user = await get_or_create_user(telegram_id, session=session)
+    await update_user_profile(telegram_id, first_name='Ali', last_name='Valiyev', phone='+998901234567', lat=41.3, lon=69.2, passport_id='AA1234567', session=session)
+    await set_referrer(telegram_id, ref_code, session=session)
+    bike = await pick_main_bike(session=session)
+    rental = await create_rental(user.id, bike.id, session=session)
+    await count_referrals(user.telegram_id, session=session)
+    return rental
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=500)
+    args = parser.parse_args()
+
+    from sqlalchemy import event, update
+    from database.db import init_db, engine, get_session
+    from database.models import Bike
+    from database.queries import get_or_create_user, create_bike_for_partner, set_main_bike, user_cache
+
+    await init_db()
+    referrer = await get_or_create_user(1)
+    bike = await create_bike_for_partner(partner_id=referrer.id, name='Main', price_per_hour=10.0, code='M1')
+    await set_main_bike(bike.id)
+
+    counters = {'checkouts': 0, 'commits': 0}
+    event.listen(engine.sync_engine.pool, 'checkout', lambda *a: counters.__setitem__('checkouts', counters['checkouts'] + 1))
+    event.listen(engine.sync_engine, 'commit', lambda *a: counters.__setitem__('commits', counters['commits'] + 1))
+
+    async def release_bike():
+        async with engine.begin() as conn:
+            await conn.execute(update(Bike).values(available=True))
+
+    async def run(label: str, shared: bool, base_tid: int):
+        latencies = []
+        checkouts = commits = 0
+        for i in range(args.n):
+            await release_bike()
+            user_cache.clear()
+            counters['checkouts'] = counters['commits'] = 0
+            t0 = time.perf_counter()
+            if shared:
+                async with get_session() as session:
+                    rental = await passport_step(base_tid + i, referrer.referral_code, session=session)
+                    await session.commit()
+            else:
+                rental = await passport_step(base_tid + i, referrer.referral_code)
+            latencies.append((time.perf_counter() - t0) * 1000)
+            assert rental is not None
+            checkouts += counters['checkouts']
+            commits += counters['commits']
+        q = percentiles(latencies)
+        print(f'{label}: {checkouts / args.n:.1f} checkouts/update, {commits / args.n:.1f} commits/update, '
+              f'latency ms p50={q["p50"]:.2f} p95={q["p95"]:.2f} p99={q["p99"]:.2f}')
+
+    await run('session per query (before)', False, 100_000)
+    await run('session per update (after) ', True, 200_000)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,96 @@
+"""Concurrent user upserts: no duplicate-key failures, and the statements each call costs.
+
+Run from the repo root (SQLite temp DB by default, or point DATABASE_URL at Postgres):
+    python -m tests.upsert_test
+"""
+import asyncio
+import time
+
+from tests.support import use_temp_database
+
+use_temp_database(keep_url=True)
+
+
+async def main():
+    from sqlalchemy import event, func, select
+    from database.db import init_db, engine, get_session
+    from database.models import User
+    from database.queries import get_or_create_user, register_partner, update_user_profile, bulk_upsert_users, user_cache
+
+    await init_db()
+    statements = []
+
+    def record(conn, cursor, stmt, *args):
+        # transaction control (SQLite's BEGIN IMMEDIATE) is not a query
+        if not stmt.lstrip().upper().startswith('BEGIN'):
+            statements.append(stmt)
+    event.listen(engine.sync_engine, 'before_cursor_execute', record)
+
+    async def count_statements(coro):
+        user_cache.clear()
+        statements.clear()
+        await coro
+        return len(statements)
+
+    # new user: lookup, insert, users counter; an existing one is a single read
+    expected = {
+        'get_or_create_user (new)': (get_or_create_user, (1,), {}, 3),
+        'get_or_create_user (existing)': (get_or_create_user, (1,), {}, 1),
+        'update_user_profile': (update_user_profile, (1,), {'first_name': 'Ali', 'phone': '+998901234567'}, 1),
+        'register_partner': (register_partner, (1,), {}, 2),
+        'register_partner (again)': (register_partner, (1,), {}, 2),
+    }
+    print('statements per call:')
+    for name, (fn, args, kwargs, want) in expected.items():
+        got = await count_statements(fn(*args, **kwargs))
+        print(f'  {name + ":":31}{got}')
+        assert got == want, (name, got, want, statements)
+    # the existing-user lookup writes nothing
+    await count_statements(get_or_create_user(1))
+    assert statements[0].lstrip().upper().startswith('SELECT'), statements
+    user_cache.clear()
+    await get_or_create_user(1)
+    statements.clear()
+    await get_or_create_user(1)
+    print(f'  {"get_or_create_user (cached):":31}{len(statements)}')
+    assert not statements, statements
+
+    # many coroutines race to create the same new users
+    ids = list(range(1000, 1200))
+    per_id = 10
+    user_cache.clear()
+    t0 = time.perf_counter()
+    calls = [get_or_create_user(tid) for tid in ids for _ in range(per_id)]
+    calls += [register_partner(tid) for tid in ids[::4]]
+    results = await asyncio.gather(*calls, return_exceptions=True)
+    elapsed = time.perf_counter() - t0
+    errors = [r for r in results if isinstance(r, Exception)]
+    by_tid = {}
+    for r in results:
+        if not isinstance(r, Exception):
+            by_tid.setdefault(r.telegram_id, set()).add(r.id)
+    async with get_session() as session:
+        rows = (await session.execute(select(func.count()).select_from(User).where(User.telegram_id.in_(ids)))).scalar_one()
+        partners = (await session.execute(select(func.count()).select_from(User).where(User.telegram_id.in_(ids), User.is_partner == True))).scalar_one()
+    print(f'concurrent upserts: {len(calls)} calls in {elapsed:.2f}s, errors={len(errors)}, rows={rows}/{len(ids)}, partners={partners}/{len(ids[::4])}')
+    assert not errors, errors[:3]
+    assert rows == len(ids)
+    assert partners == len(ids[::4])
+    assert all(len(v) == 1 for v in by_tid.values())
+
+    # bulk import
+    n = 20000
+    t0 = time.perf_counter()
+    await bulk_upsert_users([{'telegram_id': 10_000_000 + i, 'first_name': f'User{i}'} for i in range(n)])
+    elapsed = time.perf_counter() - t0
+    print(f'bulk_upsert_users: {n} rows in {elapsed:.2f}s ({n / elapsed:,.0f} rows/s)')
+    # re-import updates in place instead of failing on the unique key
+    await bulk_upsert_users([{'telegram_id': 10_000_000 + i, 'first_name': 'Renamed'} for i in range(100)])
+    async with get_session() as session:
+        renamed = (await session.execute(select(func.count()).select_from(User).where(User.first_name == 'Renamed'))).scalar_one()
+    assert renamed == 100
+    print('OK')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
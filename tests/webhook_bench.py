@@ -0,0 +1,141 @@
+"""Per-update latency of webhook mode vs long polling, without the Telegram API.
+
+Run from the repo root:  python -m tests.webhook_bench --mode both -n 2000 --rtt 0.05
+"""
+import argparse
+import asyncio
+import time
+
+from tests.support import percentiles, use_temp_database
+
+use_temp_database(keep_url=True)
+
+
+def synthetic_update(update_id: int, user_id: int, text: str) -> dict:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'},
+            'text': text,
+        },
+    }
+
+
+def make_updates(n: int, base_id: int):
+    texts = ['/start', '/admin']
+    return [synthetic_update(base_id + i, base_id + i, texts[i % len(texts)]) for i in range(n)]
+
+
+def report(name: str, started: dict, done: dict, wall: float):
+    lat = [done[k] - started[k] for k in done if k in started]
+    if not lat:
+        print(f'{name}: no updates processed')
+        return
+    q = percentiles(lat, 1000)
+    print(f'{name}: {len(lat)} updates in {wall:.2f}s ({len(lat) / wall:.0f} upd/s) '
+          f'latency ms p50={q["p50"]:.1f} p95={q["p95"]:.1f} p99={q["p99"]:.1f} max={q["max"]:.1f}')
+
+
+async def bench_webhook(dp, payloads, concurrency: int, rtt: float, done: dict, all_done: asyncio.Event):
+    import aiohttp
+    from aiogram import Bot
+    from services.webhook import UpdateQueue, create_app, start_server
+    from tests.mock_session import MockSession
+
+    bot = Bot(token='42:MOCK', session=MockSession())
+    queue = UpdateQueue(dp, bot)
+    queue.start()
+    secret = 'bench-secret'
+    runner = await start_server(create_app(bot, queue, path='/webhook', secret=secret), host='127.0.0.1', port=0)
+    port = runner.addresses[0][1]
+    url = f'http://127.0.0.1:{port}/webhook'
+
+    started = {}
+    sem = asyncio.Semaphore(concurrency)
+    t0 = time.perf_counter()
+    async with aiohttp.ClientSession(headers={'X-Telegram-Bot-Api-Secret-Token': secret}) as http:
+        async def post(payload):
+            async with sem:
+                started[payload['update_id']] = time.perf_counter()
+                # one-way Telegram -> server delay
+                await asyncio.sleep(rtt / 2)
+                while True:
+                    async with http.post(url, json=payload) as resp:
+                        if resp.status != 503:
+                            break
+                    await asyncio.sleep(0.01)
+        await asyncio.gather(*(post(p) for p in payloads))
+        await all_done.wait()
+    wall = time.perf_counter() - t0
+    await runner.cleanup()
+    await queue.stop()
+    report(f'webhook (workers={queue.concurrency}, rejected={queue.rejected})', started, done, wall)
+
+
+async def bench_polling(dp, payloads, concurrency: int, rtt: float, done: dict, all_done: asyncio.Event):
+    from aiogram import Bot
+    from aiogram.types import Update
+    from tests.mock_session import MockSession
+
+    session = MockSession(poll_rtt=rtt)
+    bot = Bot(token='42:MOCK', session=session)
+    polling = asyncio.create_task(dp.start_polling(bot, handle_signals=False, close_bot_session=False, polling_timeout=1))
+
+    started = {}
+    sem = asyncio.Semaphore(concurrency)
+    t0 = time.perf_counter()
+
+    async def arrive(payload):
+        async with sem:
+            started[payload['update_id']] = time.perf_counter()
+            await session.updates.put(Update.model_validate(payload, context={'bot': bot}))
+            await asyncio.sleep(0)
+    await asyncio.gather(*(arrive(p) for p in payloads))
+    await all_done.wait()
+    wall = time.perf_counter() - t0
+    await dp.stop_polling()
+    await polling
+    report('polling', started, done, wall)
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', choices=['webhook', 'polling', 'both'], default='both')
+    parser.add_argument('-n', type=int, default=2000, help='updates per mode')
+    parser.add_argument('-c', '--concurrency', type=int, default=64, help='concurrent senders')
+    parser.add_argument('--rtt', type=float, default=0.05, help='simulated Telegram round trip, seconds')
+    args = parser.parse_args()
+
+    from bot import build_dispatcher
+    from database.db import init_db
+
+    await init_db()
+    dp = build_dispatcher()
+
+    done = {}
+    state = {'expected': 0, 'event': None}
+
+    @dp.update.outer_middleware()
+    async def track(handler, event, data):
+        try:
+            return await handler(event, data)
+        finally:
+            done[event.update_id] = time.perf_counter()
+            if len(done) >= state['expected']:
+                state['event'].set()
+
+    modes = ['webhook', 'polling'] if args.mode == 'both' else [args.mode]
+    for i, mode in enumerate(modes):
+        done.clear()
+        state['expected'] = args.n
+        state['event'] = asyncio.Event()
+        payloads = make_updates(args.n, base_id=(i + 1) * 10_000_000)
+        runner = bench_webhook if mode == 'webhook' else bench_polling
+        await runner(dp, payloads, args.concurrency, args.rtt, done, state['event'])
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,8 +1,173 @@
+# Logging: the 'velobike' logger hands records to a queue; a listener thread formats and writes them.
+#
+# Nothing on the event loop waits on stderr. The QueueHandler only resolves the message and
+# enqueues the record (a record that finds LOG_QUEUE_SIZE others waiting is dropped and counted);
+# formatting, tracebacks included, and the write happen on the listener thread. Before a record is
+# queued, DEBUG records are sampled down to LOG_DEBUG_SAMPLE and a warning or error repeated more
+# than LOG_REPEAT_LIMIT times per LOG_REPEAT_WINDOW seconds is suppressed, so an error storm costs
+# a dict lookup per call. Records logged while an update is handled carry its update_id and user_id
+# (LogContextMiddleware).
+import atexit
+import contextvars
+import datetime
+import json
 import logging
+import queue
+import random
+import time
+from logging.handlers import QueueHandler, QueueListener
+from aiogram import BaseMiddleware
+from config import LOG_LEVEL, LOG_FORMAT, LOG_QUEUE_SIZE, LOG_DEBUG_SAMPLE, LOG_REPEAT_LIMIT, LOG_REPEAT_WINDOW
+
+# {'update_id': ..., 'user_id': ...} of the update being handled
+log_context = contextvars.ContextVar('log_context', default=None)
+
+
+class ContextFilter(logging.Filter):
+    """Sampling, repeat limiting and correlation fields.
+
+    Runs on the calling thread (the event loop, for handlers) before the record is queued, so the
+    update's log_context is still visible and dropped records never reach the queue.
+    """
+
+    def __init__(self, debug_sample: float = LOG_DEBUG_SAMPLE, repeat_limit: int = LOG_REPEAT_LIMIT,
+                 repeat_window: float = LOG_REPEAT_WINDOW, clock=time.monotonic, rng=random.random):
+        super().__init__()
+        self.debug_sample = debug_sample
+        self.repeat_limit = repeat_limit
+        self.repeat_window = repeat_window
+        self._clock = clock
+        self._rng = rng
+        self._repeats = {}  # (logger, level, message template, exception type) -> [window start, count]
+        self.sampled_out = 0
+        self.suppressed = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.INFO:
+            if self.debug_sample < 1 and self._rng() >= self.debug_sample:
+                self.sampled_out += 1
+                return False
+        elif record.levelno >= logging.WARNING and self.repeat_limit:
+            key = (record.name, record.levelno, record.msg if isinstance(record.msg, str) else type(record.msg),
+                   record.exc_info[0] if record.exc_info else None)
+            now = self._clock()
+            entry = self._repeats.get(key)
+            if entry is None or now - entry[0] >= self.repeat_window:
+                if entry is not None and entry[1] > self.repeat_limit:
+                    record.suppressed = entry[1] - self.repeat_limit
+                if len(self._repeats) >= 10_000:
+                    self._repeats.clear()
+                self._repeats[key] = [now, 1]
+            else:
+                entry[1] += 1
+                if entry[1] > self.repeat_limit:
+                    self.suppressed += 1
+                    return False
+        context = log_context.get()
+        if context:
+            record.__dict__.update(context)
+        return True
+
+
+class _QueueHandler(QueueHandler):
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord):
+        # resolve the message while its arguments are current; the traceback is formatted by the listener
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(message)s')
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        text = super().formatMessage(record)
+        if getattr(record, 'update_id', None) is not None:
+            text += f' [update {record.update_id} user {record.user_id}]'
+        if getattr(record, 'suppressed', 0):
+            text += f' ({record.suppressed} similar suppressed)'
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, logger, msg, the update context and exc when present."""
+
+    FIELDS = ('update_id', 'user_id', 'suppressed')
+
+    def format(self, record: logging.LogRecord) -> str:
+        out = {
+            'ts': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname, 'logger': record.name, 'msg': record.getMessage(),
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                out[field] = value
+        if record.exc_info:
+            out['exc'] = self.formatException(record.exc_info)
+        if record.stack_info:
+            out['stack'] = record.stack_info
+        return json.dumps(out, ensure_ascii=False, default=str)
+
+
+def attach(target: logging.Logger, stream=None, fmt: str = LOG_FORMAT, queue_size: int = LOG_QUEUE_SIZE,
+           context_filter: ContextFilter = None) -> QueueListener:
+    """Route target's records through a queue to a started listener writing to stream (stderr)."""
+    sink = logging.StreamHandler(stream)
+    sink.setFormatter(JsonFormatter() if fmt == 'json' else TextFormatter())
+    q = queue.Queue(queue_size)
+    enqueue = _QueueHandler(q)
+    enqueue.addFilter(context_filter or ContextFilter())
+    target.addHandler(enqueue)
+    listener = QueueListener(q, sink)
+    listener.handler = enqueue
+    listener.start()
+    return listener
+
+
+def stop(listener: QueueListener):
+    """Write out what is queued and stop the listener thread."""
+    if listener._thread is None:
+        return
+    # QueueListener.stop() enqueues its sentinel without waiting for room
+    while listener.queue.full():
+        time.sleep(0.01)
+    listener.stop()
+
+
+class LogContextMiddleware(BaseMiddleware):
+    """Outer update middleware: records logged while an update is handled carry its ids."""
+
+    async def __call__(self, handler, event, data):
+        user = data.get('event_from_user')
+        token = log_context.set({'update_id': event.update_id, 'user_id': user.id if user else None})
+        t0 = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Update %s handled in %.1f ms", event.update_id, (time.perf_counter() - t0) * 1000)
+            log_context.reset(token)
+
+
+def stats() -> dict:
+    handler = listener.handler
+    return {'queued': listener.queue.qsize(), 'dropped': handler.dropped,
+            'sampled_out': handler.filters[0].sampled_out, 'suppressed': handler.filters[0].suppressed}
+
 
 logger = logging.getLogger('velobike')
-handler = logging.StreamHandler()
-formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
-handler.setFormatter(formatter)
-logger.addHandler(handler)
-logger.setLevel(logging.INFO)
+logger.setLevel(LOG_LEVEL)
+listener = attach(logger)
+atexit.register(stop, listener)
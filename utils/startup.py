@@ -0,0 +1,56 @@
+# Cold start timing and readiness.
+#
+# bot.py marks the end of each startup phase (imports, token, database, dispatcher, startup hooks)
+# and one line with every phase is logged when the bot starts accepting updates. Readiness is
+# served as GET READY_PATH on the webhook and metrics servers (200 when ready, 503 before and
+# while shutting down) and, for workers without a port, as READY_FILE: written when ready,
+# removed on shutdown. Import this module first; the import phase is timed from its import.
+import os
+import time
+from config import READY_FILE
+
+
+class Startup:
+    def __init__(self, clock=time.perf_counter):
+        self._clock = clock
+        self.started = self._last = clock()
+        self.phases = []  # (name, seconds)
+        self.ready = False
+
+    def mark(self, phase: str):
+        """End the current phase, naming it."""
+        now = self._clock()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    def set_ready(self):
+        if self.ready:
+            return
+        from utils.logger import logger
+
+        self.ready = True
+        total = self._clock() - self.started
+        logger.info("Ready in %.0f ms (%s)", total * 1000, ', '.join(f'{name} {s * 1000:.0f} ms' for name, s in self.phases))
+        if READY_FILE:
+            with open(READY_FILE, 'w') as f:
+                f.write(f'{os.getpid()}\n')
+
+    def set_not_ready(self):
+        self.ready = False
+        if READY_FILE:
+            try:
+                os.remove(READY_FILE)
+            except FileNotFoundError:
+                pass
+
+    def report(self) -> dict:
+        return {'ready': self.ready, 'phases_ms': {name: round(s * 1000, 1) for name, s in self.phases}}
+
+
+async def handle_ready(request):
+    from aiohttp import web
+
+    return web.json_response(startup.report(), status=200 if startup.ready else 503)
+
+
+startup = Startup()
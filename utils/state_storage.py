@@ -0,0 +1,249 @@
+"""Conversation state shared by the onboarding wizards and aiogram's FSM.
+
+State lives in an in-memory TTL/LRU cache. With a durable backend configured
+(``STATE_STORAGE_URL``) every write goes through to it and the cache is warmed
+from it on startup, so flows in progress survive a restart.
+"""
+import asyncio
+import json
+import time
+from urllib.parse import urlparse
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from config import STATE_STORAGE_URL, STATE_TTL_SECONDS, STATE_MAX_ENTRIES
+from utils.cache import TTLCache
+from utils.logger import logger
+
+
+class SQLiteStateBackend:
+    """Durable key/value store in a local SQLite file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = None
+        self._lock = asyncio.Lock()
+
+    async def _db(self):
+        if self._conn is None:
+            async with self._lock:
+                if self._conn is None:
+                    import aiosqlite
+                    conn = await aiosqlite.connect(self.path)
+                    await conn.execute('PRAGMA journal_mode=WAL')
+                    await conn.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)')
+                    await conn.execute('CREATE INDEX IF NOT EXISTS ix_state_expires_at ON state (expires_at)')
+                    await conn.commit()
+                    self._conn = conn
+        return self._conn
+
+    async def get(self, key: str):
+        db = await self._db()
+        async with db.execute('SELECT value FROM state WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)', (key, time.time())) as cur:
+            row = await cur.fetchone()
+        return row[0] if row else None
+
+    async def set(self, key: str, value: str, ttl: float = None):
+        db = await self._db()
+        expires_at = time.time() + ttl if ttl else None
+        await db.execute('INSERT OR REPLACE INTO state (key, value, expires_at) VALUES (?, ?, ?)', (key, value, expires_at))
+        await db.commit()
+
+    async def delete(self, key: str):
+        db = await self._db()
+        await db.execute('DELETE FROM state WHERE key = ?', (key,))
+        await db.commit()
+
+    async def load(self, limit: int):
+        """Live entries as (key, value, seconds_left), longest-lived first."""
+        db = await self._db()
+        now = time.time()
+        async with db.execute(
+            'SELECT key, value, expires_at FROM state WHERE expires_at IS NULL OR expires_at > ? '
+            'ORDER BY expires_at IS NULL DESC, expires_at DESC LIMIT ?', (now, limit)
+        ) as cur:
+            rows = await cur.fetchall()
+        return [(k, v, (exp - now) if exp else None) for k, v, exp in rows]
+
+    async def purge_expired(self):
+        db = await self._db()
+        await db.execute('DELETE FROM state WHERE expires_at <= ?', (time.time(),))
+        await db.commit()
+
+    async def close(self):
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+
+class RedisStateBackend:
+    """Durable store on any Redis-protocol server (Redis, Valkey, KeyDB, ...)."""
+
+    def __init__(self, url: str, prefix: str = 'velobike:state:'):
+        try:
+            import redis.asyncio as redis
+        except ImportError as e:
+            raise RuntimeError("STATE_STORAGE_URL points to Redis but the 'redis' package is not installed") from e
+        self._redis = redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+
+    async def get(self, key: str):
+        return await self._redis.get(self.prefix + key)
+
+    async def set(self, key: str, value: str, ttl: float = None):
+        await self._redis.set(self.prefix + key, value, ex=int(ttl) if ttl else None)
+
+    async def delete(self, key: str):
+        await self._redis.delete(self.prefix + key)
+
+    async def load(self, limit: int):
+        rows = []
+        async for k in self._redis.scan_iter(match=self.prefix + '*', count=1000):
+            async with self._redis.pipeline(transaction=False) as pipe:
+                value, ttl = await pipe.get(k).ttl(k).execute()
+            if value is not None:
+                rows.append((k[len(self.prefix):], value, ttl if ttl and ttl > 0 else None))
+            if len(rows) >= limit:
+                break
+        return rows
+
+    async def purge_expired(self):
+        # Redis expires keys by itself
+        pass
+
+    async def close(self):
+        await self._redis.aclose()
+
+
+def make_backend(url: str):
+    """Build the durable backend for STATE_STORAGE_URL ('' or memory:// means none)."""
+    if not url or url.startswith('memory:'):
+        return None
+    parsed = urlparse(url)
+    if parsed.scheme == 'sqlite':
+        return SQLiteStateBackend(url[len('sqlite:///'):])
+    if parsed.scheme in ('redis', 'rediss', 'unix'):
+        return RedisStateBackend(url)
+    raise ValueError(f"Unsupported STATE_STORAGE_URL scheme: {parsed.scheme}")
+
+
+class StateStore:
+    """Per-key TTL state with a memory cap and optional write-through durability."""
+
+    def __init__(self, ttl: float = STATE_TTL_SECONDS, max_entries: int = STATE_MAX_ENTRIES, backend=None):
+        self.ttl = ttl
+        self.backend = backend
+        self._cache = TTLCache(max_entries=max_entries, ttl=ttl)
+        # while True every live durable entry is also cached, so a memory miss is final
+        self._complete = True
+
+    async def open(self):
+        """Warm the cache from the durable backend."""
+        if self.backend is None:
+            return
+        limit = self._cache.max_entries
+        rows = await self.backend.load(limit + 1)
+        if len(rows) > limit:
+            self._complete = False
+            rows = rows[:limit]
+        for key, raw, left in reversed(rows):
+            self._cache.set(key, json.loads(raw), ttl=left)
+        logger.info("Restored %s conversation states", len(rows))
+
+    async def get(self, key):
+        key = str(key)
+        value = self._cache.get(key)
+        if value is not None or self.backend is None or self._complete:
+            return value
+        raw = await self.backend.get(key)
+        if raw is None:
+            return None
+        value = json.loads(raw)
+        self._set_cached(key, value, None)
+        return value
+
+    async def set(self, key, value: dict, ttl: float = None):
+        key = str(key)
+        self._set_cached(key, value, ttl)
+        if self.backend is not None:
+            await self.backend.set(key, json.dumps(value), ttl or self.ttl)
+
+    async def delete(self, key):
+        key = str(key)
+        self._cache.pop(key)
+        if self.backend is not None:
+            await self.backend.delete(key)
+
+    def _set_cached(self, key, value, ttl):
+        evicted = self._cache.evictions
+        self._cache.set(key, value, ttl)
+        if self._cache.evictions != evicted and self.backend is not None:
+            self._complete = False
+
+    async def purge_expired(self):
+        n = self._cache.purge_expired()
+        if self.backend is not None:
+            await self.backend.purge_expired()
+        return n
+
+    async def run_sweeper(self, interval: float = 300):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.purge_expired()
+            except Exception:
+                logger.exception("State sweep failed")
+
+    async def close(self):
+        if self.backend is not None:
+            await self.backend.close()
+
+    def stats(self) -> dict:
+        return self._cache.stats()
+
+    def __len__(self):
+        return len(self._cache)
+
+
+class FSMStorage(BaseStorage):
+    """aiogram FSM storage backed by a StateStore, so the dispatcher uses the same backend."""
+
+    def __init__(self, store: StateStore):
+        self.store = store
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return f"fsm:{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id}:{key.business_connection_id}:{key.destiny}"
+
+    async def _save(self, k: str, record: dict):
+        if record.get('state') is None and not record.get('data'):
+            await self.store.delete(k)
+        else:
+            await self.store.set(k, record)
+
+    async def set_state(self, key: StorageKey, state=None):
+        k = self._key(key)
+        record = dict(await self.store.get(k) or {})
+        record['state'] = state.state if isinstance(state, State) else state
+        await self._save(k, record)
+
+    async def get_state(self, key: StorageKey):
+        record = await self.store.get(self._key(key))
+        return record.get('state') if record else None
+
+    async def set_data(self, key: StorageKey, data):
+        k = self._key(key)
+        record = dict(await self.store.get(k) or {})
+        record['data'] = dict(data)
+        await self._save(k, record)
+
+    async def get_data(self, key: StorageKey):
+        record = await self.store.get(self._key(key))
+        return dict(record.get('data') or {}) if record else {}
+
+    async def close(self):
+        # the store outlives the dispatcher; bot.py closes it on shutdown
+        pass
+
+
+# Onboarding wizards keep one record per Telegram user: {'flow': ..., 'step': ..., ...}
+conversations = StateStore(backend=make_backend(STATE_STORAGE_URL))